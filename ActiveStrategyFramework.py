@@ -1,8 +1,199 @@
 import pandas as pd
 import numpy as np
-import math
 import UNI_v3_funcs
+import TickConversion
+import JitKernels
 import copy
+from collections.abc import MutableMapping, Sequence
+import bisect
+import functools
+import concurrent.futures
+import os
+import pickle
+
+# 1bp pool's tick spacing is 1x the fee tier, other pool's 2x
+def get_tick_spacing(fee_tier):
+    return int(fee_tier*2*10000) if fee_tier > (100/1e6) else int(fee_tier*10000)
+
+########################################################
+# Position state
+# Liquidity ranges and strategy_info are copy-on-write, so steps without a 
+# rebalance share them instead of deep copying them:
+# - LiquidityRange keeps the fields that only change on a rebalance in a shared
+#   RangeDefinition, and only token_0, token_1 and time per observation.
+# - StrategyInfo shares its dict between observations until one of them writes.
+# Both behave like the dicts they replace, so strategies keep using range['key'].
+# Values are copied shallowly: replace them instead of mutating them in place.
+########################################################
+
+class RangeDefinition:
+    __slots__ = ('price','target_price','lower_bin_tick','upper_bin_tick','lower_bin_price','upper_bin_price',
+                 'position_liquidity','volatility','reset_time','return_forecast','extra')
+    
+    FIELDS    = frozenset(__slots__) - {'extra'}
+    
+    def __init__(self):
+        # Keys that are not slots are kept in a dict
+        self.extra = None
+        
+    def copy(self):
+        new_definition = RangeDefinition()
+        for key in RangeDefinition.FIELDS:
+            if hasattr(self,key):
+                setattr(new_definition,key,getattr(self,key))
+        if self.extra is not None:
+            new_definition.extra = dict(self.extra)
+        return new_definition
+
+class LiquidityRange(MutableMapping):
+    __slots__   = ('definition','owns_definition','token_0','token_1','time')
+    
+    STEP_FIELDS = frozenset(('token_0','token_1','time'))
+    
+    def __init__(self,fields=None):
+        self.definition      = RangeDefinition()
+        self.owns_definition = True
+        if fields is not None:
+            for key,value in fields.items():
+                self[key] = value
+    
+    @staticmethod
+    def from_mapping(liquidity_range):
+        if isinstance(liquidity_range,LiquidityRange):
+            return liquidity_range
+        return LiquidityRange(liquidity_range)
+    
+    def advance(self,time):
+        # Range for the next observation, sharing the definition until either side writes to it
+        new_range                 = LiquidityRange.__new__(LiquidityRange)
+        new_range.definition      = self.definition
+        new_range.owns_definition = False
+        self.owns_definition      = False
+        if hasattr(self,'token_0'):
+            new_range.token_0     = self.token_0
+        if hasattr(self,'token_1'):
+            new_range.token_1     = self.token_1
+        new_range.time            = time
+        return new_range
+    
+    def __getitem__(self,key):
+        try:
+            if key in LiquidityRange.STEP_FIELDS:
+                return getattr(self,key)
+            elif key in RangeDefinition.FIELDS:
+                return getattr(self.definition,key)
+            elif self.definition.extra is not None:
+                return self.definition.extra[key]
+        except AttributeError:
+            pass
+        raise KeyError(key)
+    
+    def __setitem__(self,key,value):
+        if key in LiquidityRange.STEP_FIELDS:
+            setattr(self,key,value)
+            return
+        if not self.owns_definition:
+            self.definition      = self.definition.copy()
+            self.owns_definition = True
+        if key in RangeDefinition.FIELDS:
+            setattr(self.definition,key,value)
+        else:
+            if self.definition.extra is None:
+                self.definition.extra = dict()
+            self.definition.extra[key] = value
+            
+    def __delitem__(self,key):
+        if key not in self:
+            raise KeyError(key)
+        if key in LiquidityRange.STEP_FIELDS:
+            delattr(self,key)
+            return
+        if not self.owns_definition:
+            self.definition      = self.definition.copy()
+            self.owns_definition = True
+        if key in RangeDefinition.FIELDS:
+            delattr(self.definition,key)
+        else:
+            del self.definition.extra[key]
+    
+    def __contains__(self,key):
+        if key in LiquidityRange.STEP_FIELDS:
+            return hasattr(self,key)
+        elif key in RangeDefinition.FIELDS:
+            return hasattr(self.definition,key)
+        return self.definition.extra is not None and key in self.definition.extra
+    
+    def __iter__(self):
+        for key in RangeDefinition.__slots__[:-1]:
+            if hasattr(self.definition,key):
+                yield key
+        if self.definition.extra is not None:
+            yield from self.definition.extra
+        for key in ('time','token_0','token_1'):
+            if hasattr(self,key):
+                yield key
+                
+    def __len__(self):
+        return sum(1 for key in self)
+    
+    def __repr__(self):
+        return 'LiquidityRange('+repr(dict(self))+')'
+
+class StrategyInfo(MutableMapping):
+    __slots__ = ('data','owns_data')
+    
+    def __init__(self,data=None):
+        self.data      = dict() if data is None else dict(data)
+        self.owns_data = True
+    
+    @staticmethod
+    def from_mapping(strategy_info):
+        if strategy_info is None or isinstance(strategy_info,StrategyInfo):
+            return strategy_info
+        return StrategyInfo(strategy_info)
+    
+    @staticmethod
+    def share(strategy_info):
+        # strategy_info for the next observation
+        if strategy_info is None:
+            return None
+        if isinstance(strategy_info,StrategyInfo):
+            return strategy_info.fork()
+        return StrategyInfo(copy.deepcopy(dict(strategy_info)))
+    
+    def fork(self):
+        new_info           = StrategyInfo.__new__(StrategyInfo)
+        new_info.data      = self.data
+        new_info.owns_data = False
+        self.owns_data     = False
+        return new_info
+    
+    def __getitem__(self,key):
+        return self.data[key]
+    
+    def __setitem__(self,key,value):
+        if not self.owns_data:
+            self.data      = dict(self.data)
+            self.owns_data = True
+        self.data[key] = value
+        
+    def __delitem__(self,key):
+        if not self.owns_data:
+            self.data      = dict(self.data)
+            self.owns_data = True
+        del self.data[key]
+        
+    def __contains__(self,key):
+        return key in self.data
+    
+    def __iter__(self):
+        return iter(self.data)
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __repr__(self):
+        return 'StrategyInfo('+repr(self.data)+')'
 
 class StrategyObservation:
     def __init__(self,timepoint,
@@ -20,7 +211,9 @@ class StrategyObservation:
                      liquidity_ranges         = None,
                      strategy_info            = None,
                      swaps                    = None,
-                     simulate_strat           = True):
+                     simulate_strat           = True,
+                     price_tick               = None,
+                     price_tick_current       = None):
         
         ######################################
         # 1. Store current values
@@ -41,15 +234,20 @@ class StrategyObservation:
         self.compound_point              = False
         self.reset_reason                = ''
         self.decimal_adjustment          = 10**(self.decimals_1  - self.decimals_0)
-        self.tickSpacing                 = int(self.fee_tier*2*10000) if self.fee_tier > (100/1e6) else int(self.fee_tier*10000) # 1bp pool's tick spacing is 1x the fee tier, other pool's 2x
+        self.tickSpacing                 = get_tick_spacing(self.fee_tier)
         self.token_0_fees                = 0.0
         self.token_1_fees                = 0.0
         self.simulate_strat              = simulate_strat
-        self.strategy_info               = copy.deepcopy(strategy_info)
+        self.strategy_info               = StrategyInfo.share(strategy_info)
         
-        TICK_P_PRE                       = math.log(self.decimal_adjustment*self.price,1.0001)
-        self.price_tick                  = math.floor(TICK_P_PRE/self.tickSpacing)*self.tickSpacing
-        self.price_tick_current          = math.floor(TICK_P_PRE)
+        # Ticks can be precomputed for the whole price series (see SimulationTimeline)
+        if price_tick is None or price_tick_current is None:
+            TICK_P_PRE                   = TickConversion.raw_ticks(self.price,self.decimal_adjustment)
+            self.price_tick              = TickConversion.snap_ticks(TICK_P_PRE,self.tickSpacing,'floor')
+            self.price_tick_current      = TickConversion.snap_ticks(TICK_P_PRE,1,'floor')
+        else:
+            self.price_tick              = price_tick
+            self.price_tick_current      = price_tick_current
             
         ######################################
         # 2. Execute the strategy
@@ -59,25 +257,20 @@ class StrategyObservation:
         #        If no swap data is fed in (for a live environment) only ranges will be updated 
         ######################################
         if liquidity_ranges is None:
-            self.liquidity_ranges,self.strategy_info  = strategy_in.set_liquidity_ranges(self)
+            self.set_ranges(*strategy_in.set_liquidity_ranges(self))
                                  
         else: 
-            self.liquidity_ranges         = copy.deepcopy(liquidity_ranges)
+            self.liquidity_ranges         = [LiquidityRange.from_mapping(x).advance(self.time) for x in liquidity_ranges]
             
             # Update amounts in each position according to current pool price
-            for i in range(len(self.liquidity_ranges)):
-                self.liquidity_ranges[i]['time'] = self.time
-                
-                if self.simulate_strat:
-                    amount_0, amount_1 = UNI_v3_funcs.get_amounts(self.price_tick_current,
-                                                                 self.liquidity_ranges[i]['lower_bin_tick'],
-                                                                 self.liquidity_ranges[i]['upper_bin_tick'],
-                                                                 self.liquidity_ranges[i]['position_liquidity'],
-                                                                 self.decimals_0,
-                                                                 self.decimals_1)
-
-                    self.liquidity_ranges[i]['token_0'] = amount_0
-                    self.liquidity_ranges[i]['token_1'] = amount_1
+            if self.simulate_strat:
+                for liquidity_range in self.liquidity_ranges:
+                    liquidity_range.token_0, liquidity_range.token_1 = UNI_v3_funcs.get_amounts(self.price_tick_current,
+                                                                                                 liquidity_range['lower_bin_tick'],
+                                                                                                 liquidity_range['upper_bin_tick'],
+                                                                                                 liquidity_range['position_liquidity'],
+                                                                                                 self.decimals_0,
+                                                                                                 self.decimals_1)
 
             # If backtesting swaps, accrue the fees in the provided period
             if swaps is not None:
@@ -86,7 +279,15 @@ class StrategyObservation:
                 self.token_1_fees                   = fees_token_1
                 
             # Check strategy and potentially reset the ranges
-            self.liquidity_ranges,self.strategy_info     = strategy_in.check_strategy(self)
+            self.set_ranges(*strategy_in.check_strategy(self))
+    
+    ########################################################
+    # Store the ranges and strategy_info returned by a strategy
+    # Strategies can return plain dicts
+    ########################################################
+    def set_ranges(self,liquidity_ranges,strategy_info):
+        self.liquidity_ranges = [LiquidityRange.from_mapping(x) for x in liquidity_ranges]
+        self.strategy_info    = StrategyInfo.from_mapping(strategy_info)
                 
     ########################################################
     # Accrue earned fees (not supply into LP yet)
@@ -98,22 +299,23 @@ class StrategyObservation:
                 
         if len(relevant_swaps) > 0:
             
-            # For every swap in this time period
-            for s in range(len(relevant_swaps)):
-                for i in range(len(self.liquidity_ranges)):
-                    in_range   = (self.liquidity_ranges[i]['lower_bin_tick'] <= relevant_swaps.iloc[s]['tick_swap']) and \
-                                 (self.liquidity_ranges[i]['upper_bin_tick'] >= relevant_swaps.iloc[s]['tick_swap'])
-
-                    token_0_in = relevant_swaps.iloc[s]['token_in'] == 'token0'
-                    
-                    # Low liquidity tokens can have zero liquidity after swap
-                    if relevant_swaps.iloc[s]['virtual_liquidity'] < 1e-9:
-                        fraction_fees_earned_position = 1
-                    else:
-                        fraction_fees_earned_position = self.liquidity_ranges[i]['position_liquidity']/(self.liquidity_ranges[i]['position_liquidity'] + relevant_swaps.iloc[s]['virtual_liquidity'])
-
-                    fees_earned_token_0 += in_range * token_0_in     * self.fee_tier * fraction_fees_earned_position * relevant_swaps.iloc[s]['traded_in']
-                    fees_earned_token_1 += in_range * (1-token_0_in) * self.fee_tier * fraction_fees_earned_position * relevant_swaps.iloc[s]['traded_in']
+            if isinstance(relevant_swaps,pd.DataFrame):
+                relevant_swaps = SwapColumns.from_frame(relevant_swaps)
+            
+            # Windows of a FeeIndex.FeeIndex are looked up rather than scanned
+            if hasattr(relevant_swaps,'fees_earned'):
+                fees_earned_token_0,fees_earned_token_1 = relevant_swaps.fees_earned([x['lower_bin_tick']     for x in self.liquidity_ranges],
+                                                                                     [x['upper_bin_tick']     for x in self.liquidity_ranges],
+                                                                                     [x['position_liquidity'] for x in self.liquidity_ranges])
+            else:
+                fees_earned_token_0,fees_earned_token_1 = accrue_fees_columnar(relevant_swaps.tick_swap,
+                                                                           relevant_swaps.token_0_in,
+                                                                           relevant_swaps.virtual_liquidity,
+                                                                           relevant_swaps.traded_in,
+                                                                           [x['lower_bin_tick']     for x in self.liquidity_ranges],
+                                                                           [x['upper_bin_tick']     for x in self.liquidity_ranges],
+                                                                           [x['position_liquidity'] for x in self.liquidity_ranges],
+                                                                           self.fee_tier)
         
         self.token_0_fees_uncollected += fees_earned_token_0
         self.token_1_fees_uncollected += fees_earned_token_1
@@ -152,47 +354,1288 @@ class StrategyObservation:
         self.token_1_fees_uncollected = 0.0
         
    
+########################################################
+# Columnar fee accrual
+# Computes the fees earned by every range over a batch of swaps in one pass.
+# Swap columns are NumPy arrays, range attributes are sequences with one
+# entry per range. Terms are added in the same (swap, range) order as a 
+# swap by swap loop, so the result is identical to accruing one swap at a time.
+# Only the ranges each swap is in are visited, found through a RangeIndex.
+########################################################
+
+def accrue_fees_columnar(tick_swap,token_0_in,virtual_liquidity,traded_in,
+                         lower_bin_tick,upper_bin_tick,position_liquidity,fee_tier):
+    
+    if len(tick_swap) == 0 or len(position_liquidity) == 0:
+        return 0.0,0.0
+    
+    if JitKernels.ENABLED:
+        # The RangeIndex finds the pairs, only the terms and their sums are compiled
+        swap_index,range_index    = get_range_index(tuple(lower_bin_tick),tuple(upper_bin_tick)).pairs(np.asarray(tick_swap))
+        fees_token_0,fees_token_1 = JitKernels.accrue_fee_pairs(swap_index,range_index,np.asarray(token_0_in,dtype=bool),
+                                                                np.asarray(virtual_liquidity,dtype=float),np.asarray(traded_in,dtype=float),
+                                                                np.array([float(x) for x in position_liquidity]),fee_tier)
+        return 0.0 + float(fees_token_0),0.0 + float(fees_token_1)
+    
+    fees_token_0,fees_token_1,_ = fee_terms_columnar(tick_swap,token_0_in,virtual_liquidity,traded_in,
+                                                     lower_bin_tick,upper_bin_tick,position_liquidity,fee_tier)
+    
+    return sum_fee_terms(fees_token_0),sum_fee_terms(fees_token_1)
+
+def fee_terms_columnar(tick_swap,token_0_in,virtual_liquidity,traded_in,
+                       lower_bin_tick,upper_bin_tick,position_liquidity,fee_tier):
+    
+    # Fees earned on each (swap, range) pair where the swap is in range, ordered by swap then range
+    swap_index,range_index = get_range_index(tuple(lower_bin_tick),tuple(upper_bin_tick)).pairs(np.asarray(tick_swap))
+    
+    token_0_in         = np.asarray(token_0_in,dtype=bool)[swap_index]
+    virtual_liquidity  = np.asarray(virtual_liquidity,dtype=float)[swap_index]
+    traded_in          = np.asarray(traded_in,dtype=float)[swap_index]
+    
+    # Liquidity can be larger than int64, convert each value like python would
+    position_liquidity = np.array([float(x) for x in position_liquidity])[range_index]
+    
+    # Low liquidity tokens can have zero liquidity after swap
+    with np.errstate(divide='ignore',invalid='ignore'):
+        fraction_fees_earned_position = np.where(virtual_liquidity < 1e-9,1.0,position_liquidity/(position_liquidity + virtual_liquidity))
+    
+    fees               = fee_tier * fraction_fees_earned_position * traded_in
+    fees_token_0       = np.where(token_0_in,fees,0.0)
+    fees_token_1       = np.where(token_0_in,0.0,fees)
+    
+    return fees_token_0,fees_token_1,swap_index
+
+def sum_fee_terms(fee_terms):
+    # cumsum adds sequentially (np.sum uses pairwise summation)
+    if fee_terms.size == 0:
+        return 0.0
+    return 0.0 + float(np.cumsum(fee_terms.ravel())[-1])
+
+########################################################
+# Interval index over the ranges of a position
+# The range endpoints split the ticks into elementary segments: below the 
+# first endpoint, each endpoint, and between consecutive endpoints. Each 
+# segment stores the ranges that cover it (CSR layout), so finding the ranges
+# a swap is in is one binary search, however many ranges there are.
+########################################################
+
+class RangeIndex:
+    def __init__(self,lower_bin_tick,upper_bin_tick):
+        
+        lower_bin_tick  = np.asarray(lower_bin_tick,dtype=float)
+        upper_bin_tick  = np.asarray(upper_bin_tick,dtype=float)
+        self.endpoints  = np.unique(np.concatenate([lower_bin_tick,upper_bin_tick]))
+        
+        # Segment 2*j+1 is endpoint j, segment 2*j+2 lies between endpoints j and j+1
+        first_segment   = 2*np.searchsorted(self.endpoints,lower_bin_tick) + 1
+        last_segment    = 2*np.searchsorted(self.endpoints,upper_bin_tick) + 1
+        n_segments      = np.maximum(last_segment - first_segment + 1,0)
+        
+        range_ids       = np.repeat(np.arange(len(lower_bin_tick)),n_segments)
+        segments        = np.repeat(first_segment,n_segments) + expand_offsets(n_segments)
+        order           = np.lexsort((range_ids,segments))
+        self.ranges     = range_ids[order]
+        self.indptr     = np.concatenate([[0],np.cumsum(np.bincount(segments,minlength=2*len(self.endpoints)+1))])
+        
+    def segment(self,tick):
+        endpoint        = np.searchsorted(self.endpoints,tick,side='right') - 1
+        on_endpoint     = (endpoint >= 0) & (self.endpoints[np.maximum(endpoint,0)] == tick)
+        return np.where(on_endpoint,2*endpoint + 1,2*endpoint + 2)
+    
+    def pairs(self,tick_swap):
+        # (swap, range) positions of every swap in range, ordered by swap then range
+        segment         = self.segment(tick_swap)
+        start           = self.indptr[segment]
+        n_ranges        = self.indptr[segment + 1] - start
+        swap_index      = np.repeat(np.arange(len(tick_swap)),n_ranges)
+        range_index     = self.ranges[np.repeat(start,n_ranges) + expand_offsets(n_ranges)]
+        return swap_index,range_index
+
+def expand_offsets(counts):
+    # 0, 1, ..., counts[0]-1, 0, 1, ..., counts[1]-1, ...
+    counts = np.asarray(counts)
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,counts)
+
+# Positions keep their ranges between rebalances, so the same index is asked for repeatedly
+@functools.lru_cache(maxsize=16)
+def get_range_index(lower_bin_tick,upper_bin_tick):
+    return RangeIndex(lower_bin_tick,upper_bin_tick)
+   
+########################################################
+# Swap data as NumPy columns, the inputs of accrue_fees_columnar
+########################################################
+
+class SwapColumns:
+    __slots__ = ('tick_swap','token_0_in','virtual_liquidity','traded_in')
+    
+    def __init__(self,tick_swap,token_0_in,virtual_liquidity,traded_in):
+        self.tick_swap         = tick_swap
+        self.token_0_in        = token_0_in
+        self.virtual_liquidity = virtual_liquidity
+        self.traded_in         = traded_in
+        
+    @classmethod
+    def from_frame(cls,swap_data):
+        return cls(swap_data['tick_swap'].to_numpy(dtype=float),
+                   swap_data['token_in'].to_numpy() == 'token0',
+                   swap_data['virtual_liquidity'].to_numpy(dtype=float),
+                   swap_data['traded_in'].to_numpy(dtype=float))
+    
+    def __len__(self):
+        return len(self.tick_swap)
+    
+    def window(self,start,end):
+        # Slices are views, no data is copied
+        return SwapColumns(self.tick_swap[start:end],self.token_0_in[start:end],
+                           self.virtual_liquidity[start:end],self.traded_in[start:end])
+
+def datetime_index_ns(index):
+    # Nanoseconds since epoch (UTC for timezone aware indices)
+    return pd.DatetimeIndex(index).values.astype('datetime64[ns]').view('int64')
+
+########################################################
+# Compiled simulation inputs
+# Everything simulate_strategy needs from price_data and swap_data is computed once:
+# the ticks of every price, and the offsets of the swaps between consecutive prices.
+# The same timeline can be reused for any strategy or parameter set on the same pool.
+# With a FeeIndex.FeeIndex built from swap_data, fees are looked up in the index.
+########################################################
+
+class SimulationTimeline:
+    def __init__(self,price_data,swap_data,fee_tier,decimals_0,decimals_1,fee_index=None):
+        
+        self.fee_tier           = fee_tier
+        self.decimals_0         = decimals_0
+        self.decimals_1         = decimals_1
+        self.tickSpacing        = get_tick_spacing(fee_tier)
+        decimal_adjustment      = 10**(decimals_1  - decimals_0)
+        
+        # Price series
+        self.time               = list(price_data.index)
+        self.time_ns            = datetime_index_ns(price_data.index)
+        self.price              = price_data.to_numpy()
+        
+        TICK_P_PRE              = TickConversion.raw_ticks(self.price,decimal_adjustment)
+        self.price_tick         = TickConversion.snap_ticks(TICK_P_PRE,self.tickSpacing,'floor')
+        self.price_tick_current = TickConversion.snap_ticks(TICK_P_PRE,1,'floor')
+        
+        # Swaps for step i are the ones between time[i-1] and time[i], both included
+        self.swaps              = SwapColumns.from_frame(swap_data)
+        swap_time_ns            = datetime_index_ns(swap_data.index)
+        if np.any(np.diff(self.time_ns) < 0) or np.any(np.diff(swap_time_ns) < 0):
+            raise ValueError('price_data and swap_data must be sorted by time')
+        self.swap_start         = np.searchsorted(swap_time_ns,self.time_ns[:-1],side='left')
+        self.swap_end           = np.searchsorted(swap_time_ns,self.time_ns[1:], side='right')
+        
+        if fee_index is not None and (len(fee_index) != len(self.swaps) or fee_index.fee_tier != fee_tier):
+            raise ValueError('fee_index was built from different swaps or for a different fee tier')
+        self.fee_index          = fee_index
+        
+    def __len__(self):
+        return len(self.time)
+    
+    def swaps_between(self,i):
+        if self.fee_index is not None:
+            return self.fee_index.window(self.swap_start[i-1],self.swap_end[i-1])
+        return self.swaps.window(self.swap_start[i-1],self.swap_end[i-1])
+
+def compile_timeline(price_data,swap_data,fee_tier,decimals_0,decimals_1,fee_index=None):
+    return SimulationTimeline(price_data,swap_data,fee_tier,decimals_0,decimals_1,fee_index)
+
+def check_timeline(timeline,price_data,swap_data,fee_tier,decimals_0,decimals_1):
+    # A precompiled timeline replaces price_data and swap_data, so both must be the ones it was compiled from
+    if (timeline.fee_tier,timeline.decimals_0,timeline.decimals_1) != (fee_tier,decimals_0,decimals_1):
+        raise ValueError('timeline was compiled for a different fee tier or decimals')
+    if price_data is not None and swap_data is not None:
+        if timeline_fingerprint(timeline) != data_fingerprint(price_data,swap_data,fee_tier,decimals_0,decimals_1):
+            raise ValueError('timeline was compiled from different price or swap data')
+    
 ########################################################
 # Simulate strategy using a pandas Series called price_data, which has as an index
 # the time point, and contains the pool price (token 1 per token 0) 
+# A precompiled timeline can be passed to skip the input preprocessing
 ########################################################
 
 def simulate_strategy(price_data,swap_data,strategy_in,
-                       liquidity_in_0,liquidity_in_1,fee_tier,decimals_0,decimals_1):
+                       liquidity_in_0,liquidity_in_1,fee_tier,decimals_0,decimals_1,timeline=None,record=False,fee_index=None):
 
-    strategy_results = []    
+    if timeline is None:
+        timeline = compile_timeline(price_data,swap_data,fee_tier,decimals_0,decimals_1,fee_index)
+    else:
+        check_timeline(timeline,price_data,swap_data,fee_tier,decimals_0,decimals_1)
+    
+    # In recording mode only the previous observation is kept, 
+    # every step is written to the preallocated columns of a SimulationRecorder
+    if record:
+        strategy_results = SimulationRecorder(strategy_in,len(timeline))
+        for strategy_observation in iterate_observations(timeline,strategy_in,liquidity_in_0,liquidity_in_1):
+            strategy_results.record(strategy_observation)
+        return strategy_results
+    
+    return list(iterate_observations(timeline,strategy_in,liquidity_in_0,liquidity_in_1))
+
+def iterate_observations(timeline,strategy_in,liquidity_in_0,liquidity_in_1):
   
     # Go through every time period in the data that was passet
-    for i in range(len(price_data)): 
+    for i in range(len(timeline)): 
         # Strategy Initialization
         if i == 0:
-            strategy_results.append(StrategyObservation(price_data.index[i],
-                                              price_data[i],
-                                              strategy_in,
-                                              liquidity_in_0,liquidity_in_1,
-                                              fee_tier,decimals_0,decimals_1))
+            previous = initial_observation(timeline,strategy_in,liquidity_in_0,liquidity_in_1)
         # After initialization
         else:
+            previous = next_observation(timeline,i,strategy_in,previous)
+        yield previous
+
+########################################################
+# Streaming simulation over chunked inputs
+# price_chunks is an iterable of price Series and swap_chunks an iterable of swap
+# DataFrames (e.g. read from time partitioned files), both in time order.
+# Only the current chunks, the swaps that straddle them and the previous 
+# observation are held in memory, and each step is identical to simulate_strategy.
+########################################################
+
+def iterate_observations_stream(price_chunks,swap_chunks,strategy_in,
+                                liquidity_in_0,liquidity_in_1,fee_tier,decimals_0,decimals_1):
+    
+    swap_chunks   = iter(swap_chunks)
+    swap_buffer   = None
+    swaps_done    = False
+    previous      = None
+    
+    for price_chunk in price_chunks:
+        if len(price_chunk) == 0:
+            continue
+            
+        # Steps of this chunk need the swaps since the last price of the previous chunk
+        if previous is not None:
+            price_chunk = pd.concat([pd.Series([previous.price],index=[previous.time]),price_chunk])
+        chunk_end = price_chunk.index[-1]
+        
+        # Load swaps until the buffer goes past the end of this chunk
+        while not swaps_done and (swap_buffer is None or len(swap_buffer) == 0 or swap_buffer.index[-1] <= chunk_end):
+            try:
+                swap_chunk  = next(swap_chunks)
+                swap_buffer = swap_chunk if swap_buffer is None else pd.concat([swap_buffer,swap_chunk])
+            except StopIteration:
+                swaps_done  = True
+        if swap_buffer is None:
+            raise ValueError('swap_chunks did not yield any swap data')
+        
+        timeline    = compile_timeline(price_chunk,swap_buffer[:chunk_end],fee_tier,decimals_0,decimals_1)
+        
+        # Swaps at chunk_end also belong to the first step of the next chunk
+        swap_buffer = swap_buffer[chunk_end:]
+        
+        for i in range(len(timeline)):
+            if previous is None:
+                previous = initial_observation(timeline,strategy_in,liquidity_in_0,liquidity_in_1)
+            elif i > 0:
+                previous = next_observation(timeline,i,strategy_in,previous)
+            else:
+                continue
+            yield previous
+
+def simulate_strategy_stream(price_chunks,swap_chunks,strategy_in,
+                             liquidity_in_0,liquidity_in_1,fee_tier,decimals_0,decimals_1,sink):
+    
+    # sink is either a recorder (e.g. ChunkedRecorder) or a function that takes each observation
+    strategy_observation = None
+    for strategy_observation in iterate_observations_stream(price_chunks,swap_chunks,strategy_in,
+                                                            liquidity_in_0,liquidity_in_1,fee_tier,decimals_0,decimals_1):
+        if hasattr(sink,'record'):
+            sink.record(strategy_observation)
+        else:
+            sink(strategy_observation)
+            
+    if hasattr(sink,'flush'):
+        sink.flush()
+        
+    # Last observation, to continue the simulation if more data arrives
+    return strategy_observation
+
+########################################################
+# Snapshots and branches
+# simulate_until simulates up to a time and returns a SimulationSnapshot, from
+# which any number of branches continue with other strategy objects or 
+# strategy_info entries (e.g. {'force_initial_reset': True} for 
+# AutoRegressiveStrategy). Branches without their own strategy object continue
+# a deep copy of the snapshot's, so they all start from its state at the snapshot.
+# Branch results are views over the snapshot's results followed by their own,
+# so the shared prefix is neither re-simulated nor copied.
+# A branch can itself be simulated until a later time and forked again.
+########################################################
+
+def simulate_until(price_data,swap_data,strategy_in,liquidity_in_0,liquidity_in_1,fee_tier,decimals_0,decimals_1,
+                   until,timeline=None,record=False,fee_index=None):
+    
+    if timeline is None:
+        timeline = compile_timeline(price_data,swap_data,fee_tier,decimals_0,decimals_1,fee_index)
+    else:
+        check_timeline(timeline,price_data,swap_data,fee_tier,decimals_0,decimals_1)
+    
+    end = snapshot_step(timeline,until) + 1
+    if end < 1:
+        raise ValueError('until is before the first price')
+    
+    strategy_results = SimulationRecorder(strategy_in,end) if record else []
+    for i in range(end):
+        if i == 0:
+            strategy_observation = initial_observation(timeline,strategy_in,liquidity_in_0,liquidity_in_1)
+        else:
+            strategy_observation = next_observation(timeline,i,strategy_in,strategy_observation)
+        if record:
+            strategy_results.record(strategy_observation)
+        else:
+            strategy_results.append(strategy_observation)
+            
+    return SimulationSnapshot(timeline,strategy_in,strategy_results,strategy_observation)
+
+def snapshot_step(timeline,until):
+    # Last step at or before until
+    return int(np.searchsorted(timeline.time_ns,pd.Timestamp(until).value,side='right')) - 1
+
+class SimulationSnapshot:
+    def __init__(self,timeline,strategy_in,strategy_results,strategy_observation):
+        self.timeline             = timeline
+        self.strategy_in          = strategy_in
+        self.strategy_results     = strategy_results
+        self.strategy_observation = strategy_observation
+        self.step                 = len(strategy_results) - 1
+        
+    @property
+    def time(self):
+        return self.timeline.time[self.step]
+    
+    def fork(self,strategy_in=None,strategy_info=None,until=None):
+        
+        # Results of a branch continuing from this snapshot, or a snapshot of it at until.
+        # Every branch continues a copy of the snapshot's strategy, whose state (e.g. model caches) 
+        # must not leak from one branch to another
+        strategy_in = copy.deepcopy(self.strategy_in) if strategy_in is None else strategy_in
+        end         = len(self.timeline) if until is None else snapshot_step(self.timeline,until) + 1
+        if end <= self.step:
+            raise ValueError('until is before the snapshot')
+        
+        previous    = self.strategy_observation
+        if strategy_info is not None:
+            previous               = copy.copy(previous)
+            previous.strategy_info = StrategyInfo.share(previous.strategy_info) if previous.strategy_info is not None else StrategyInfo()
+            for key,value in strategy_info.items():
+                previous.strategy_info[key] = value
+        
+        record           = isinstance(self.strategy_results,SimulationRecorder)
+        strategy_results = BranchRecorder(strategy_in,self.strategy_results,end) if record else BranchResults(self.strategy_results)
+        for i in range(self.step+1,end):
+            previous = next_observation(self.timeline,i,strategy_in,previous)
+            strategy_results.record(previous)
             
-            relevant_swaps = swap_data[price_data.index[i-1]:price_data.index[i]]
-            strategy_results.append(StrategyObservation(price_data.index[i],
-                                              price_data[i],
-                                              strategy_in,
-                                              strategy_results[i-1].liquidity_in_0,
-                                              strategy_results[i-1].liquidity_in_1,
-                                              strategy_results[i-1].fee_tier,
-                                              strategy_results[i-1].decimals_0,
-                                              strategy_results[i-1].decimals_1,
-                                              strategy_results[i-1].token_0_left_over,
-                                              strategy_results[i-1].token_1_left_over,
-                                              strategy_results[i-1].token_0_fees_uncollected,
-                                              strategy_results[i-1].token_1_fees_uncollected,
-                                              strategy_results[i-1].liquidity_ranges,
-                                              strategy_results[i-1].strategy_info,
-                                              relevant_swaps))
+        if until is None:
+            return strategy_results
+        return SimulationSnapshot(self.timeline,strategy_in,strategy_results,previous)
+
+class BranchResults(Sequence):
+    # Observations of the snapshot followed by those of the branch
+    def __init__(self,prefix):
+        self.prefix       = prefix
+        self.n_prefix     = len(prefix)
+        self.observations = []
+        
+    def record(self,strategy_observation):
+        self.observations.append(strategy_observation)
+        
+    def __len__(self):
+        return self.n_prefix + len(self.observations)
+    
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        if i < self.n_prefix:
+            return self.prefix[i]
+        return self.observations[i-self.n_prefix]
+
+########################################################
+# Checkpointed simulation
+# Records like simulate_strategy(record=True) and every checkpoint_every steps
+# saves its state to the checkpoint_path directory: the strategy (once), the 
+# recorded rows in append-only segments and the last observation with the 
+# loop position. A first checkpoint is saved before the first step, so a run
+# interrupted at any point can be resumed. resume_simulation continues from 
+# the last checkpoint with the same data. The strategy is restored as it was
+# pickled at the start: state it changes during a simulation (e.g. model 
+# caches, as in AutoRegressiveStrategy) is only carried over if it saves it
+# with checkpoint_state and restores it with restore_state. With such hooks,
+# or without state outside the observations, results are those of an 
+# uninterrupted run.
+########################################################
+
+def simulate_strategy_checkpointed(price_data,swap_data,strategy_in,liquidity_in_0,liquidity_in_1,fee_tier,decimals_0,decimals_1,
+                                   checkpoint_path,checkpoint_every=1000,timeline=None,fee_index=None):
+    
+    if timeline is None:
+        timeline = compile_timeline(price_data,swap_data,fee_tier,decimals_0,decimals_1,fee_index)
+    else:
+        check_timeline(timeline,price_data,swap_data,fee_tier,decimals_0,decimals_1)
+    
+    # Start over, removing the files of a previous run
+    os.makedirs(checkpoint_path,exist_ok=True)
+    for file_name in os.listdir(checkpoint_path):
+        if file_name.startswith('rows_') or file_name in ('state.pkl','strategy.pkl'):
+            os.remove(os.path.join(checkpoint_path,file_name))
+            
+    with open(os.path.join(checkpoint_path,'strategy.pkl'),'wb') as output:
+        pickle.dump(strategy_in,output,pickle.HIGHEST_PROTOCOL)
+    
+    checkpoint = {'fingerprint'      : timeline_fingerprint(timeline),
+                  'liquidity_in'     : (liquidity_in_0,liquidity_in_1),
+                  'checkpoint_every' : checkpoint_every,
+                  'next_step'        : 0,
+                  'segments'         : [],
+                  'observation'      : None}
+    strategy_results = SimulationRecorder(strategy_in,len(timeline))
+    save_state(timeline,strategy_in,checkpoint,checkpoint_path,strategy_results,None,0)
+    
+    return run_checkpointed(timeline,strategy_in,checkpoint,checkpoint_path,strategy_results)
+
+def resume_simulation(price_data,swap_data,checkpoint_path,timeline=None,fee_index=None):
+    
+    with open(os.path.join(checkpoint_path,'strategy.pkl'),'rb') as input:
+        strategy_in = pickle.load(input)
+    with open(os.path.join(checkpoint_path,'state.pkl'),'rb') as input:
+        checkpoint  = pickle.load(input)
+    
+    if timeline is None:
+        timeline = compile_timeline(price_data,swap_data,checkpoint['fee_tier'],checkpoint['decimals_0'],checkpoint['decimals_1'],fee_index)
+    if timeline_fingerprint(timeline) != checkpoint['fingerprint']:
+        raise ValueError('checkpoint in '+checkpoint_path+' was saved for different price or swap data')
+    
+    if hasattr(strategy_in,'restore_state'):
+        strategy_in.restore_state(checkpoint['strategy_state'])
+    
+    # Rows recorded up to the checkpoint
+    strategy_results = SimulationRecorder(strategy_in,len(timeline))
+    strategy_results.time_zone                                  = checkpoint['time_zone']
+    strategy_results.token_0_initial,strategy_results.token_1_initial = checkpoint['token_initial']
+    for file_name in checkpoint['segments']:
+        with open(os.path.join(checkpoint_path,file_name),'rb') as input:
+            segment = pickle.load(input)
+        n_rows  = len(segment['time'])
+        strategy_results.time[strategy_results.length:strategy_results.length+n_rows] = segment['time']
+        for name,x in strategy_results.columns.items():
+            x[strategy_results.length:strategy_results.length+n_rows] = segment['columns'][name]
+        strategy_results.length += n_rows
+        
+    return run_checkpointed(timeline,strategy_in,checkpoint,checkpoint_path,strategy_results)
+
+def run_checkpointed(timeline,strategy_in,checkpoint,checkpoint_path,strategy_results):
+    
+    previous       = checkpoint['observation']
+    segment_start  = strategy_results.length
+    
+    for i in range(checkpoint['next_step'],len(timeline)):
+        if i == 0:
+            previous = initial_observation(timeline,strategy_in,*checkpoint['liquidity_in'])
+        else:
+            previous = next_observation(timeline,i,strategy_in,previous)
+        strategy_results.record(previous)
+        
+        if (i + 1) % checkpoint['checkpoint_every'] == 0 or i == len(timeline) - 1:
+            save_checkpoint(timeline,strategy_in,checkpoint,checkpoint_path,strategy_results,segment_start,previous,i+1)
+            segment_start = strategy_results.length
             
     return strategy_results
 
+def save_checkpoint(timeline,strategy_in,checkpoint,checkpoint_path,strategy_results,segment_start,previous,next_step):
+    
+    # Rows since the last checkpoint go to a new segment, then the state is replaced in one step
+    # so that an interrupted save leaves the previous checkpoint
+    file_name = 'rows_{:012d}.pkl'.format(segment_start)
+    segment   = {'time'    : strategy_results.time[segment_start:strategy_results.length],
+                 'columns' : {name: x[segment_start:strategy_results.length] for name,x in strategy_results.columns.items()}}
+    with open(os.path.join(checkpoint_path,file_name),'wb') as output:
+        pickle.dump(segment,output,pickle.HIGHEST_PROTOCOL)
+    checkpoint['segments'] = checkpoint['segments'] + [file_name]
+    save_state(timeline,strategy_in,checkpoint,checkpoint_path,strategy_results,previous,next_step)
+
+def save_state(timeline,strategy_in,checkpoint,checkpoint_path,strategy_results,previous,next_step):
+    
+    checkpoint.update({'next_step'      : next_step,
+                       'observation'    : previous,
+                       'fee_tier'       : timeline.fee_tier,
+                       'decimals_0'     : timeline.decimals_0,
+                       'decimals_1'     : timeline.decimals_1,
+                       'time_zone'      : strategy_results.time_zone,
+                       'token_initial'  : (strategy_results.token_0_initial,strategy_results.token_1_initial),
+                       'strategy_state' : strategy_in.checkpoint_state() if hasattr(strategy_in,'checkpoint_state') else None})
+    with open(os.path.join(checkpoint_path,'state.pkl.tmp'),'wb') as output:
+        pickle.dump(checkpoint,output,pickle.HIGHEST_PROTOCOL)
+    os.replace(os.path.join(checkpoint_path,'state.pkl.tmp'),os.path.join(checkpoint_path,'state.pkl'))
+
+def timeline_fingerprint(timeline):
+    # Identifies the prices and swaps a timeline was compiled from
+    return [len(timeline),int(timeline.time_ns[0]),int(timeline.time_ns[-1]),float(np.sum(timeline.price)),
+            len(timeline.swaps),float(np.sum(timeline.swaps.traded_in)),float(np.sum(timeline.swaps.tick_swap)),
+            timeline.fee_tier,timeline.decimals_0,timeline.decimals_1]
+
+def data_fingerprint(price_data,swap_data,fee_tier,decimals_0,decimals_1):
+    # timeline_fingerprint of the timeline compile_timeline would build from these inputs
+    time_ns = datetime_index_ns(price_data.index)
+    return [len(price_data),int(time_ns[0]),int(time_ns[-1]),float(np.sum(price_data.to_numpy())),
+            len(swap_data),float(np.sum(swap_data['traded_in'].to_numpy(dtype=float))),
+            float(np.sum(swap_data['tick_swap'].to_numpy(dtype=float))),fee_tier,decimals_0,decimals_1]
+
+########################################################
+# Sharded simulation of one long backtest on several processes
+#
+# For strategies whose ranges after a reset depend only on prices (like
+# ResetStrategy), the state after a reset depends on the past only through
+# the capital removed from the pool. The timeline is split in n_shards 
+# pieces which are simulated in worker processes, then stitched in order: the
+# actual simulation is continued from the end of the previous shard until both
+# it and the shard reset at the same step with the same recorded strategy state
+# (the simulation_columns not in amount_columns), the same token composition 
+# (share of value in token 1 within tolerance) and the same capital (ratio
+# within 1 +- tolerance). From there the shard's results are used, rescaled
+# by the ratio of the capitals. A shard without such a step is re-run 
+# sequentially, so its results are exact.
+#
+# Fee accrual is nonlinear in liquidity, so shards only match the actual 
+# simulation when started from its capital. This is predicted in two rounds.
+# The first runs every shard from a fresh position with the initial capital,
+# starting warmup steps before its piece (a quarter of a piece by default). Where it
+# resets together with the previous shard, the ratio of their capitals 
+# chains the capital of the actual simulation through the shards. The second
+# round re-runs every shard whose ratio is known from the last observation of
+# the previous one, rescaled by that ratio, so that it holds the ranges and
+# close to the capital of the actual simulation. The two rounds cost at most
+# (2 + warmup/piece) times a sequential run divided by n_shards, plus the 
+# shards that are re-run sequentially. Stitching runs in the parent process.
+# Where shards seldom reset together the chain breaks and most shards are 
+# re-run: the results stay exact, but the run is slower than simulate_strategy.
+# This is the usual case for ResetStrategy (in tests on 3000 minutes of swaps 
+# only the first shard synchronized, and the sharded run took about twice as long
+# as simulate_strategy), so sharding is no faster unless shards line up.
+#
+# Rescaling is exact for token amounts and values. After rescaling by a ratio
+# within 1 +- tolerance, the fees of every swap differ from those at the 
+# actual capital by less than a relative tolerance. shard_report lists the
+# ratio of every shard, the round it comes from and whether it was re-run.
+# Strategies opt in by listing the columns that scale with capital in 
+# amount_columns. Strategies with other state that depends on the path
+# (like the forecast models of AutoRegressiveStrategy) do not list them.
+########################################################
+
+def simulate_strategy_sharded(price_data,swap_data,strategy_in,liquidity_in_0,liquidity_in_1,fee_tier,decimals_0,decimals_1,
+                              n_shards=None,max_workers=None,tolerance=1e-3,warmup=None):
+    
+    timeline         = compile_timeline(price_data,swap_data,fee_tier,decimals_0,decimals_1)
+    n_shards         = max(1,min(n_shards or os.cpu_count() or 1,len(timeline)//2))
+    bounds           = [len(timeline)*j//n_shards for j in range(n_shards+1)]
+    warmup           = bounds[1]//4 if warmup is None else warmup
+    if not hasattr(strategy_in,'amount_columns'):
+        raise ValueError('strategy_in does not list its amount_columns, only strategies whose state after a reset '+
+                         'depends on the past through the capital alone can be sharded')
+    amount_columns   = set(strategy_in.amount_columns)
+    state_columns    = [name for name,_ in strategy_in.simulation_columns if name not in amount_columns]
+    
+    # Shards after the first start warmup steps early, with their capital half in each token
+    initial_value    = liquidity_in_0 + liquidity_in_1/timeline.price[0]
+    starts           = [0] + [max(0,bounds[j]-warmup) for j in range(1,n_shards)]
+    
+    def shard_inputs(j,previous=None):
+        # A shard continued from an observation starts at the step of the observation
+        start,end    = (bounds[j]-1 if previous is not None else starts[j]),bounds[j+1]
+        price_shard  = price_data.iloc[start:end]
+        swap_shard   = swap_data.loc[timeline.time[start]:timeline.time[end-1]]
+        if j == 0:
+            return (price_shard,swap_shard,strategy_in,liquidity_in_0,liquidity_in_1,fee_tier,decimals_0,decimals_1)
+        return (price_shard,swap_shard,strategy_in,initial_value/2,initial_value/2*timeline.price[start],fee_tier,decimals_0,decimals_1,previous)
+    
+    def common_reset(j,i,actual,actual_row):
+        # Capital ratio to shard j at a step i where both reset with the same composition, None otherwise
+        shard        = shard_results[j][0]
+        if shard is None or not actual.columns['reset_point'][actual_row] or not shard.columns['reset_point'][i-starts[j]]:
+            return None
+        # The strategy's own state (ranges, reset prices, ...) must be the same
+        for name in state_columns:
+            actual_value,shard_value = actual.columns[name][actual_row],shard.columns[name][i-starts[j]]
+            if actual_value != shard_value and not (pd.isna(actual_value) and pd.isna(shard_value)):
+                return None
+        return shard_scale(actual,actual_row,shard,i-starts[j],timeline.price[i],tolerance)
+    
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        shard_results = run_shards(executor,[shard_inputs(j) for j in range(n_shards)],True)
+        
+        # Capital of the actual simulation relative to every shard, from the resets in common with the previous one
+        ratios        = [1.0] + [None]*(n_shards-1)
+        for j in range(1,n_shards):
+            if ratios[j-1] is None or shard_results[j-1][0] is None:
+                break
+            for i in range(starts[j],bounds[j]):
+                scale = common_reset(j,i,shard_results[j-1][0],i-starts[j-1])
+                if scale is not None:
+                    ratios[j] = ratios[j-1]*scale
+                    break
+        
+        # Second round from the rescaled last observation of the previous shard
+        rounds        = [1]*n_shards
+        rerun         = [j for j in range(1,n_shards) if ratios[j-1] is not None and (ratios[j] is None or abs(ratios[j] - 1) > tolerance)]
+        inputs        = [shard_inputs(j,scale_observation(shard_results[j-1][1],ratios[j-1])) for j in rerun]
+        for j,result in zip(rerun,run_shards(executor,inputs)):
+            shard_results[j] = result
+            starts[j]        = bounds[j]
+            rounds[j]        = 2
+    
+    # Stitch the shards in order
+    strategy_results = ShardedRecorder(strategy_in,len(timeline))
+    strategy_results.append_rows(shard_results[0][0],0,bounds[1],1.0,amount_columns)
+    previous         = shard_results[0][1]
+    
+    for j in range(1,n_shards):
+        start,end        = bounds[j],bounds[j+1]
+        shard,final      = shard_results[j]
+        sync_step,scale  = None,None
+        
+        # Continue the actual simulation until it synchronizes with the shard
+        for i in range(start,end-1):
+            previous = next_observation(timeline,i,strategy_in,previous)
+            strategy_results.record(previous)
+            scale    = common_reset(j,i,strategy_results,strategy_results.length-1)
+            if scale is not None and abs(scale - 1) <= tolerance:
+                sync_step = i
+                break
+        
+        if sync_step is not None:
+            strategy_results.append_rows(shard,sync_step-starts[j]+1,end-starts[j],scale,amount_columns)
+            previous     = scale_observation(final,scale)
+        else:
+            previous = next_observation(timeline,end-1,strategy_in,previous)
+            strategy_results.record(previous)
+        strategy_results.shard_report.append({'start':start,'end':end,'sync_step':sync_step,'rounds':rounds[j],
+                                              'scale':scale if sync_step is not None else None,'rerun':sync_step is None})
+        
+    return strategy_results
+
+def run_shards(executor,inputs,first_from_start=False):
+    # A shard that fails from the predicted capital is re-run sequentially when stitching,
+    # errors of the first shard (from the initial capital) are raised
+    futures = [executor.submit(simulate_shard,*x) for x in inputs]
+    results = []
+    for j,future in enumerate(futures):
+        if j == 0 and first_from_start:
+            results.append(future.result())
+            continue
+        try:
+            results.append(future.result())
+        except ArithmeticError:
+            results.append((None,None))
+    return results
+
+def simulate_shard(price_data,swap_data,strategy_in,liquidity_in_0,liquidity_in_1,fee_tier,decimals_0,decimals_1,previous=None):
+    # Recorded results of a shard and its last observation, to continue from it.
+    # From previous, the observation at the first price, the shard starts at the second
+    timeline         = compile_timeline(price_data,swap_data,fee_tier,decimals_0,decimals_1)
+    strategy_results = SimulationRecorder(strategy_in,len(timeline))
+    if previous is None:
+        for strategy_observation in iterate_observations(timeline,strategy_in,liquidity_in_0,liquidity_in_1):
+            strategy_results.record(strategy_observation)
+        return strategy_results,strategy_observation
+    for i in range(1,len(timeline)):
+        previous = next_observation(timeline,i,strategy_in,previous)
+        strategy_results.record(previous)
+    return strategy_results,previous
+
+def shard_scale(actual,actual_row,shard,shard_row,price,tolerance):
+    
+    # Capital ratio between the actual simulation and the shard after a common reset, 
+    # None if their token compositions differ by more than tolerance
+    actual_0,actual_1 = actual.columns['token_0_total'][actual_row],actual.columns['token_1_total'][actual_row]
+    shard_0,shard_1   = shard.columns['token_0_total'][shard_row], shard.columns['token_1_total'][shard_row]
+    actual_value      = actual_0 + actual_1/price
+    shard_value       = shard_0  + shard_1/price
+    if actual_value <= 0.0 or shard_value <= 0.0:
+        return None
+    if abs(actual_1/price/actual_value - shard_1/price/shard_value) > tolerance:
+        return None
+    return actual_value/shard_value
+
+def scale_observation(strategy_observation,scale):
+    
+    # Same observation with scale times the capital
+    scaled_observation = StrategyObservation.__new__(StrategyObservation)
+    scaled_observation.__dict__.update(strategy_observation.__dict__)
+    for name in ['liquidity_in_0','liquidity_in_1','token_0_left_over','token_1_left_over',
+                 'token_0_fees_uncollected','token_1_fees_uncollected','token_0_fees','token_1_fees']:
+        setattr(scaled_observation,name,getattr(strategy_observation,name)*scale)
+        
+    scaled_observation.liquidity_ranges = []
+    for liquidity_range in strategy_observation.liquidity_ranges:
+        scaled_range                       = LiquidityRange.from_mapping(liquidity_range).advance(liquidity_range.time)
+        scaled_range['position_liquidity'] = int(liquidity_range['position_liquidity']*scale)
+        scaled_range.token_0               = liquidity_range.token_0*scale
+        scaled_range.token_1               = liquidity_range.token_1*scale
+        scaled_observation.liquidity_ranges.append(scaled_range)
+    scaled_observation.strategy_info    = StrategyInfo.share(strategy_observation.strategy_info)
+    return scaled_observation
+
+def initial_observation(timeline,strategy_in,liquidity_in_0,liquidity_in_1,i=0):
+    return StrategyObservation(timeline.time[i],
+                               timeline.price[i],
+                               strategy_in,
+                               liquidity_in_0,liquidity_in_1,
+                               timeline.fee_tier,timeline.decimals_0,timeline.decimals_1,
+                               price_tick         = int(timeline.price_tick[i]),
+                               price_tick_current = int(timeline.price_tick_current[i]))
+
+def next_observation(timeline,i,strategy_in,previous):
+    return StrategyObservation(timeline.time[i],
+                               timeline.price[i],
+                               strategy_in,
+                               previous.liquidity_in_0,
+                               previous.liquidity_in_1,
+                               previous.fee_tier,
+                               previous.decimals_0,
+                               previous.decimals_1,
+                               previous.token_0_left_over,
+                               previous.token_1_left_over,
+                               previous.token_0_fees_uncollected,
+                               previous.token_1_fees_uncollected,
+                               previous.liquidity_ranges,
+                               previous.strategy_info,
+                               timeline.swaps_between(i),
+                               price_tick         = int(timeline.price_tick[i]),
+                               price_tick_current = int(timeline.price_tick_current[i]))
+
+########################################################
+# Approximate simulation from swap buckets
+# The swaps of every bucket (frequency as in aggregate_swap_data), token in and
+# optionally tick bucket are replaced by one swap with their summed traded_in
+# at their median tick, placed at the time of the last swap of the bucket. Its
+# virtual liquidity is the traded_in weighted harmonic mean of the swaps'
+# (the median for buckets without volume or liquidity), which gives the fees of
+# positions small relative to the pool. Every step then accrues fees over a few buckets
+# instead of all its swaps.
+# The report bounds the fees of the approximate run: a bucket whose ticks all
+# lie in a range earns at least with its largest virtual liquidity, one that
+# touches the range at most with its smallest. The bound holds for the ranges
+# the approximate run held; runs that rebalance at different times than the
+# exact run can differ by more, which check_approximation measures on samples.
+########################################################
+
+SWAP_BUCKETS = {'M': '1min','H': '1h','D': '1D'}
+
+def aggregate_swap_buckets(swap_data,frequency='H',tick_resolution=None):
+    
+    # With tick_resolution, swaps are also bucketed by tick_resolution ticks
+    buckets                      = swap_data[['tick_swap','token_in','virtual_liquidity','traded_in']].copy()
+    buckets['time_last']         = swap_data.index
+    buckets['tick_bucket']       = 0.0 if tick_resolution is None else np.floor(buckets['tick_swap']/tick_resolution)
+    
+    # Swaps without liquidity earn positions all their fees, they are kept apart
+    buckets['no_liquidity']      = buckets['virtual_liquidity'] < 1e-9
+    with np.errstate(divide='ignore',invalid='ignore'):
+        buckets['inverse_liquidity'] = np.where(buckets['no_liquidity'],0.0,buckets['traded_in']/buckets['virtual_liquidity'])
+    
+    buckets = buckets.groupby([pd.Grouper(freq=SWAP_BUCKETS[frequency]),'token_in','tick_bucket','no_liquidity']).agg(
+                  tick_swap         = ('tick_swap','median'),
+                  tick_min          = ('tick_swap','min'),
+                  tick_max          = ('tick_swap','max'),
+                  virtual_liquidity = ('virtual_liquidity','median'),
+                  liquidity_min     = ('virtual_liquidity','min'),
+                  liquidity_max     = ('virtual_liquidity','max'),
+                  inverse_liquidity = ('inverse_liquidity','sum'),
+                  traded_in         = ('traded_in','sum'),
+                  n_swaps           = ('traded_in','size'),
+                  time_last         = ('time_last','max'))
+    
+    buckets              = buckets[buckets['n_swaps'] > 0].reset_index(level='token_in')
+    buckets['tick_swap'] = np.floor(buckets['tick_swap'])
+    
+    # Volume weighted harmonic mean of the liquidity, which gives the fees of positions small relative to the pool
+    with np.errstate(divide='ignore',invalid='ignore'):
+        buckets['virtual_liquidity'] = np.where(buckets['inverse_liquidity'] > 0.0,buckets['traded_in']/buckets['inverse_liquidity'],buckets['virtual_liquidity'])
+    return buckets.set_index('time_last').sort_index(kind='stable')
+
+def simulate_strategy_approximate(price_data,swap_data,strategy_in,liquidity_in_0,liquidity_in_1,fee_tier,decimals_0,decimals_1,
+                                  frequency='H',tick_resolution=None,record=False,buckets=None):
+    
+    # buckets can be computed once with aggregate_swap_buckets and shared by a parameter grid
+    if buckets is None:
+        buckets = aggregate_swap_buckets(swap_data,frequency,tick_resolution)
+    timeline    = compile_timeline(price_data,buckets,fee_tier,decimals_0,decimals_1)
+    tick_min    = buckets['tick_min'].to_numpy(dtype=float)
+    tick_max    = buckets['tick_max'].to_numpy(dtype=float)
+    liquidity   = [buckets['liquidity_min'].to_numpy(dtype=float),buckets['liquidity_max'].to_numpy(dtype=float)]
+    
+    strategy_results = SimulationRecorder(strategy_in,len(timeline)) if record else []
+    fee_bounds       = np.zeros((2,2))
+    previous         = None
+    for i,strategy_observation in enumerate(iterate_observations(timeline,strategy_in,liquidity_in_0,liquidity_in_1)):
+        if i > 0:
+            window      = slice(timeline.swap_start[i-1],timeline.swap_end[i-1])
+            fee_bounds += bucket_fee_bounds(tick_min[window],tick_max[window],liquidity[0][window],liquidity[1][window],
+                                            timeline.swaps.token_0_in[window],timeline.swaps.traded_in[window],
+                                            previous.liquidity_ranges,fee_tier)
+        if record:
+            strategy_results.record(strategy_observation)
+        else:
+            strategy_results.append(strategy_observation)
+        previous = strategy_observation
+    
+    if record:
+        fees = [float(np.sum(strategy_results.columns['token_0_fees'][1:len(strategy_results)])),
+                float(np.sum(strategy_results.columns['token_1_fees'][1:len(strategy_results)]))]
+    else:
+        fees = [sum(x.token_0_fees for x in strategy_results[1:]),sum(x.token_1_fees for x in strategy_results[1:])]
+    
+    # Largest deviation from the bounds, valued at the last price
+    price       = previous.price
+    fee_error   = max(fees[0] - fee_bounds[0,0],fee_bounds[0,1] - fees[0],0.0) + max(fees[1] - fee_bounds[1,0],fee_bounds[1,1] - fees[1],0.0)/price
+    fee_value   = fees[0] + fees[1]/price
+    report      = {'frequency'                  : frequency,
+                   'n_swaps'                    : int(buckets['n_swaps'].sum()),
+                   'n_buckets'                  : len(buckets),
+                   'token_0_fees'               : fees[0],
+                   'token_1_fees'               : fees[1],
+                   'token_0_fees_lower'         : fee_bounds[0,0],
+                   'token_0_fees_upper'         : fee_bounds[0,1],
+                   'token_1_fees_lower'         : fee_bounds[1,0],
+                   'token_1_fees_upper'         : fee_bounds[1,1],
+                   'fee_error_bound_in_token_0' : fee_error,
+                   'relative_fee_error_bound'   : fee_error/fee_value if fee_value > 0 else 0.0}
+    return strategy_results,report
+
+def bucket_fee_bounds(tick_min,tick_max,liquidity_min,liquidity_max,token_0_in,traded_in,liquidity_ranges,fee_tier):
+    
+    # [[lower, upper] of token 0 fees, [lower, upper] of token 1 fees] earned by the ranges over the buckets
+    bounds = np.zeros((2,2))
+    if len(traded_in) == 0:
+        return bounds
+    for liquidity_range in liquidity_ranges:
+        lower_bin_tick     = liquidity_range['lower_bin_tick']
+        upper_bin_tick     = liquidity_range['upper_bin_tick']
+        position_liquidity = float(liquidity_range['position_liquidity'])
+        inside             = (tick_min >= lower_bin_tick) & (tick_max <= upper_bin_tick)
+        touching           = (tick_max >= lower_bin_tick) & (tick_min <= upper_bin_tick)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            fraction_lower = np.where(liquidity_max < 1e-9,1.0,position_liquidity/(position_liquidity + liquidity_max))
+            fraction_upper = np.where(liquidity_min < 1e-9,1.0,position_liquidity/(position_liquidity + liquidity_min))
+        fees_lower         = np.where(inside,  fee_tier*fraction_lower*traded_in,0.0)
+        fees_upper         = np.where(touching,fee_tier*fraction_upper*traded_in,0.0)
+        bounds[0]         += [np.sum(fees_lower[token_0_in]), np.sum(fees_upper[token_0_in])]
+        bounds[1]         += [np.sum(fees_lower[~token_0_in]),np.sum(fees_upper[~token_0_in])]
+    return bounds
+
+def check_approximation(price_data,swap_data,strategy_in,liquidity_in_0,liquidity_in_1,fee_tier,decimals_0,decimals_1,
+                        frequency='H',tick_resolution=None,n_windows=3,window_steps=500,seed=0,buckets=None):
+    
+    # Exact and approximate runs over randomly chosen windows of price_data, from the same start
+    if buckets is None:
+        buckets = aggregate_swap_buckets(swap_data,frequency,tick_resolution)
+    window_steps = min(window_steps,len(price_data))
+    starts       = np.sort(np.random.default_rng(seed).choice(len(price_data) - window_steps + 1,
+                                                              min(n_windows,len(price_data) - window_steps + 1),replace=False))
+    rows         = []
+    for start in starts:
+        prices        = price_data.iloc[start:start+window_steps]
+        exact         = simulate_strategy(prices,swap_data,copy.deepcopy(strategy_in),liquidity_in_0,liquidity_in_1,
+                                          fee_tier,decimals_0,decimals_1,record=True)
+        approximate,_ = simulate_strategy_approximate(prices,swap_data,copy.deepcopy(strategy_in),liquidity_in_0,liquidity_in_1,
+                                                      fee_tier,decimals_0,decimals_1,record=True,buckets=buckets)
+        price         = prices.iloc[-1]
+        results       = []
+        for recorder in [exact,approximate]:
+            columns   = recorder.columns
+            results.append((columns['value_position_in_token_0'][len(recorder)-1],
+                            float(np.sum(columns['token_0_fees'][1:len(recorder)]) + np.sum(columns['token_1_fees'][1:len(recorder)])/price),
+                            int(np.sum(columns['reset_point'][:len(recorder)])) if 'reset_point' in columns else 0))
+        rows.append({'start'                 : prices.index[0],
+                     'end'                   : prices.index[-1],
+                     'exact_value'           : results[0][0],
+                     'approximate_value'     : results[1][0],
+                     'relative_value_error'  : results[1][0]/results[0][0] - 1,
+                     'exact_fees'            : results[0][1],
+                     'approximate_fees'      : results[1][1],
+                     'relative_fee_error'    : results[1][1]/results[0][1] - 1 if results[0][1] > 0 else 0.0,
+                     'exact_resets'          : results[0][2],
+                     'approximate_resets'    : results[1][2]})
+    return pd.DataFrame(rows)
+
+########################################################
+# Range minimum / maximum queries in O(1) after an O(n log n) build
+########################################################
+
+class SparseTable:
+    def __init__(self,values):
+        values          = np.asarray(values)
+        self.min_levels = [values]
+        self.max_levels = [values]
+        width           = 1
+        while 2*width <= len(values):
+            self.min_levels.append(np.minimum(self.min_levels[-1][:-width],self.min_levels[-1][width:]))
+            self.max_levels.append(np.maximum(self.max_levels[-1][:-width],self.max_levels[-1][width:]))
+            width *= 2
+    
+    # Queries cover positions start, ..., end-1
+    def min(self,start,end):
+        level = int(end - start).bit_length() - 1
+        return min(self.min_levels[level][start],self.min_levels[level][end - (1 << level)])
+    
+    def max(self,start,end):
+        level = int(end - start).bit_length() - 1
+        return max(self.max_levels[level][start],self.max_levels[level][end - (1 << level)])
+
+########################################################
+# Event driven simulation
+# Strategies can implement quiet_bounds(current_strat_obs), returning 
+# (price_lower, price_upper, tick_intervals) such that check_strategy can not 
+# act while the price stays in [price_lower, price_upper] and price_tick_current
+# stays out of every open interval (tick_a, tick_b) in tick_intervals.
+# Steps that satisfy it are skipped: their fees are accrued in bulk and their
+# observations are rebuilt lazily when the results are read.
+# Strategies without quiet_bounds are simulated step by step.
+########################################################
+
+def simulate_strategy_event_driven(price_data,swap_data,strategy_in,
+                                   liquidity_in_0,liquidity_in_1,fee_tier,decimals_0,decimals_1,timeline=None,fee_index=None):
+    
+    if timeline is None:
+        timeline = compile_timeline(price_data,swap_data,fee_tier,decimals_0,decimals_1,fee_index)
+    else:
+        check_timeline(timeline,price_data,swap_data,fee_tier,decimals_0,decimals_1)
+    
+    strategy_results = EventDrivenResults(timeline)
+    if len(timeline) == 0:
+        return strategy_results
+    
+    price_table          = SparseTable(timeline.price)
+    tick_table           = SparseTable(timeline.price_tick_current)
+    strategy_observation = initial_observation(timeline,strategy_in,liquidity_in_0,liquidity_in_1)
+    strategy_results.add_observation(0,strategy_observation)
+    
+    i = 1
+    while i < len(timeline):
+        
+        if hasattr(strategy_in,'quiet_bounds'):
+            end = quiet_span_end(price_table,tick_table,i,len(timeline),strategy_in.quiet_bounds(strategy_observation))
+        else:
+            end = i
+            
+        # Skip steps i, ..., end-1 and continue from the last one
+        if end > i:
+            quiet_span           = QuietSpan(timeline,i,end,strategy_observation)
+            strategy_results.add_span(quiet_span)
+            strategy_observation = quiet_span.observation(end-1)
+            i                    = end
+            
+        if i < len(timeline):
+            strategy_observation = next_observation(timeline,i,strategy_in,strategy_observation)
+            strategy_results.add_observation(i,strategy_observation)
+            i += 1
+            
+    return strategy_results
+
+def quiet_span_end(price_table,tick_table,start,n_steps,bounds):
+    
+    if bounds is None:
+        return start
+    
+    price_lower,price_upper,tick_intervals = bounds
+    
+    def is_quiet(end):
+        if price_table.min(start,end) < price_lower or price_table.max(start,end) > price_upper:
+            return False
+        for tick_a,tick_b in tick_intervals:
+            if tick_table.max(start,end) > tick_a and tick_table.min(start,end) < tick_b:
+                return False
+        return True
+    
+    # Gallop to bracket the first step that is not quiet, then bisect
+    if not is_quiet(start+1):
+        return start
+    quiet_end = start + 1
+    while quiet_end < n_steps:
+        candidate = min(n_steps,start + 2*(quiet_end - start))
+        if not is_quiet(candidate):
+            break
+        quiet_end = candidate
+    else:
+        return n_steps
+    
+    # is_quiet(quiet_end) is True, is_quiet(candidate) is False
+    while candidate - quiet_end > 1:
+        middle = (quiet_end + candidate)//2
+        if is_quiet(middle):
+            quiet_end = middle
+        else:
+            candidate = middle
+    return quiet_end
+
+class QuietSpan:
+    def __init__(self,timeline,start,end,anchor):
+        
+        # Steps start, ..., end-1 after the observation anchor, where nothing but fee accrual happens
+        self.timeline                 = timeline
+        self.start                    = start
+        self.end                      = end
+        self.anchor                   = anchor
+        
+        lower_bin_tick                = [x['lower_bin_tick']     for x in anchor.liquidity_ranges]
+        upper_bin_tick                = [x['upper_bin_tick']     for x in anchor.liquidity_ranges]
+        position_liquidity            = [x['position_liquidity'] for x in anchor.liquidity_ranges]
+        
+        # Same per step sums and running totals as StrategyObservation.accrue_fees
+        self.token_0_fees             = np.zeros(end-start)
+        self.token_1_fees             = np.zeros(end-start)
+        self.token_0_fees_uncollected = np.zeros(end-start)
+        self.token_1_fees_uncollected = np.zeros(end-start)
+        token_0_fees_uncollected      = anchor.token_0_fees_uncollected
+        token_1_fees_uncollected      = anchor.token_1_fees_uncollected
+        
+        if timeline.fee_index is not None:
+            self.token_0_fees,self.token_1_fees = timeline.fee_index.window_fees(timeline.swap_start[start-1:end-1],timeline.swap_end[start-1:end-1],
+                                                                                 lower_bin_tick,upper_bin_tick,position_liquidity)
+        else:
+            swap_offset               = timeline.swap_start[start-1]
+            swaps                     = timeline.swaps.window(swap_offset,timeline.swap_end[end-2])
+            fee_terms_0,fee_terms_1,swap_index = fee_terms_columnar(swaps.tick_swap,swaps.token_0_in,swaps.virtual_liquidity,swaps.traded_in,
+                                                                    lower_bin_tick,upper_bin_tick,position_liquidity,anchor.fee_tier)
+            
+            # Terms of the swaps of each step
+            terms_start = np.searchsorted(swap_index,timeline.swap_start[start-1:end-1] - swap_offset,side='left')
+            terms_end   = np.searchsorted(swap_index,timeline.swap_end[start-1:end-1]   - swap_offset,side='left')
+            for k in range(end-start):
+                window_start = terms_start[k]
+                window_end   = terms_end[k]
+                if window_end > window_start:
+                    self.token_0_fees[k] = sum_fee_terms(fee_terms_0[window_start:window_end])
+                    self.token_1_fees[k] = sum_fee_terms(fee_terms_1[window_start:window_end])
+                    
+        for k in range(end-start):
+            token_0_fees_uncollected += self.token_0_fees[k]
+            token_1_fees_uncollected += self.token_1_fees[k]
+            self.token_0_fees_uncollected[k] = token_0_fees_uncollected
+            self.token_1_fees_uncollected[k] = token_1_fees_uncollected
+            
+    def observation(self,i):
+        
+        # Rebuild the observation of step i without running the strategy
+        k                                          = i - self.start
+        strategy_observation                       = StrategyObservation.__new__(StrategyObservation)
+        strategy_observation.__dict__.update(self.anchor.__dict__)
+        strategy_observation.time                  = self.timeline.time[i]
+        strategy_observation.price                 = self.timeline.price[i]
+        strategy_observation.price_tick            = int(self.timeline.price_tick[i])
+        strategy_observation.price_tick_current    = int(self.timeline.price_tick_current[i])
+        strategy_observation.reset_point           = False
+        strategy_observation.compound_point        = False
+        strategy_observation.reset_reason          = ''
+        strategy_observation.token_0_fees          = float(self.token_0_fees[k])
+        strategy_observation.token_1_fees          = float(self.token_1_fees[k])
+        strategy_observation.token_0_fees_uncollected = float(self.token_0_fees_uncollected[k])
+        strategy_observation.token_1_fees_uncollected = float(self.token_1_fees_uncollected[k])
+        strategy_observation.strategy_info         = StrategyInfo.share(self.anchor.strategy_info)
+        strategy_observation.liquidity_ranges      = [x.advance(strategy_observation.time) for x in self.anchor.liquidity_ranges]
+        
+        if strategy_observation.simulate_strat:
+            for liquidity_range in strategy_observation.liquidity_ranges:
+                liquidity_range.token_0, liquidity_range.token_1 = UNI_v3_funcs.get_amounts(strategy_observation.price_tick_current,
+                                                                                             liquidity_range['lower_bin_tick'],
+                                                                                             liquidity_range['upper_bin_tick'],
+                                                                                             liquidity_range['position_liquidity'],
+                                                                                             strategy_observation.decimals_0,
+                                                                                             strategy_observation.decimals_1)
+        return strategy_observation
+
+class EventDrivenResults(Sequence):
+    # Behaves like the list returned by simulate_strategy, skipped steps are built on access
+    def __init__(self,timeline):
+        self.timeline     = timeline
+        self.observations = dict()
+        self.spans        = []
+        self.span_starts  = []
+        
+    def add_observation(self,i,strategy_observation):
+        self.observations[i] = strategy_observation
+        
+    def add_span(self,quiet_span):
+        self.spans.append(quiet_span)
+        self.span_starts.append(quiet_span.start)
+        
+    def __len__(self):
+        return len(self.timeline)
+    
+    def __getitem__(self,i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        if i in self.observations:
+            return self.observations[i]
+        return self.spans[bisect.bisect_right(self.span_starts,i) - 1].observation(i)
+    
+    @property
+    def steps_simulated(self):
+        return len(self.observations)
+
+########################################################
+# Columnar simulation results
+# Strategies declare the columns they record in simulation_columns, a list of 
+# (name, dtype) pairs, and write one step into them in record_components. 
+# time is always recorded by the recorder itself.
+########################################################
+
+class SimulationRecorder:
+    def __init__(self,strategy_in,n_rows):
+        self.strategy_in     = strategy_in
+        self.length          = 0
+        self.time_zone       = None
+        self.token_0_initial = None
+        self.token_1_initial = None
+        self.time            = np.empty(n_rows,dtype=np.int64)
+        self.columns         = {name: np.empty(n_rows,dtype=dtype) for name,dtype in strategy_in.simulation_columns}
+        
+    def __len__(self):
+        return self.length
+        
+    def record(self,strategy_observation):
+        i = self.length
+        if i == len(self.time):
+            self.grow(max(2*i,1))
+        if self.token_0_initial is None:
+            self.time_zone                             = strategy_observation.time.tz
+            self.token_0_initial,self.token_1_initial  = initial_token_amounts(strategy_observation)
+        self.time[i] = strategy_observation.time.value
+        self.strategy_in.record_components(strategy_observation,self.columns,i)
+        self.length += 1
+        
+    def grow(self,n_rows):
+        self.time    = np.concatenate([self.time,np.empty(n_rows-len(self.time),dtype=self.time.dtype)])
+        self.columns = {name: np.concatenate([x,np.empty(n_rows-len(x),dtype=x.dtype)]) for name,x in self.columns.items()}
+        
+    def to_frame(self):
+        time = pd.to_datetime(self.time[:self.length],unit='ns')
+        if self.time_zone is not None:
+            time = time.tz_localize('UTC').tz_convert(self.time_zone)
+        data = {'time': time}
+        data.update({name: x[:self.length] for name,x in self.columns.items()})
+        return pd.DataFrame(data)
+
+########################################################
+# Recorder with a fixed number of rows for streaming simulations:
+# when it is full the rows are handed to on_chunk as a DataFrame and it starts over
+########################################################
+
+class ChunkedRecorder(SimulationRecorder):
+    def __init__(self,strategy_in,chunk_size,on_chunk):
+        super().__init__(strategy_in,chunk_size)
+        self.on_chunk = on_chunk
+        
+    def record(self,strategy_observation):
+        if self.length == len(self.time):
+            self.flush()
+        super().record(strategy_observation)
+        
+    def flush(self):
+        if self.length > 0:
+            self.on_chunk(self.to_frame())
+            self.length = 0
+
+########################################################
+# Recorder of a branch of a SimulationSnapshot
+########################################################
+
+class BranchRecorder(SimulationRecorder):
+    # Rows of the snapshot's recorder followed by those of the branch
+    def __init__(self,strategy_in,prefix,n_rows):
+        super().__init__(strategy_in,n_rows-len(prefix))
+        self.prefix          = prefix
+        self.n_prefix        = len(prefix)
+        self.time_zone       = prefix.time_zone
+        self.token_0_initial = prefix.token_0_initial
+        self.token_1_initial = prefix.token_1_initial
+        
+    def __len__(self):
+        return self.n_prefix + self.length
+    
+    def to_frame(self):
+        return pd.concat([self.prefix.to_frame(),super().to_frame()],ignore_index=True)
+
+########################################################
+# Recorder assembled from the shards of simulate_strategy_sharded
+########################################################
+
+class ShardedRecorder(SimulationRecorder):
+    def __init__(self,strategy_in,n_rows):
+        super().__init__(strategy_in,n_rows)
+        self.shard_report = []
+        
+    def append_rows(self,recorder,start,end,scale,amount_columns):
+        # Rows start, ..., end-1 of another recorder, amounts multiplied by scale
+        n_rows = end - start
+        i      = self.length
+        if i + n_rows > len(self.time):
+            self.grow(i + n_rows)
+        if self.token_0_initial is None:
+            self.time_zone                             = recorder.time_zone
+            self.token_0_initial,self.token_1_initial  = recorder.token_0_initial,recorder.token_1_initial
+        self.time[i:i+n_rows] = recorder.time[start:end]
+        for name,x in self.columns.items():
+            x[i:i+n_rows]     = recorder.columns[name][start:end]*scale if name in amount_columns else recorder.columns[name][start:end]
+        self.length += n_rows
+
+########################################################
+# Columns every strategy records about the assets of the position, 
+# in the same order as in dict_components
+########################################################
+
+POSITION_COLUMNS = [('token_0_fees',float),('token_1_fees',float),('token_0_fees_uncollected',float),('token_1_fees_uncollected',float),
+                    ('token_0_left_over',float),('token_1_left_over',float),('token_0_allocated',float),('token_1_allocated',float),
+                    ('token_0_total',float),('token_1_total',float),
+                    ('value_position_in_token_0',float),('value_allocated_in_token_0',float),('value_left_over_in_token_0',float)]
+
+def record_position_components(strategy_observation,columns,i):
+    
+    price                                     = strategy_observation.price
+    
+    # Fee Varaibles
+    columns['token_0_fees'][i]                = strategy_observation.token_0_fees 
+    columns['token_1_fees'][i]                = strategy_observation.token_1_fees 
+    columns['token_0_fees_uncollected'][i]    = strategy_observation.token_0_fees_uncollected
+    columns['token_1_fees_uncollected'][i]    = strategy_observation.token_1_fees_uncollected
+    
+    # Asset Variables
+    columns['token_0_left_over'][i]           = strategy_observation.token_0_left_over
+    columns['token_1_left_over'][i]           = strategy_observation.token_1_left_over
+    
+    total_token_0 = 0.0
+    total_token_1 = 0.0
+    for liquidity_range in strategy_observation.liquidity_ranges:
+        total_token_0 += liquidity_range['token_0']
+        total_token_1 += liquidity_range['token_1']
+    
+    token_0_total = total_token_0 + strategy_observation.token_0_left_over + strategy_observation.token_0_fees_uncollected
+    token_1_total = total_token_1 + strategy_observation.token_1_left_over + strategy_observation.token_1_fees_uncollected
+        
+    columns['token_0_allocated'][i]           = total_token_0
+    columns['token_1_allocated'][i]           = total_token_1
+    columns['token_0_total'][i]               = token_0_total
+    columns['token_1_total'][i]               = token_1_total
+
+    # Value Variables          
+    columns['value_position_in_token_0'][i]   = token_0_total + token_1_total / price
+    columns['value_allocated_in_token_0'][i]  = total_token_0 + total_token_1 / price
+    columns['value_left_over_in_token_0'][i]  = strategy_observation.token_0_left_over + strategy_observation.token_1_left_over / price
+
+def initial_token_amounts(strategy_observation):
+    # Tokens placed at the start of a simulation, used to value the hold strategy
+    token_0_initial = sum(x['token_0'] for x in strategy_observation.liquidity_ranges) + strategy_observation.token_0_left_over
+    token_1_initial = sum(x['token_1'] for x in strategy_observation.liquidity_ranges) + strategy_observation.token_1_left_over
+    return token_0_initial,token_1_initial
+
 ########################################################
 # Extract Strategy Data
 ########################################################
@@ -201,18 +1644,27 @@ def generate_simulation_series(simulations,strategy_in,token_0_usd_data = None):
     
     # token_0_usd_data has in quotePrice 
     # token_0 / usd value for each index
+    # simulations is either a list of StrategyObservation or a SimulationRecorder
     
-    data_strategy                    = pd.DataFrame([strategy_in.dict_components(i) for i in simulations])
+    if isinstance(simulations,SimulationRecorder):
+        data_strategy                = simulations.to_frame()
+        token_0_initial              = simulations.token_0_initial
+        token_1_initial              = simulations.token_1_initial
+    else:
+        data_strategy                = pd.DataFrame([strategy_in.dict_components(i) for i in simulations])
+        token_0_initial,token_1_initial = initial_token_amounts(simulations[0])
+        
     data_strategy                    = data_strategy.set_index('time',drop=False)
     data_strategy                    = data_strategy.sort_index()
     
-    token_0_initial                  = simulations[0].liquidity_ranges[0]['token_0'] + simulations[0].liquidity_ranges[1]['token_0'] + simulations[0].token_0_left_over
-    token_1_initial                  = simulations[0].liquidity_ranges[0]['token_1'] + simulations[0].liquidity_ranges[1]['token_1'] + simulations[0].token_1_left_over
+    # Strategies with a base and a limit position report their values separately
+    base_limit                       = 'base_position_value_in_token_0' in data_strategy.columns and 'limit_position_value_in_token_0' in data_strategy.columns
     
     if token_0_usd_data is None:
         data_strategy['value_position_usd']       = data_strategy['value_position_in_token_0']
-        data_strategy['base_position_value_usd']  = data_strategy['base_position_value_in_token_0']
-        data_strategy['limit_position_value_usd'] = data_strategy['limit_position_value_in_token_0']
+        if base_limit:
+            data_strategy['base_position_value_usd']  = data_strategy['base_position_value_in_token_0']
+            data_strategy['limit_position_value_usd'] = data_strategy['limit_position_value_in_token_0']
         data_strategy['cum_fees_usd']             = data_strategy['token_0_fees'].cumsum() + (data_strategy['token_1_fees'] / data_strategy['price']).cumsum()
         data_strategy['token_0_hold_usd']         = token_0_initial
         data_strategy['token_1_hold_usd']         = token_1_initial / data_strategy['price']
@@ -230,8 +1682,9 @@ def generate_simulation_series(simulations,strategy_in,token_0_usd_data = None):
         
         # Generate usd position values
         data_return['value_position_usd']       = data_return['value_position_in_token_0']*data_return['price_0_usd']
-        data_return['base_position_value_usd']  = data_return['base_position_value_in_token_0']*data_return['price_0_usd']
-        data_return['limit_position_value_usd'] = data_return['limit_position_value_in_token_0']*data_return['price_0_usd']
+        if base_limit:
+            data_return['base_position_value_usd']  = data_return['base_position_value_in_token_0']*data_return['price_0_usd']
+            data_return['limit_position_value_usd'] = data_return['limit_position_value_in_token_0']*data_return['price_0_usd']
         data_return['cum_fees_0']               = data_return['token_0_fees'].cumsum() + (data_return['token_1_fees'] / data_return['price']).cumsum()
         data_return['cum_fees_usd']             = data_return['cum_fees_0']*data_return['price_0_usd']
         data_return['token_0_hold_usd']         = token_0_initial * data_return['price_0_usd']
@@ -240,6 +1693,44 @@ def generate_simulation_series(simulations,strategy_in,token_0_usd_data = None):
         
     return data_return
 
+########################################################
+# Extract the ranges of each observation, one row per range and time
+# Works with any number of ranges, which can change from one observation to the next
+########################################################
+
+def range_components(strategy_observation):
+    price = strategy_observation.price
+    return [{'time'               : strategy_observation.time,
+             'range'              : i,
+             'lower_bin_price'    : liquidity_range['lower_bin_price'],
+             'upper_bin_price'    : liquidity_range['upper_bin_price'],
+             'lower_bin_tick'     : liquidity_range['lower_bin_tick'],
+             'upper_bin_tick'     : liquidity_range['upper_bin_tick'],
+             'position_liquidity' : float(liquidity_range['position_liquidity']),
+             'token_0'            : liquidity_range['token_0'],
+             'token_1'            : liquidity_range['token_1'],
+             'value_in_token_0'   : liquidity_range['token_0'] + liquidity_range['token_1'] / price}
+            for i,liquidity_range in enumerate(strategy_observation.liquidity_ranges)]
+
+def generate_range_series(simulations,token_0_usd_data = None):
+    
+    # simulations is a list of StrategyObservation (or the results of simulate_strategy_event_driven)
+    data_ranges = pd.DataFrame([x for strategy_observation in simulations for x in range_components(strategy_observation)])
+    
+    if token_0_usd_data is None:
+        data_ranges['value_usd'] = data_ranges['value_in_token_0']
+    else:
+        token_0_usd_data                = token_0_usd_data.copy()
+        token_0_usd_data['price_0_usd'] = 1/token_0_usd_data['quotePrice']
+        token_0_usd_data['time_pd']     = token_0_usd_data.index
+        token_0_usd_data                = token_0_usd_data.set_index('time_pd').sort_index()
+        
+        data_ranges['time_pd']          = pd.to_datetime(data_ranges['time'],utc=True)
+        data_ranges                     = pd.merge_asof(data_ranges.sort_values('time_pd'),token_0_usd_data['price_0_usd'],on='time_pd',direction='backward',allow_exact_matches = True)
+        data_ranges['value_usd']        = data_ranges['value_in_token_0']*data_ranges['price_0_usd']
+        
+    return data_ranges.sort_values(['time','range']).reset_index(drop=True)
+
 
 ########################################################
 # Calculates % returns over a minutes frequency
@@ -272,14 +1763,7 @@ def aggregate_price_data(data,frequency):
 
 def aggregate_swap_data(data, frequency):
     
-    if   frequency == 'M':
-            resample_option      = '1 min'
-    elif frequency == 'H':
-            resample_option      = '1H'
-    elif frequency == 'D':
-            resample_option      = '1D'
-            
-    swap_data_tmp = data[['amount0_adj', 'amount1_adj', 'virtual_liquidity_adj']].resample(resample_option).agg(
+    swap_data_tmp = data[['amount0_adj', 'amount1_adj', 'virtual_liquidity_adj']].resample(SWAP_BUCKETS[frequency]).agg(
         {'amount0_adj': np.sum, 'amount1_adj': np.sum, 'virtual_liquidity_adj': np.median})
     
     return swap_data_tmp.ffill()
@@ -311,15 +1795,21 @@ def analyze_strategy(data_usd,frequency = 'M'):
                         'max_drawdown'         : ( data_usd['value_position_usd'].max() - data_usd['value_position_usd'].min() ) / data_usd['value_position_usd'].max(),
                         'volatility'           : ((data_usd['value_position_usd'].pct_change().var())**(0.5)) * ((annualization_factor)**(0.5)),
                         'sharpe_ratio'         : float(net_apr / (((data_usd['value_position_usd'].pct_change().var())**(0.5)) * ((annualization_factor)**(0.5)))),
-                        'impermanent_loss'     : ((strategy_last_obs['value_position_usd'] - strategy_last_obs['value_hold_usd']) / strategy_last_obs['value_hold_usd'])[0],
+                        'impermanent_loss'     : ((strategy_last_obs['value_position_usd'] - strategy_last_obs['value_hold_usd']) / strategy_last_obs['value_hold_usd'])[0]
+                    }
+    
+    # Base / limit statistics, for strategies that report them
+    if 'base_position_value_in_token_0' in data_usd.columns:
+        summary_strat.update({
                         'mean_base_position'   : (data_usd['base_position_value_in_token_0']/ \
                                                   (data_usd['base_position_value_in_token_0']+data_usd['limit_position_value_in_token_0']+data_usd['value_left_over_in_token_0'])).mean(),        
                         'median_base_position' : (data_usd['base_position_value_in_token_0']/ \
                                                   (data_usd['base_position_value_in_token_0']+data_usd['limit_position_value_in_token_0']+data_usd['value_left_over_in_token_0'])).median(),
                         'mean_base_width'      : ((data_usd['base_range_upper']-data_usd['base_range_lower'])/data_usd['price_at_reset']).mean(),
-                        'median_base_width'    : ((data_usd['base_range_upper']-data_usd['base_range_lower'])/data_usd['price_at_reset']).median(),        
-                        'final_value'          : data_usd['value_position_usd'].iloc[-1]
-                    }
+                        'median_base_width'    : ((data_usd['base_range_upper']-data_usd['base_range_lower'])/data_usd['price_at_reset']).median()
+                    })
+    
+    summary_strat['final_value'] = data_usd['value_position_usd'].iloc[-1]
     
     return summary_strat
 
@@ -531,30 +2021,44 @@ def plot_position_return_decomposition(data_strategy):
     return fig_income
 
 
-def plot_position_composition(data_strategy):
+def plot_position_composition(data_strategy,range_data=None):
     import plotly.graph_objects as go
     CHART_SIZE = 300
     fig_position_composition = go.Figure()
-    fig_position_composition.add_trace(go.Scatter(
-        x=data_strategy['time'], y=data_strategy['base_position_value_usd'],
-        mode='lines',
-        name='Base Position',
-        line=dict(width=0.5, color='#ff0000'),
-        stackgroup='one', # define stack group
-    #     groupnorm='percent'
-    ))
-    fig_position_composition.add_trace(go.Scatter(
-        x=data_strategy['time'], y=data_strategy['limit_position_value_usd'],
-        mode='lines',
-        name='Limit Position',
-        line=dict(width=0.5, color='#6f6f6f'),
-        stackgroup='one'
-    ))
+    
+    # With the output of generate_range_series, stack the value of every range
+    if range_data is not None:
+        for range_id,data_range in range_data.groupby('range'):
+            fig_position_composition.add_trace(go.Scatter(
+                x=data_range['time'], y=data_range['value_usd'],
+                mode='lines',
+                name='Range '+str(range_id),
+                line=dict(width=0.5),
+                stackgroup='one'
+            ))
+        title = 'Range Values'
+    else:
+        fig_position_composition.add_trace(go.Scatter(
+            x=data_strategy['time'], y=data_strategy['base_position_value_usd'],
+            mode='lines',
+            name='Base Position',
+            line=dict(width=0.5, color='#ff0000'),
+            stackgroup='one', # define stack group
+        #     groupnorm='percent'
+        ))
+        fig_position_composition.add_trace(go.Scatter(
+            x=data_strategy['time'], y=data_strategy['limit_position_value_usd'],
+            mode='lines',
+            name='Limit Position',
+            line=dict(width=0.5, color='#6f6f6f'),
+            stackgroup='one'
+        ))
+        title = 'Base / Limit Values'
 
     fig_position_composition.update_layout(
         margin=dict(l=20, r=20, t=40, b=20),
         height= CHART_SIZE,
-        title = 'Base / Limit Values',
+        title = title,
         xaxis_title="Date",
         yaxis_title="USD Value",
         legend_title='Value'
@@ -562,4 +2066,48 @@ def plot_position_composition(data_strategy):
 
     fig_position_composition.show(renderer="png")
 
-    return fig_position_composition
\ No newline at end of file
+    return fig_position_composition
+
+########################################################
+# Liquidity placed at each price over time, for any number of ranges
+# range_data is the output of generate_range_series
+########################################################
+
+def plot_liquidity_distribution(range_data,y_axis_label,data_strategy=None,n_bins=100,flip_price_axis=False):
+    import plotly.graph_objects as go
+    CHART_SIZE = 300
+    
+    lower_price = range_data[['lower_bin_price','upper_bin_price']].min(axis=1).to_numpy()
+    upper_price = range_data[['lower_bin_price','upper_bin_price']].max(axis=1).to_numpy()
+    if flip_price_axis:
+        lower_price,upper_price = 1/upper_price,1/lower_price
+    
+    # Liquidity of the ranges covering each price bin, at each time
+    bins        = np.linspace(lower_price.min(),upper_price.max(),n_bins+1)
+    centers     = (bins[:-1] + bins[1:])/2
+    times,row   = np.unique(range_data['time'].to_numpy(),return_inverse=True)
+    liquidity   = np.zeros((n_bins,len(times)))
+    covered     = (lower_price[:,None] <= centers[None,:]) & (upper_price[:,None] >= centers[None,:])
+    np.add.at(liquidity.T,row,covered*range_data['position_liquidity'].to_numpy()[:,None])
+    
+    fig_liquidity = go.Figure()
+    fig_liquidity.add_trace(go.Heatmap(x=times,y=centers,z=liquidity,colorscale='Reds',showscale=False))
+    
+    if data_strategy is not None:
+        fig_liquidity.add_trace(go.Scatter(
+            x=data_strategy['time'], 
+            y=1/data_strategy['price'] if flip_price_axis else data_strategy['price'],
+            name='Price',
+            line=dict(width=2,color='black')))
+    
+    fig_liquidity.update_layout(
+        margin=dict(l=20, r=20, t=40, b=20),
+        height= CHART_SIZE,
+        title = 'Liquidity Distribution',
+        xaxis_title="Date",
+        yaxis_title=y_axis_label,
+    )
+
+    fig_liquidity.show(renderer="png")
+    
+    return fig_liquidity
@@ -1,14 +1,23 @@
 import pandas as pd
 import numpy as np
-import math
 import arch
 import UNI_v3_funcs
+import TickConversion
 import ActiveStrategyFramework
+import GarchForecast
 import scipy
-import copy
 
 class AutoRegressiveStrategy:
-    def __init__(self,model_data,alpha_param,tau_param,volatility_reset_ratio,tokens_outside_reset = .05,data_frequency='D',default_width = .5,days_ar_model = 180,return_forecast_cutoff=0.15,z_score_cutoff=5):
+    # Columns written by record_components, see ActiveStrategyFramework.SimulationRecorder
+    simulation_columns = [('price',float),('reset_point',bool),('compound_point',bool),('reset_reason',object),
+                          ('volatility',float),('return_forecast',float),
+                          ('base_range_lower',float),('base_range_upper',float),('limit_range_lower',float),('limit_range_upper',float),
+                          ('reset_range_lower',float),('reset_range_upper',float),('price_at_reset',float)] + \
+                         ActiveStrategyFramework.POSITION_COLUMNS + \
+                         [('base_position_value_in_token_0',float),('limit_position_value_in_token_0',float)]
+    
+    def __init__(self,model_data,alpha_param,tau_param,volatility_reset_ratio,tokens_outside_reset = .05,data_frequency='D',default_width = .5,days_ar_model = 180,return_forecast_cutoff=0.15,z_score_cutoff=5,
+                 incremental_forecast=False,refit_interval='1D',forecast_table=None,forecast_tolerance=0.02,allow_native_forecasts=False):
         
         
         # Allow for different input data frequencies, always get 1 day ahead forecast
@@ -40,6 +49,32 @@ class AutoRegressiveStrategy:
         self.window_size            = 60*24*30
         self.model_data             = self.clean_data_for_garch(model_data)
 
+        # Optionally forecast with GarchForecast.IncrementalForecaster: one model is filtered over the moving window and
+        # refitted from its own parameters when refitting would move sd_forecast by more than forecast_tolerance, or at
+        # least every refit_interval, instead of a cold fit at every call
+        self.forecaster             = None
+        if incremental_forecast:
+            self.forecaster         = GarchForecast.IncrementalForecaster(self.model_data['quotePrice'],self.resample_option,
+                                                                          days_ar_model,self.annualization_factor,refit_interval,forecast_tolerance)
+
+        # Forecasts computed beforehand, see GarchForecast.get_forecast_table. Times missing from the table are forecast as usual.
+        # Tables of GarchForecast.fit_ar_garch_batch (estimator='native') can differ from arch's fits, they need allow_native_forecasts
+        self.forecast_table         = forecast_table
+        if forecast_table is not None:
+            if forecast_table.key == GarchForecast.forecast_key(self,'native') and not allow_native_forecasts:
+                raise ValueError('the forecast table was built with the native estimator, pass allow_native_forecasts=True to use it')
+            if forecast_table.key not in [GarchForecast.forecast_key(self,x) for x in GarchForecast.ESTIMATORS]:
+                raise ValueError('the forecast table was built from different model data or settings')
+
+    def checkpoint_state(self):
+        # State of the incremental forecasts, saved by ActiveStrategyFramework.simulate_strategy_checkpointed
+        if self.forecaster is None:
+            return None
+        return self.forecaster.state()
+
+    def restore_state(self,state):
+        if state is not None:
+            self.forecaster.restore(state)
         
     #####################################
     # Estimate AR model at current timepoint
@@ -69,6 +104,14 @@ class AutoRegressiveStrategy:
         
     def generate_model_forecast(self,timepoint):
         
+            if self.forecast_table is not None:
+                model_forecast = self.forecast_table.get(timepoint)
+                if model_forecast is not None:
+                    return model_forecast
+
+            if self.forecaster is not None:
+                return self.forecaster.forecast(timepoint)
+
             # Compute returns with data_frequency frequency starting at the current timepoint and looking backwards
             current_data                   = self.model_data.loc[:timepoint].resample(self.resample_option,closed='right',label='right',origin=timepoint).last()      
             current_data['price_return']   = current_data['quotePrice'].pct_change()
@@ -281,7 +324,7 @@ class AutoRegressiveStrategy:
         if current_strat_obs.strategy_info is None:
             strategy_info_here = dict()
         else:
-            strategy_info_here = copy.deepcopy(current_strat_obs.strategy_info)
+            strategy_info_here = dict(current_strat_obs.strategy_info)
             
         # Limit return prediction to a return_forecast_cutoff % change
         if np.abs(model_forecast['return_forecast']) > self.return_forecast_cutoff:
@@ -321,16 +364,14 @@ class AutoRegressiveStrategy:
                                     
         # Set baseLower
         if base_range_lower > 0.0:
-            baseLowerPRE       = math.log(current_strat_obs.decimal_adjustment*base_range_lower,1.0001)
-            baseLower          = int(math.floor(baseLowerPRE/current_strat_obs.tickSpacing)*current_strat_obs.tickSpacing)
+            baseLower          = TickConversion.price_to_tick(base_range_lower,current_strat_obs.decimal_adjustment,current_strat_obs.tickSpacing,'floor')
         else:
             # If lower end of base range is negative, fix at 0.0
             base_range_lower   = 0.0
-            baseLower          = math.ceil(math.log((2**-128),1.0001)/current_strat_obs.tickSpacing)*current_strat_obs.tickSpacing
+            baseLower          = TickConversion.min_usable_tick(current_strat_obs.tickSpacing)
 
         # Set baseUpper
-        baseUpperPRE      = math.log(current_strat_obs.decimal_adjustment*base_range_upper,1.0001)
-        baseUpper         = int(math.floor(baseUpperPRE/current_strat_obs.tickSpacing)*current_strat_obs.tickSpacing)
+        baseUpper         = TickConversion.price_to_tick(base_range_upper,current_strat_obs.decimal_adjustment,current_strat_obs.tickSpacing,'floor')
 
         ## Sanity Checks
         # Make sure baseLower < baseUpper. If not make two tick
@@ -382,15 +423,13 @@ class AutoRegressiveStrategy:
         
         # Set limitLower
         if limit_range_lower > 0.0:
-            limitLowerPRE      = math.log(current_strat_obs.decimal_adjustment*limit_range_lower,1.0001)
-            limitLower         = int(math.floor(limitLowerPRE/current_strat_obs.tickSpacing)*current_strat_obs.tickSpacing)
+            limitLower         = TickConversion.price_to_tick(limit_range_lower,current_strat_obs.decimal_adjustment,current_strat_obs.tickSpacing,'floor')
         else:
             limit_range_lower  = 0.0
-            limitLower         = math.ceil(math.log((2**-128),1.0001)/current_strat_obs.tickSpacing)*current_strat_obs.tickSpacing
+            limitLower         = TickConversion.min_usable_tick(current_strat_obs.tickSpacing)
                 
         # Set limitUpper
-        limitUpperPRE     = math.log(current_strat_obs.decimal_adjustment*limit_range_upper,1.0001)
-        limitUpper        = int(math.floor(limitUpperPRE/current_strat_obs.tickSpacing)*current_strat_obs.tickSpacing)
+        limitUpper        = TickConversion.price_to_tick(limit_range_upper,current_strat_obs.decimal_adjustment,current_strat_obs.tickSpacing,'floor')
         
         ## Sanity Checks
         if token_0_limit:        
@@ -562,4 +601,32 @@ class AutoRegressiveStrategy:
             this_data['base_position_value_in_token_0']    = strategy_observation.liquidity_ranges[0]['token_0'] + strategy_observation.liquidity_ranges[0]['token_1'] / this_data['price']
             this_data['limit_position_value_in_token_0']   = strategy_observation.liquidity_ranges[1]['token_0'] + strategy_observation.liquidity_ranges[1]['token_1'] / this_data['price']
              
-            return this_data
\ No newline at end of file
+            return this_data
+
+    ########################################################
+    # Record strategy parameters into simulation columns
+    ########################################################
+    def record_components(self,strategy_observation,columns,i):
+            
+            # General variables
+            columns['price'][i]                  = strategy_observation.price
+            columns['reset_point'][i]            = strategy_observation.reset_point
+            columns['compound_point'][i]         = strategy_observation.compound_point
+            columns['reset_reason'][i]           = strategy_observation.reset_reason
+            columns['volatility'][i]             = strategy_observation.liquidity_ranges[0]['volatility']
+            columns['return_forecast'][i]        = strategy_observation.liquidity_ranges[0]['return_forecast']
+            
+            # Range Variables
+            columns['base_range_lower'][i]       = strategy_observation.liquidity_ranges[0]['lower_bin_price']
+            columns['base_range_upper'][i]       = strategy_observation.liquidity_ranges[0]['upper_bin_price']
+            columns['limit_range_lower'][i]      = strategy_observation.liquidity_ranges[1]['lower_bin_price']
+            columns['limit_range_upper'][i]      = strategy_observation.liquidity_ranges[1]['upper_bin_price']
+            columns['reset_range_lower'][i]      = strategy_observation.strategy_info['reset_range_lower']
+            columns['reset_range_upper'][i]      = strategy_observation.strategy_info['reset_range_upper']
+            columns['price_at_reset'][i]         = strategy_observation.liquidity_ranges[0]['price']
+            
+            # Fee, Asset and Value Variables
+            ActiveStrategyFramework.record_position_components(strategy_observation,columns,i)
+            
+            columns['base_position_value_in_token_0'][i]    = strategy_observation.liquidity_ranges[0]['token_0'] + strategy_observation.liquidity_ranges[0]['token_1'] / strategy_observation.price
+            columns['limit_position_value_in_token_0'][i]   = strategy_observation.liquidity_ranges[1]['token_0'] + strategy_observation.liquidity_ranges[1]['token_1'] / strategy_observation.price
@@ -0,0 +1,357 @@
+import pandas as pd
+import numpy as np
+import ActiveStrategyFramework
+import JitKernels
+import UNI_v3_funcs
+
+##############################################################
+# Lockstep simulation of K configurations of a strategy over one timeline
+#
+# Instead of a StrategyObservation per configuration and step, the state of
+# all configurations is kept in arrays with one row per configuration (and a
+# column per range), and every step updates all of them at once: token
+# amounts, fee accrual, rebalance checks, and the resets of the rows that
+# need one. Batch strategies (see ResetStrategy.ResetStrategyBatch) implement
+#     set_liquidity_ranges(state,rows,timeline,i)
+#     check_strategy(state,timeline,i)
+#     record_components(state,timeline,i,columns)
+# and a simulation_columns list, like their single configuration versions.
+#
+# The liquidity math reproduces UNI_v3_funcs in float64. sqrt prices are
+# computed with python when ranges are set, so results agree with
+# simulate_strategy up to the last bit of the token amounts.
+#
+# Configurations usually share the prices and swaps of one timeline. A
+# timeline can also give every configuration its own path (as the ones of
+# MonteCarlo.PathTimeline): price, price_tick and price_tick_current then
+# have a column per configuration, and the swap columns of each step a row
+# per configuration.
+##############################################################
+
+class BatchState:
+    def __init__(self,n_configs,n_ranges,liquidity_in_0,liquidity_in_1):
+
+        shape                         = (n_configs,n_ranges)
+
+        # Ranges
+        self.lower_bin_tick           = np.zeros(shape,dtype=np.int64)
+        self.upper_bin_tick           = np.zeros(shape,dtype=np.int64)
+        self.sqrt_lower               = np.zeros(shape)
+        self.sqrt_upper               = np.zeros(shape)
+        self.lower_bin_price          = np.zeros(shape)
+        self.upper_bin_price          = np.zeros(shape)
+        self.range_price              = np.zeros(shape)
+        self.position_liquidity       = np.zeros(shape)
+        self.token_0                  = np.zeros(shape)
+        self.token_1                  = np.zeros(shape)
+
+        # Position
+        self.liquidity_in_0           = np.full(n_configs,float(liquidity_in_0))
+        self.liquidity_in_1           = np.full(n_configs,float(liquidity_in_1))
+        self.token_0_left_over        = np.zeros(n_configs)
+        self.token_1_left_over        = np.zeros(n_configs)
+        self.token_0_fees_uncollected = np.zeros(n_configs)
+        self.token_1_fees_uncollected = np.zeros(n_configs)
+        self.token_0_fees             = np.zeros(n_configs)
+        self.token_1_fees             = np.zeros(n_configs)
+        self.reset_point              = np.zeros(n_configs,dtype=bool)
+        self.reset_reason             = np.full(n_configs,'',dtype=object)
+        
+        # Step where a configuration could not place its liquidity (simulate_strategy would raise), -1 if none
+        self.failed_step              = np.full(n_configs,-1,dtype=np.int64)
+
+        # Strategy specific arrays, the batch version of strategy_info
+        self.strategy_info            = dict()
+
+    def __len__(self):
+        return len(self.liquidity_in_0)
+
+    def fail(self,rows,i):
+        # Configurations that failed stop rebalancing, their results are not valid after step i
+        rows                          = rows[self.failed_step[rows] < 0]
+        self.failed_step[rows]        = i
+        
+    def set_range(self,rows,j,lower_bin_tick,upper_bin_tick):
+        # Ticks are python ints, as in UNI_v3_funcs
+        self.lower_bin_tick[rows,j]   = lower_bin_tick
+        self.upper_bin_tick[rows,j]   = upper_bin_tick
+        self.sqrt_lower[rows,j]       = sqrt_prices_x96(lower_bin_tick)
+        self.sqrt_upper[rows,j]       = sqrt_prices_x96(upper_bin_tick)
+
+########################################################
+# UNI_v3_funcs over arrays of ranges, with sqrt prices already computed
+########################################################
+
+def get_amounts(sqrt,sqrtA,sqrtB,liquidity,decimals_0,decimals_1):
+
+    sqrt = row_prices(sqrt,sqrtA)
+    if JitKernels.ENABLED and np.ndim(sqrt) == 0:
+        shape           = np.shape(sqrtA)
+        amount_0,amount_1 = JitKernels.get_amounts(float(sqrt),flat_floats(sqrtA),flat_floats(sqrtB),flat_floats(liquidity,shape),
+                                                   float(10**decimals_0),float(10**decimals_1))
+        return amount_0.reshape(shape),amount_1.reshape(shape)
+
+    sqrt            = np.broadcast_to(np.asarray(sqrt,dtype=float),np.shape(sqrtA))
+    sqrtA,sqrtB     = np.minimum(sqrtA,sqrtB),np.maximum(sqrtA,sqrtB)
+    below           = sqrt <= sqrtA
+    inside          = (sqrt < sqrtB) & (sqrt > sqrtA)
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        amount_0    = np.where(below, ((liquidity*2**96*(sqrtB-sqrtA)/sqrtB/sqrtA)/10**decimals_0),
+                      np.where(inside,((liquidity*2**96*(sqrtB-sqrt) /sqrtB/sqrt) /10**decimals_0),0.0))
+        amount_1    = np.where(below,0.0,
+                      np.where(inside,liquidity*(sqrt-sqrtA)/2**96/10**decimals_1,
+                                      liquidity*(sqrtB-sqrtA)/2**96/10**decimals_1))
+    return amount_0,amount_1
+
+def get_liquidity(sqrt,sqrtA,sqrtB,amount_0,amount_1,decimals_0,decimals_1):
+
+    sqrt = row_prices(sqrt,sqrtA)
+    if JitKernels.ENABLED and np.ndim(sqrt) == 0:
+        shape           = np.shape(sqrtA)
+        return JitKernels.get_liquidity(float(sqrt),flat_floats(sqrtA),flat_floats(sqrtB),flat_floats(amount_0,shape),flat_floats(amount_1,shape),
+                                        float(10**decimals_0),float(10**decimals_1)).reshape(shape)
+
+    sqrt            = np.broadcast_to(np.asarray(sqrt,dtype=float),np.shape(sqrtA))
+    sqrtA,sqrtB     = np.minimum(sqrtA,sqrtB),np.maximum(sqrtA,sqrtB)
+    below           = sqrt <= sqrtA
+    inside          = (sqrt < sqrtB) & (sqrt > sqrtA)
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        liquidity_0 = np.trunc(amount_0/((2**96*(sqrtB-np.where(inside,sqrt,sqrtA))/sqrtB/np.where(inside,sqrt,sqrtA))/10**decimals_0))
+        liquidity_1 = np.trunc(amount_1/((np.where(inside,sqrt,sqrtB)-sqrtA)/2**96/10**decimals_1))
+
+    # UNI_v3_funcs raises for ranges without width, here their liquidity is nan
+    return np.where(sqrtA == sqrtB,np.nan,np.where(below,liquidity_0,np.where(inside,np.minimum(liquidity_0,liquidity_1),liquidity_1)))
+
+def row_prices(sqrt,sqrtA):
+    # One price per configuration applies to all of its ranges
+    if np.ndim(sqrt) == 1 and np.ndim(sqrtA) == 2:
+        return np.asarray(sqrt)[:,None]
+    return sqrt
+
+def sqrt_prices_x96(ticks):
+    # UNI_v3_funcs.sqrt_price_x96 as floats (numpy's power can differ from python's in the last bit)
+    if np.ndim(ticks) == 0:
+        return float(UNI_v3_funcs.sqrt_price_x96(int(ticks)))
+    return np.array([float(UNI_v3_funcs.sqrt_price_x96(int(x))) for x in ticks])
+
+def row_values(x,rows):
+    # Values of a step for the configurations in rows, x is shared by all of them or has one per configuration
+    if np.ndim(x) == 0:
+        return x
+    return x[rows]
+
+def flat_floats(x,shape=None):
+    # Contiguous float64 copy for the kernels, broadcast to shape
+    if shape is not None:
+        x = np.broadcast_to(np.asarray(x,dtype=float),shape)
+    return np.ascontiguousarray(x,dtype=float).ravel()
+
+########################################################
+# Steps shared by every batch strategy
+########################################################
+
+def update_amounts(state,timeline,i):
+    # Token amounts of every range at the current pool price
+    state.token_0,state.token_1 = get_amounts(sqrt_prices_x96(timeline.price_tick_current[i]),
+                                              state.sqrt_lower,state.sqrt_upper,state.position_liquidity,
+                                              timeline.decimals_0,timeline.decimals_1)
+
+def accrue_fees(state,swaps,fee_tier):
+
+    # Terms are summed per configuration in (swap, range) order, as in ActiveStrategyFramework.accrue_fees_columnar
+    state.token_0_fees[:] = 0.0
+    state.token_1_fees[:] = 0.0
+
+    if len(swaps) > 0 and JitKernels.ENABLED and np.ndim(swaps.tick_swap) == 1:
+        fees_token_0,fees_token_1 = JitKernels.accrue_fees(swaps.tick_swap,swaps.token_0_in,swaps.virtual_liquidity,swaps.traded_in,
+                                                           state.lower_bin_tick,state.upper_bin_tick,state.position_liquidity,fee_tier)
+        state.token_0_fees[:] = 0.0 + fees_token_0
+        state.token_1_fees[:] = 0.0 + fees_token_1
+    elif len(swaps) > 0:
+        tick_swap         = swap_column(swaps.tick_swap)
+        virtual_liquidity = swap_column(swaps.virtual_liquidity)
+        traded_in         = swap_column(swaps.traded_in)
+        token_0_in        = swap_column(swaps.token_0_in)
+        liquidity         = state.position_liquidity[:,None,:]
+        in_range          = (state.lower_bin_tick[:,None,:] <= tick_swap) & (state.upper_bin_tick[:,None,:] >= tick_swap)
+
+        with np.errstate(divide='ignore',invalid='ignore'):
+            fraction_fees_earned_position = np.where(virtual_liquidity < 1e-9,1.0,liquidity/(liquidity + virtual_liquidity))
+
+        fees              = fee_tier * fraction_fees_earned_position * traded_in
+        fees_token_0      = np.where(in_range &  token_0_in,fees,0.0).reshape(len(state),-1)
+        fees_token_1      = np.where(in_range & ~token_0_in,fees,0.0).reshape(len(state),-1)
+
+        state.token_0_fees[:] = 0.0 + np.cumsum(fees_token_0,axis=1)[:,-1]
+        state.token_1_fees[:] = 0.0 + np.cumsum(fees_token_1,axis=1)[:,-1]
+
+    state.token_0_fees_uncollected += state.token_0_fees
+    state.token_1_fees_uncollected += state.token_1_fees
+
+def swap_column(x):
+    # Swaps shared by all configurations, or a row of swaps per configuration
+    if np.ndim(x) == 1:
+        return x[None,:,None]
+    return x[:,:,None]
+
+def remove_liquidity(state,rows,timeline,i):
+
+    # As StrategyObservation.remove_liquidity, for the configurations in rows
+    token_0,token_1  = get_amounts(sqrt_prices_x96(row_values(timeline.price_tick[i],rows)),
+                                   state.sqrt_lower[rows],state.sqrt_upper[rows],state.position_liquidity[rows],
+                                   timeline.decimals_0,timeline.decimals_1)
+    removed_amount_0 = np.zeros(len(rows))
+    removed_amount_1 = np.zeros(len(rows))
+    for j in range(token_0.shape[1]):
+        removed_amount_0 += token_0[:,j]
+        removed_amount_1 += token_1[:,j]
+
+    state.liquidity_in_0[rows]           = removed_amount_0 + state.token_0_left_over[rows] + state.token_0_fees_uncollected[rows]
+    state.liquidity_in_1[rows]           = removed_amount_1 + state.token_1_left_over[rows] + state.token_1_fees_uncollected[rows]
+    state.token_0_left_over[rows]        = 0.0
+    state.token_1_left_over[rows]        = 0.0
+    state.token_0_fees_uncollected[rows] = 0.0
+    state.token_1_fees_uncollected[rows] = 0.0
+
+def allocated_amounts(state):
+    # Tokens in ranges, added range by range as in the single configuration code
+    total_token_0 = np.zeros(len(state))
+    total_token_1 = np.zeros(len(state))
+    for j in range(state.token_0.shape[1]):
+        total_token_0 = total_token_0 + state.token_0[:,j]
+        total_token_1 = total_token_1 + state.token_1[:,j]
+    return total_token_0,total_token_1
+
+def record_position_components(state,price,columns,i):
+
+    # Batch version of ActiveStrategyFramework.record_position_components
+    columns['token_0_fees'][i]                = state.token_0_fees
+    columns['token_1_fees'][i]                = state.token_1_fees
+    columns['token_0_fees_uncollected'][i]    = state.token_0_fees_uncollected
+    columns['token_1_fees_uncollected'][i]    = state.token_1_fees_uncollected
+    columns['token_0_left_over'][i]           = state.token_0_left_over
+    columns['token_1_left_over'][i]           = state.token_1_left_over
+
+    total_token_0,total_token_1               = allocated_amounts(state)
+    token_0_total                             = total_token_0 + state.token_0_left_over + state.token_0_fees_uncollected
+    token_1_total                             = total_token_1 + state.token_1_left_over + state.token_1_fees_uncollected
+
+    columns['token_0_allocated'][i]           = total_token_0
+    columns['token_1_allocated'][i]           = total_token_1
+    columns['token_0_total'][i]               = token_0_total
+    columns['token_1_total'][i]               = token_1_total
+    columns['value_position_in_token_0'][i]   = token_0_total + token_1_total / price
+    columns['value_allocated_in_token_0'][i]  = total_token_0 + total_token_1 / price
+    columns['value_left_over_in_token_0'][i]  = state.token_0_left_over + state.token_1_left_over / price
+
+########################################################
+# Simulate all configurations of strategy_batch over the same prices and swaps
+########################################################
+
+def simulate_batch(price_data,swap_data,strategy_batch,liquidity_in_0,liquidity_in_1,fee_tier,decimals_0,decimals_1,timeline=None):
+
+    if timeline is None:
+        timeline = ActiveStrategyFramework.compile_timeline(price_data,swap_data,fee_tier,decimals_0,decimals_1)
+    else:
+        ActiveStrategyFramework.check_timeline(timeline,price_data,swap_data,fee_tier,decimals_0,decimals_1)
+
+    state   = BatchState(len(strategy_batch),strategy_batch.n_ranges,liquidity_in_0,liquidity_in_1)
+    results = BatchResults(strategy_batch,timeline)
+
+    for i in range(len(timeline)):
+        if i == 0:
+            strategy_batch.set_liquidity_ranges(state,np.arange(len(state)),timeline,i)
+            results.token_0_initial,results.token_1_initial = allocated_amounts(state)
+            results.token_0_initial = results.token_0_initial + state.token_0_left_over
+            results.token_1_initial = results.token_1_initial + state.token_1_left_over
+        else:
+            update_amounts(state,timeline,i)
+            accrue_fees(state,timeline.swaps_between(i),timeline.fee_tier)
+            state.reset_point[:]  = False
+            state.reset_reason[:] = ''
+            strategy_batch.check_strategy(state,timeline,i)
+        strategy_batch.record_components(state,timeline,i,results.columns)
+
+    results.failed_step = state.failed_step
+    return results
+
+class BatchResults:
+    def __init__(self,strategy_batch,timeline):
+        self.strategy_batch  = strategy_batch
+        self.timeline        = timeline
+        self.token_0_initial = None
+        self.token_1_initial = None
+        self.failed_step     = None
+
+        # One row per step, one column per configuration
+        self.columns         = {name: np.empty((len(timeline),len(strategy_batch)),dtype=dtype) for name,dtype in strategy_batch.simulation_columns}
+
+    def __len__(self):
+        return len(self.strategy_batch)
+
+    def recorder(self,k):
+        # Results of configuration k as a SimulationRecorder, as simulate_strategy(...,record=True) returns
+        if self.failed_step[k] >= 0:
+            raise ValueError('configuration '+str(k)+' could not place its liquidity at step '+str(self.failed_step[k])+ \
+                             ' (range without width), simulate_strategy raises ZeroDivisionError')
+        recorder                 = ActiveStrategyFramework.SimulationRecorder(self.strategy_batch,0)
+        recorder.length          = len(self.timeline)
+        recorder.time            = self.timeline.time_ns.copy()
+        recorder.time_zone       = self.timeline.time[0].tz if len(self.timeline) > 0 else None
+        recorder.token_0_initial = float(self.token_0_initial[k])
+        recorder.token_1_initial = float(self.token_1_initial[k])
+        recorder.columns         = {name: x[:,k].copy() for name,x in self.columns.items()}
+        return recorder
+
+    def simulation_series(self,k,token_0_usd_data = None):
+        return ActiveStrategyFramework.generate_simulation_series(self.recorder(k),self.strategy_batch,token_0_usd_data)
+
+    def analyze(self,frequency = 'M'):
+
+        # ActiveStrategyFramework.analyze_strategy of every configuration (values in token 0),
+        # computed on the result columns instead of a DataFrame per configuration.
+        # Configurations that failed have nan metrics.
+        annualization_factor = {'M': 365*24*60, 'H': 365*24, 'D': 365}[frequency]
+        columns              = self.columns
+        price                = columns['price']
+        value_position       = columns['value_position_in_token_0']
+        value_hold           = self.token_0_initial + self.token_1_initial / price
+        cum_fees             = np.cumsum(columns['token_0_fees'],axis=0) + np.cumsum(columns['token_1_fees'] / price,axis=0)
+        days_strategy        = pd.Timedelta(int(self.timeline.time_ns.max() - self.timeline.time_ns.min())).days
+        initial_value        = value_hold[0]
+
+        with np.errstate(divide='ignore',invalid='ignore'):
+            net_apr          = (value_position[-1]/initial_value - 1) * 365 / days_strategy
+            volatility       = np.nanvar(value_position[1:]/value_position[:-1] - 1,axis=0,ddof=1)**0.5 * annualization_factor**0.5
+            summary          = {'days_strategy'    : np.full(len(self),days_strategy),
+                                'gross_fee_apr'    : (cum_fees[-1]/initial_value) * 365 / days_strategy,
+                                'gross_fee_return' : cum_fees[-1]/initial_value,
+                                'net_apr'          : net_apr,
+                                'net_return'       : value_position[-1]/initial_value - 1,
+                                'rebalances'       : columns['reset_point'].sum(axis=0),
+                                'compounds'        : columns['compound_point'].sum(axis=0) if 'compound_point' in columns else np.zeros(len(self),dtype=np.int64),
+                                'max_drawdown'     : (value_position.max(axis=0) - value_position.min(axis=0)) / value_position.max(axis=0),
+                                'volatility'       : volatility,
+                                'sharpe_ratio'     : net_apr / volatility,
+                                'impermanent_loss' : (value_position[-1] - value_hold[-1]) / value_hold[-1]}
+
+            # Base / limit statistics, for strategies that report them
+            if 'base_position_value_in_token_0' in columns:
+                base_position = columns['base_position_value_in_token_0'] / \
+                                (columns['base_position_value_in_token_0'] + columns['limit_position_value_in_token_0'] + columns['value_left_over_in_token_0'])
+                base_width    = (columns['base_range_upper'] - columns['base_range_lower']) / columns['price_at_reset']
+                summary.update({'mean_base_position'   : np.nanmean(base_position,axis=0),
+                                'median_base_position' : np.nanmedian(base_position,axis=0),
+                                'mean_base_width'      : np.nanmean(base_width,axis=0),
+                                'median_base_width'    : np.nanmedian(base_width,axis=0)})
+
+        summary['final_value'] = value_position[-1]
+
+        failed                 = self.failed_step >= 0
+        if np.any(failed):
+            summary            = {name: x if name == 'days_strategy' else np.where(failed,np.nan,x) for name,x in summary.items()}
+        summary                = pd.DataFrame(summary)
+        summary['failed_step'] = self.failed_step
+        return summary
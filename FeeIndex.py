@@ -0,0 +1,390 @@
+import numpy as np
+import pandas as pd
+import json
+import os
+import ActiveStrategyFramework
+
+##############################################################
+# Fee index over the swaps of a pool
+#
+# Answers "fees earned by liquidity L on [tick_lower, tick_upper] between
+# swaps start and end" with O(log #ticks) array lookups, instead of scanning
+# the swaps as StrategyObservation.accrue_fees does.
+#
+# A swap earns the position fee_tier * traded_in * L/(L + virtual_liquidity).
+# Like Uniswap's feeGrowthGlobal, the index stores fee growth per unit of
+# liquidity, fee_tier * traded_in / virtual_liquidity, and to account for the
+# position's own liquidity also its higher powers:
+#     L/(L + VL) = L/VL - (L/VL)**2 + (L/VL)**3 - ...
+# The series is kept up to order terms. When L is too large relative to the
+# smallest virtual liquidity in the window for the truncation error to be
+# below rtol, or the rounding error of the cumulative sums could exceed rtol
+# (see rounding_error), the query falls back to scanning the swaps. Swaps with virtual
+# liquidity below min_liquidity (including the ones without liquidity) are
+# left out of the series and always computed exactly. Windows with fewer than
+# scan_below swaps are scanned too, which is both exact and faster.
+#
+# Cumulative sums by tick are kept in a wavelet matrix: swaps are stored in time
+# order, and every level splits them by one bit of their (compressed) tick,
+# storing the running count and fee growth of the swaps with a zero bit.
+# Running sums are compensated, the rounding error of every addition is kept
+# in a low part, so that a window late in a long history is not lost in the
+# cancellation of two large sums.
+#
+# The index is built once per pool and saved to disk (see get_fee_index), it can be
+# shared by any simulation over the same swaps through compile_timeline(...,fee_index=...)
+##############################################################
+
+class WaveletSums:
+    # Sums of weights (columns) over swaps in [start,end) with code < bound
+    def __init__(self,codes,weights,n_bits):
+
+        n                 = len(codes)
+        self.n_bits       = n_bits
+        self.zeros        = np.zeros((n_bits,n+1),dtype=np.int64)
+        self.zero_weights = np.zeros((n_bits,n+1,weights.shape[1]))
+        self.zero_low     = np.zeros((n_bits,n+1,weights.shape[1]),dtype=np.float32)
+        self.n_zeros      = np.zeros(n_bits,dtype=np.int64)
+        self.total        = np.vstack([np.zeros((1,weights.shape[1])),np.cumsum(weights,axis=0)])
+
+        for level in range(n_bits):
+            bit_zero                      = ((codes >> (n_bits - 1 - level)) & 1) == 0
+            self.zeros[level,1:]          = np.cumsum(bit_zero)
+            self.zero_weights[level],self.zero_low[level] = compensated_cumsum(weights*bit_zero[:,None])
+            self.n_zeros[level]           = self.zeros[level,-1]
+
+            # Stable partition, swaps with a zero bit first
+            order                         = np.concatenate([np.flatnonzero(bit_zero),np.flatnonzero(~bit_zero)])
+            codes                         = codes[order]
+            weights                       = weights[order]
+
+    @classmethod
+    def from_arrays(cls,zeros,zero_weights,zero_low,n_zeros,total):
+        wavelet_sums              = cls.__new__(cls)
+        wavelet_sums.n_bits       = len(n_zeros)
+        wavelet_sums.zeros        = zeros
+        wavelet_sums.zero_weights = zero_weights
+        wavelet_sums.zero_low     = zero_low
+        wavelet_sums.n_zeros      = n_zeros
+        wavelet_sums.total        = total
+        return wavelet_sums
+
+    def sum_below(self,start,end,bound,counts=False):
+
+        # Vectorized over queries, start, end and bound are integer arrays. With counts, also the number of swaps
+        result = np.zeros((len(start),self.total.shape[1]))
+        count  = np.zeros(len(start),dtype=np.int64)
+
+        for level in range(self.n_bits):
+            bit_one     = ((bound >> (self.n_bits - 1 - level)) & 1) == 1
+            zeros_start = self.zeros[level][start]
+            zeros_end   = self.zeros[level][end]
+
+            # Swaps with a zero bit where the bound has a one are all below the bound
+            result[bit_one] += (self.zero_weights[level][end[bit_one]] - self.zero_weights[level][start[bit_one]]) + \
+                               (self.zero_low[level][end[bit_one]]     - self.zero_low[level][start[bit_one]])
+            count[bit_one]  += zeros_end[bit_one] - zeros_start[bit_one]
+
+            start       = np.where(bit_one,self.n_zeros[level] + start - zeros_start,zeros_start)
+            end         = np.where(bit_one,self.n_zeros[level] + end   - zeros_end,  zeros_end)
+
+        return (result,count) if counts else result
+
+def compensated_cumsum(weights):
+    # Running sums from 0 as high + low parts. high is np.cumsum, low accumulates the exact
+    # rounding error of each of its additions (TwoSum); float32 is enough for the errors
+    high     = np.vstack([np.zeros((1,weights.shape[1])),np.cumsum(weights,axis=0)])
+    previous = high[:-1]
+    added    = high[1:] - previous
+    error    = (previous - (high[1:] - added)) + (weights - added)
+    low      = np.vstack([np.zeros((1,weights.shape[1])),np.cumsum(error,axis=0)])
+    return high,low.astype(np.float32)
+
+class FeeIndex:
+    def __init__(self,fee_tier,order,rtol,min_liquidity,scale,time_ns,swaps,ticks,exceptions,token_prefix,token_sums,scan_below=64):
+
+        self.fee_tier      = fee_tier
+        self.order         = order
+        self.rtol          = rtol
+        self.min_liquidity = min_liquidity
+        self.scale         = scale
+        self.scan_below    = scan_below
+        self.time_ns       = time_ns
+        self.swaps         = swaps
+        self.ticks         = ticks
+
+        # Positions of the swaps computed exactly
+        self.exceptions    = exceptions
+
+        # token_prefix[k][i] is the number of swaps of token k before swap i
+        self.token_prefix  = token_prefix
+        self.token_sums    = token_sums
+
+        # Smallest virtual liquidity of the swaps in the series, to bound its truncation
+        virtual_liquidity  = np.where(swaps.virtual_liquidity < min_liquidity,np.inf,swaps.virtual_liquidity)
+        self.liquidity_table = ActiveStrategyFramework.SparseTable(virtual_liquidity) if len(swaps) > 0 else None
+
+    @classmethod
+    def from_swaps(cls,swap_data,fee_tier,order=4,rtol=1e-8,min_liquidity=None):
+
+        swaps         = ActiveStrategyFramework.SwapColumns.from_frame(swap_data)
+        time_ns       = ActiveStrategyFramework.datetime_index_ns(swap_data.index)
+        ticks         = np.unique(swaps.tick_swap)
+        codes         = np.searchsorted(ticks,swaps.tick_swap)
+        n_bits        = max(1,len(ticks).bit_length())
+
+        # Growth is expressed relative to the median liquidity, so that its powers stay in range
+        with_liquidity = swaps.virtual_liquidity[swaps.virtual_liquidity >= 1e-9]
+        scale          = float(np.median(with_liquidity)) if len(with_liquidity) > 0 else 1.0
+        if min_liquidity is None:
+            min_liquidity = 0.1*scale
+        min_liquidity  = max(float(min_liquidity),1e-9)
+        regular        = swaps.virtual_liquidity >= min_liquidity
+        
+        with np.errstate(divide='ignore',invalid='ignore'):
+            relative_liquidity = scale/swaps.virtual_liquidity
+        weights       = np.column_stack([np.where(regular,fee_tier*swaps.traded_in*relative_liquidity**k,0.0) for k in range(1,order+1)])
+
+        token_prefix  = []
+        token_sums    = []
+        for token_mask in [swaps.token_0_in,~swaps.token_0_in]:
+            token_prefix.append(np.concatenate([[0],np.cumsum(token_mask)]))
+            token_sums.append(WaveletSums(codes[token_mask],weights[token_mask],n_bits))
+
+        return cls(fee_tier,order,rtol,min_liquidity,scale,time_ns,swaps,ticks,np.flatnonzero(~regular),token_prefix,token_sums)
+
+    def __len__(self):
+        return len(self.swaps)
+
+    ########################################################
+    # Queries
+    ########################################################
+
+    def window(self,start,end):
+        return FeeWindow(self,start,end)
+
+    def swap_positions(self,time_start,time_end):
+        # Swaps between two times, both included
+        return (int(np.searchsorted(self.time_ns,pd.Timestamp(time_start).value,side='left')),
+                int(np.searchsorted(self.time_ns,pd.Timestamp(time_end).value,  side='right')))
+
+    def fees_between(self,time_start,time_end,lower_bin_tick,upper_bin_tick,position_liquidity):
+        # Fees earned by the ranges between two times
+        start,end = self.swap_positions(time_start,time_end)
+        return self.fees_earned(start,end,lower_bin_tick,upper_bin_tick,position_liquidity)
+
+    def fees_earned(self,start,end,lower_bin_tick,upper_bin_tick,position_liquidity):
+        fees_token_0,fees_token_1 = self.window_fees([start],[end],lower_bin_tick,upper_bin_tick,position_liquidity)
+        return float(fees_token_0[0]),float(fees_token_1[0])
+
+    def scan_fees(self,positions,lower_bin_tick,upper_bin_tick,position_liquidity):
+        return ActiveStrategyFramework.accrue_fees_columnar(self.swaps.tick_swap[positions],self.swaps.token_0_in[positions],
+                                                            self.swaps.virtual_liquidity[positions],self.swaps.traded_in[positions],
+                                                            lower_bin_tick,upper_bin_tick,position_liquidity,self.fee_tier)
+
+    def rounding_error(self,token,growth,powers):
+        # Bound on the rounding error of fees computed from growth, the sum of the growth below the
+        # upper and below the lower bound of a range, with powers of its liquidity (last axis: order).
+        # The subtractions of the prefix sums are accurate relative to the growth itself, what remains
+        # of the prefix sums' own error is bounded by their magnitude, at most the total of the token
+        token_sums = self.token_sums[token]
+        eps        = np.finfo(float).eps
+        n_swaps    = len(token_sums.total) - 1
+        prefix     = n_swaps*eps*(np.finfo(np.float32).eps + eps)*token_sums.total[-1]
+        return np.sum(np.abs(powers)*((token_sums.n_bits + self.order)*eps*growth + 4*token_sums.n_bits*prefix),axis=-1)
+
+    def window_fees(self,starts,ends,lower_bin_tick,upper_bin_tick,position_liquidity):
+
+        # Fees earned by all ranges together, for each window [starts[i],ends[i]) of swaps
+        starts             = np.asarray(starts,dtype=np.int64)
+        ends               = np.asarray(ends,  dtype=np.int64)
+        fees_token_0       = np.zeros(len(starts))
+        fees_token_1       = np.zeros(len(starts))
+        n_ranges           = len(position_liquidity)
+
+        if len(self.swaps) == 0 or n_ranges == 0:
+            return fees_token_0,fees_token_1
+
+        # Liquidity can be larger than int64, convert each value like python would
+        position_liquidity = [float(x) for x in position_liquidity]
+        powers             = np.array([[(-1)**(k+1)*(x/self.scale)**k for k in range(1,self.order+1)] for x in position_liquidity])
+
+        # Truncation of the series is bounded by (L/min VL)**order
+        scan               = (ends - starts) < self.scan_below
+        indexed            = np.flatnonzero(~scan & (ends > starts))
+        min_liquidity      = np.array([self.liquidity_table.min(starts[i],ends[i]) for i in indexed])
+        scan[indexed]     |= (max(position_liquidity)/min_liquidity)**self.order > self.rtol
+        indexed            = np.flatnonzero(~scan & (ends > starts))
+
+        if len(indexed) > 0:
+            # One query per token for every window, range and bound
+            code_lower     = np.searchsorted(self.ticks,np.asarray(lower_bin_tick,dtype=float),side='left')
+            code_upper     = np.searchsorted(self.ticks,np.asarray(upper_bin_tick,dtype=float),side='right')
+            code_upper     = np.maximum(code_upper,code_lower)
+            bounds         = np.repeat(np.concatenate([code_upper,code_lower]),len(indexed))
+
+            for token,fees in enumerate([fees_token_0,fees_token_1]):
+                query_start = np.tile(self.token_prefix[token][starts[indexed]],2*n_ranges)
+                query_end   = np.tile(self.token_prefix[token][ends[indexed]],  2*n_ranges)
+                growth,count  = self.token_sums[token].sum_below(query_start,query_end,bounds,True)
+                growth        = growth.reshape(2,n_ranges,len(indexed),self.order)
+                count         = count.reshape(2,n_ranges,len(indexed))
+                # Ranges without swaps in the window earn nothing, rather than the rounding errors of the prefix sums
+                in_range      = count[0] - count[1] > 0
+                fees[indexed] = np.einsum('rqk,rk->q',np.where(in_range[:,:,None],growth[0] - growth[1],0.0),powers)
+                error         = np.sum(in_range*self.rounding_error(token,growth[0] + growth[1],powers[:,None,:]),axis=0)
+                scan[indexed]|= error > self.rtol*np.abs(fees[indexed])
+
+            # Swaps left out of the series
+            exception_start = np.searchsorted(self.exceptions,starts[indexed],side='left')
+            exception_end   = np.searchsorted(self.exceptions,ends[indexed],  side='left')
+            for i,exception_start_i,exception_end_i in zip(indexed,exception_start,exception_end):
+                if exception_end_i > exception_start_i:
+                    exception_fees   = self.scan_fees(self.exceptions[exception_start_i:exception_end_i],
+                                                      lower_bin_tick,upper_bin_tick,position_liquidity)
+                    fees_token_0[i] += exception_fees[0]
+                    fees_token_1[i] += exception_fees[1]
+
+        for i in np.flatnonzero(scan & (ends > starts)):
+            fees_token_0[i],fees_token_1[i] = self.scan_fees(slice(starts[i],ends[i]),lower_bin_tick,upper_bin_tick,position_liquidity)
+
+        return np.maximum(fees_token_0,0.0),np.maximum(fees_token_1,0.0)
+
+    def range_fees(self,starts,ends,lower_bin_tick,upper_bin_tick,position_liquidity):
+
+        # Fees earned by one range per query, range q over the window [starts[q],ends[q]) of swaps,
+        # e.g. a grid of static positions (see StaticRangeBacktest)
+        starts             = np.asarray(starts,dtype=np.int64)
+        ends               = np.asarray(ends,  dtype=np.int64)
+        lower_bin_tick     = np.asarray(lower_bin_tick,dtype=float)
+        upper_bin_tick     = np.asarray(upper_bin_tick,dtype=float)
+        position_liquidity = np.array([float(x) for x in position_liquidity])
+        fees_token_0       = np.zeros(len(starts))
+        fees_token_1       = np.zeros(len(starts))
+
+        if len(self.swaps) == 0:
+            return fees_token_0,fees_token_1
+
+        scan               = (ends - starts) < self.scan_below
+        indexed            = np.flatnonzero(~scan & (ends > starts))
+        min_liquidity      = np.array([self.liquidity_table.min(starts[q],ends[q]) for q in indexed])
+        scan[indexed]     |= (position_liquidity[indexed]/min_liquidity)**self.order > self.rtol
+        indexed            = np.flatnonzero(~scan & (ends > starts))
+
+        if len(indexed) > 0:
+            code_lower     = np.searchsorted(self.ticks,lower_bin_tick[indexed],side='left')
+            code_upper     = np.maximum(np.searchsorted(self.ticks,upper_bin_tick[indexed],side='right'),code_lower)
+            powers         = np.column_stack([(-1)**(k+1)*(position_liquidity[indexed]/self.scale)**k for k in range(1,self.order+1)])
+
+            for token,fees in enumerate([fees_token_0,fees_token_1]):
+                query_start   = self.token_prefix[token][starts[indexed]]
+                query_end     = self.token_prefix[token][ends[indexed]]
+                upper,count_upper = self.token_sums[token].sum_below(query_start,query_end,code_upper,True)
+                lower,count_lower = self.token_sums[token].sum_below(query_start,query_end,code_lower,True)
+                in_range          = count_upper - count_lower > 0
+                fees[indexed]     = np.where(in_range,np.einsum('qk,qk->q',upper - lower,powers),0.0)
+                scan[indexed]    |= in_range*self.rounding_error(token,upper + lower,powers) > self.rtol*np.abs(fees[indexed])
+
+            # Swaps left out of the series
+            exception_start = np.searchsorted(self.exceptions,starts[indexed],side='left')
+            exception_end   = np.searchsorted(self.exceptions,ends[indexed],  side='left')
+            for q,exception_start_q,exception_end_q in zip(indexed,exception_start,exception_end):
+                if exception_end_q > exception_start_q:
+                    exception_fees   = self.scan_fees(self.exceptions[exception_start_q:exception_end_q],
+                                                      [lower_bin_tick[q]],[upper_bin_tick[q]],[position_liquidity[q]])
+                    fees_token_0[q] += exception_fees[0]
+                    fees_token_1[q] += exception_fees[1]
+
+        for q in np.flatnonzero(scan & (ends > starts)):
+            fees_token_0[q],fees_token_1[q] = self.scan_fees(slice(starts[q],ends[q]),[lower_bin_tick[q]],[upper_bin_tick[q]],[position_liquidity[q]])
+
+        return np.maximum(fees_token_0,0.0),np.maximum(fees_token_1,0.0)
+
+    ########################################################
+    # Storage, a directory of .npy files which are memory mapped when loaded
+    ########################################################
+
+    def save(self,path):
+
+        os.makedirs(path,exist_ok=True)
+        arrays = {'time_ns':self.time_ns,'ticks':self.ticks,'exceptions':self.exceptions,
+                  'tick_swap':self.swaps.tick_swap,'token_0_in':self.swaps.token_0_in,
+                  'virtual_liquidity':self.swaps.virtual_liquidity,'traded_in':self.swaps.traded_in}
+        for token in range(2):
+            arrays['token_'+str(token)+'_prefix']       = self.token_prefix[token]
+            arrays['token_'+str(token)+'_zeros']        = self.token_sums[token].zeros
+            arrays['token_'+str(token)+'_zero_weights'] = self.token_sums[token].zero_weights
+            arrays['token_'+str(token)+'_zero_low']     = self.token_sums[token].zero_low
+            arrays['token_'+str(token)+'_n_zeros']      = self.token_sums[token].n_zeros
+            arrays['token_'+str(token)+'_total']        = self.token_sums[token].total
+        for name,array in arrays.items():
+            np.save(os.path.join(path,name+'.npy'),array)
+
+        with open(os.path.join(path,'index.json'),'w') as output:
+            json.dump({'fee_tier':self.fee_tier,'order':self.order,'rtol':self.rtol,
+                       'min_liquidity':self.min_liquidity,'scale':self.scale,
+                       'fingerprint':swap_fingerprint(self.time_ns,self.swaps)},output)
+
+    @classmethod
+    def load(cls,path,mmap_mode='r'):
+
+        with open(os.path.join(path,'index.json'),'r') as input:
+            meta = json.load(input)
+
+        # Plain ndarray views of the mapped files, indexing a np.memmap is slower
+        def load_array(name):
+            return np.asarray(np.load(os.path.join(path,name+'.npy'),mmap_mode=mmap_mode))
+
+        swaps        = ActiveStrategyFramework.SwapColumns(load_array('tick_swap'),load_array('token_0_in'),
+                                                           load_array('virtual_liquidity'),load_array('traded_in'))
+        token_prefix = [load_array('token_'+str(token)+'_prefix') for token in range(2)]
+        token_sums   = [WaveletSums.from_arrays(load_array('token_'+str(token)+'_zeros'),
+                                                load_array('token_'+str(token)+'_zero_weights'),
+                                                load_array('token_'+str(token)+'_zero_low'),
+                                                load_array('token_'+str(token)+'_n_zeros'),
+                                                load_array('token_'+str(token)+'_total')) for token in range(2)]
+
+        return cls(meta['fee_tier'],meta['order'],meta['rtol'],meta['min_liquidity'],meta['scale'],
+                   load_array('time_ns'),swaps,load_array('ticks'),load_array('exceptions'),token_prefix,token_sums)
+
+class FeeWindow:
+    # The swaps of one simulation step, accrued through the index by StrategyObservation.accrue_fees
+    __slots__ = ('index','start','end')
+
+    def __init__(self,index,start,end):
+        self.index = index
+        self.start = start
+        self.end   = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def fees_earned(self,lower_bin_tick,upper_bin_tick,position_liquidity):
+        return self.index.fees_earned(self.start,self.end,lower_bin_tick,upper_bin_tick,position_liquidity)
+
+def swap_fingerprint(time_ns,swaps):
+    # Identifies the swaps an index was built from
+    if len(swaps) == 0:
+        return [0]
+    return [len(swaps),int(time_ns[0]),int(time_ns[-1]),float(np.sum(swaps.traded_in)),float(np.sum(swaps.tick_swap))]
+
+##############################################################
+# Load the index of a pool from ./data, building it if it does not exist
+# or was built from different swaps or settings
+##############################################################
+def get_fee_index(swap_data,fee_tier,file_name,order=4,rtol=1e-8,min_liquidity=None,BUILD_INDEX=False):
+
+    path = './data/'+file_name+'_fee_index'
+
+    # Indices saved without the low parts of the running sums are rebuilt
+    if not BUILD_INDEX and os.path.exists(os.path.join(path,'index.json')) and os.path.exists(os.path.join(path,'token_0_zero_low.npy')):
+        fee_index   = FeeIndex.load(path)
+        fingerprint = swap_fingerprint(ActiveStrategyFramework.datetime_index_ns(swap_data.index),
+                                       ActiveStrategyFramework.SwapColumns.from_frame(swap_data))
+        if [fee_index.fee_tier,fee_index.order,fee_index.rtol,swap_fingerprint(fee_index.time_ns,fee_index.swaps)] == [fee_tier,order,rtol,fingerprint] and \
+           (min_liquidity is None or fee_index.min_liquidity == max(float(min_liquidity),1e-9)):
+            return fee_index
+
+    fee_index = FeeIndex.from_swaps(swap_data,fee_tier,order,rtol,min_liquidity)
+    fee_index.save(path)
+    return fee_index
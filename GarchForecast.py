@@ -0,0 +1,863 @@
+import numpy as np
+import pandas as pd
+import scipy.signal
+import os
+import copy
+import hashlib
+import warnings
+import concurrent.futures
+import ActiveStrategyFramework
+import JitKernels
+
+##############################################################
+# AR(1)-GARCH(1,1) forecasts of AutoRegressiveStrategy
+#
+# AutoRegressiveStrategy.generate_model_forecast resamples the whole price
+# history at every check and fits arch's ARX + GARCH(1,1) from its default
+# starting values. The functions below reproduce the parts of arch's
+# estimation the forecasts depend on (data scaling, backcast, variance bounds
+# and the variance recursion), so that a fitted model can be filtered over
+# new returns without refitting.
+##############################################################
+
+@JitKernels.jit
+def garch_recursion(omega,alpha,beta,resids,backcast,lower_bounds,upper_bounds):
+    # Conditional variances as arch's GARCH(1,1) recursion, bounded as in arch's bounds_check
+    sigma2 = np.empty(len(resids))
+    for t in range(len(resids)):
+        if t == 0:
+            variance = omega + alpha*backcast + beta*backcast
+        else:
+            variance = omega + alpha*resids[t-1]**2 + beta*sigma2[t-1]
+        if variance < lower_bounds[t]:
+            variance = lower_bounds[t]
+        elif variance > upper_bounds[t]:
+            if np.isinf(variance):
+                variance = upper_bounds[t] + 1000
+            else:
+                variance = upper_bounds[t] + np.log(variance/upper_bounds[t])
+        sigma2[t] = variance
+    return sigma2
+
+def backcast(resids):
+    # Exponentially weighted mean of the first 75 squared residuals, as arch
+    tau = min(75,len(resids))
+    w   = 0.94**np.arange(tau)
+    w   = w/sum(w)
+    return float(np.sum((resids[:tau]**2.0)*w))
+
+def variance_bounds(resids):
+    # Lower and upper bounds of the conditional variances, as arch's VolatilityProcess.variance_bounds
+    tau             = min(75,len(resids))
+    w               = 0.94**np.arange(tau)
+    w               = w/sum(w)
+    shocks          = np.concatenate([[w.dot(resids[:tau]**2.0)],(1.0 - 0.94)*resids[:-1]**2.0])
+    var_bound       = scipy.signal.lfilter([1.0],[1.0,-0.94],shocks)
+    lower,upper     = var_bound/1e6,var_bound*1e6
+    var             = float(np.var(resids))
+    min_upper_bound = 1 + float(np.max(resids**2.0))
+    lower_bound     = var/1e8
+    upper_bound     = 1e7*(1 + float(np.max(resids**2.0)))
+    lower           = np.where(lower < lower_bound,lower_bound,lower)
+    upper           = np.where(upper < min_upper_bound,min_upper_bound,upper)
+    upper           = np.where(upper > upper_bound,upper_bound,upper)
+    return lower,upper
+
+def ar1_ols(y):
+    # Constant and AR(1) coefficient by least squares, arch's starting values for ARX
+    regressors = np.column_stack([np.ones(len(y)-1),y[:-1]])
+    return np.linalg.pinv(regressors).dot(y[1:])
+
+def arch_scale(returns):
+    # Power of 10 arch's rescale=True multiplies the returns by
+    resids     = returns[1:] - np.column_stack([np.ones(len(returns)-1),returns[:-1]]).dot(ar1_ols(returns))
+    orig_scale = scale = float(np.var(resids))
+    rescale    = 1.0
+    while not 0.1 <= scale < 10000.0 and scale > 0:
+        if scale < 1.0:
+            rescale *= 10
+        else:
+            rescale /= 10
+        scale = orig_scale*rescale**2
+    return rescale
+
+def filter_ar_garch(y,params):
+
+    # Residuals and conditional variances of the scaled returns y with params (Const, y[1], omega, alpha[1], beta[1]),
+    # with the backcast and bounds of arch's forecast (computed from these residuals)
+    mu,phi,omega,alpha,beta = params
+    resids                  = y[1:] - mu - phi*y[:-1]
+    lower,upper             = variance_bounds(resids)
+    sigma2                  = garch_recursion(omega,alpha,beta,resids,backcast(resids),lower,upper)
+    return resids,sigma2
+
+def fit_ar_garch_arch(returns,starting_values=None):
+    # arch's ARX + GARCH(1,1) as AutoRegressiveStrategy fits it, optionally from starting values in the scale of the fit.
+    # Returns the parameters and the scale
+    import arch
+    ar_model            = arch.univariate.ARX(returns,lags=1,rescale=True)
+    ar_model.volatility = arch.univariate.GARCH(p=1,q=1)
+    with warnings.catch_warnings():
+        # Starting values outside arch's bounds are replaced by its defaults
+        warnings.simplefilter('ignore')
+        res             = ar_model.fit(update_freq=0,disp="off",starting_values=starting_values)
+    return np.asarray(res.params,dtype=float),res.scale
+
+##############################################################
+# Incremental forecasts
+#
+# The returns of generate_model_forecast at time t are the last prices of
+# bars of data_frequency ending at t, t - 1 period, ... (resample with
+# origin=t). Bars only depend on t through its phase within the period, so
+# they are kept per phase and extended with the new bars at each call.
+#
+# One model serves the moving window of every phase. The first forecast is
+# a cold fit, as generate_model_forecast. Later ones filter the model over
+# the returns of the window, after Newton iterations of arch's likelihood of
+# the window from the model's parameters (newton_fit) find the maximum a
+# refit would reach. When the forecast at that maximum differs from the
+# model's by more than tolerance (relative, on sd_forecast), the iterations
+# do not converge or the model is older than refit_interval, arch refits
+# the window from where they stopped. Every forecast is thus a refit or
+# within tolerance of the maximum of its window's likelihood reached from
+# the previous model. refit_errors keeps the change of sd_forecast at every
+# refit. Without numba the likelihood is too slow to check, and every
+# forecast is a refit from the previous model.
+#
+# With numba, on simulated GARCH prices and hourly checks, minute data over
+# 3 days took 10 ms per check instead of 40 ms for a cold fit (4 refits in
+# 72 checks). Daily data over 180 days took 19 ms: the windows of checks an
+# hour apart differ in every bar, and 89 of 96 checks refitted. Where the
+# likelihood has several maxima arch's cold fits jump between them from one
+# window to the next while the model follows one of them: 26% of the daily
+# forecasts were more than 2% from a cold fit (at most 12%), none of the
+# minute ones. check_incremental_forecasts measures this on any data.
+##############################################################
+
+class IncrementalForecaster:
+    def __init__(self,prices,resample_option,days_ar_model,annualization_factor,refit_interval='1D',tolerance=0.02):
+
+        prices                    = prices.dropna()
+        self.time_ns              = ActiveStrategyFramework.datetime_index_ns(prices.index)
+        self.prices               = prices.to_numpy(dtype=float)
+        self.period_ns            = pd.Timedelta(resample_option).value
+        self.window_ns            = pd.Timedelta(str(days_ar_model)+' days').value
+        self.annualization_factor = annualization_factor
+        self.refit_interval_ns    = pd.Timedelta(refit_interval).value
+        self.tolerance            = tolerance
+
+        # Bars of every phase, and the model shared by all of them
+        self.phases               = dict()
+        self.model                = None
+        self.refit_errors         = []
+
+    def state(self):
+        # Everything forecast changes, e.g. for AutoRegressiveStrategy.checkpoint_state
+        return copy.deepcopy({'phases': self.phases,'model': self.model,'refit_errors': self.refit_errors})
+
+    def restore(self,state):
+        state                     = copy.deepcopy(state)
+        self.phases               = state['phases']
+        self.model                = state['model']
+        self.refit_errors         = state['refit_errors']
+
+    def bars(self,time_ns):
+
+        # End times and prices of the bars ending at or before time_ns, in the phase of time_ns
+        phase = time_ns % self.period_ns
+        if phase not in self.phases:
+            if time_ns < self.time_ns[0]:
+                raise ValueError('no model data before the forecast time')
+            first_end          = time_ns - ((time_ns - self.time_ns[0])//self.period_ns)*self.period_ns
+            self.phases[phase] = {'end_ns': np.zeros(0,dtype=np.int64),'price': np.zeros(0),'next_end': first_end}
+        bars = self.phases[phase]
+
+        if bars['next_end'] <= time_ns:
+            # Last price within (end - period, end] of every new bar, nan if there is none
+            ends             = np.arange(bars['next_end'],time_ns + 1,self.period_ns,dtype=np.int64)
+            last             = np.searchsorted(self.time_ns,ends,side='right') - 1
+            valid            = (last >= 0) & (self.time_ns[np.maximum(last,0)] > ends - self.period_ns)
+            bars['end_ns']   = np.concatenate([bars['end_ns'],ends])
+            bars['price']    = np.concatenate([bars['price'],np.where(valid,self.prices[np.maximum(last,0)],np.nan)])
+            bars['next_end'] = ends[-1] + self.period_ns
+        return bars,np.searchsorted(bars['end_ns'],time_ns,side='right')
+
+    def window_returns(self,time_ns):
+
+        # Returns of generate_model_forecast
+        bars,n       = self.bars(time_ns)
+        start        = np.searchsorted(bars['end_ns'][:n],time_ns - self.window_ns,side='left')
+        first        = start - 1
+        while first > 0 and np.isnan(bars['price'][first]):
+            first   -= 1
+        first        = max(first,0)
+        price_return = pd.Series(bars['price'][first:n]).pct_change().to_numpy()
+        bar          = np.arange(first,n)
+        return price_return[(bar >= start) & ~np.isnan(price_return)]
+
+    def forecast(self,timepoint):
+
+        time_ns      = pd.Timestamp(timepoint).value
+        window       = fit_window(self.window_returns(time_ns))
+        model        = self.model
+
+        # Refits never use a model fitted after the forecast time
+        if model is None or time_ns < model['fit_time_ns']:
+            self.refit(window,time_ns,None)
+            return self.model_forecast(window,self.model['params'])
+
+        # Parameters of the model in the scale of the window, and the local maximum of the window's likelihood from them
+        ratio                   = window['scale']/model['scale']
+        mu,phi,omega,alpha,beta = model['params']
+        params       = np.array([mu*ratio,phi,omega*ratio**2,alpha,beta])
+        forecast     = self.model_forecast(window,params)
+        maximum      = params
+        if JitKernels.ENABLED and time_ns - model['fit_time_ns'] < self.refit_interval_ns:
+            maximum,converged = newton_fit(params,window)
+            if converged and abs(forecast['sd_forecast']/self.model_forecast(window,maximum)['sd_forecast'] - 1) <= self.tolerance:
+                return forecast
+
+        self.refit(window,time_ns,maximum)
+        refitted     = self.model_forecast(window,self.model['params'])
+        self.refit_errors.append((time_ns,abs(forecast['sd_forecast']/refitted['sd_forecast'] - 1)))
+        return refitted
+
+    def model_forecast(self,window,params):
+        # One step ahead forecast of params over the window, as generate_model_forecast
+        mu,phi,omega,alpha,beta = params
+        resids,sigma2     = filter_ar_garch(window['y'],params)
+        variance_forecast = omega + alpha*resids[-1]**2 + beta*sigma2[-1]
+        return {'return_forecast': (mu + phi*window['y'][-1]) / window['scale'],
+                'sd_forecast'    : (variance_forecast / window['scale']**2)**0.5 * self.annualization_factor}
+
+    def refit(self,window,time_ns,starting_values):
+        # arch's fit of the window from starting values in the scale of the window, cold if None
+        if starting_values is not None:
+            # Strictly within the bounds, arch computes them with other rounding and replaces starting values outside by its defaults
+            starting_values    = starting_values.copy()
+            starting_values[2] = np.clip(starting_values[2],window['omega_bounds'][0]*(1 + 1e-9),window['omega_bounds'][1]*(1 - 1e-9))
+            starting_values[4] = min(starting_values[4],(1 - starting_values[3])*(1 - 1e-9))
+        params,scale = fit_ar_garch_arch(window['returns'],starting_values)
+        self.model   = {'params': params,'scale': scale,'fit_time_ns': time_ns}
+
+def fit_window(returns):
+
+    # Scaled returns of one window with arch's least squares starting values, backcast, variance bounds and bounds of omega
+    scale          = arch_scale(returns)
+    y              = scale*returns
+    ols            = ar1_ols(y)
+    ols_resids     = y[1:] - ols[0] - ols[1]*y[:-1]
+    lower,upper    = variance_bounds(ols_resids)
+    variance       = float(np.mean(ols_resids**2))
+    return {'returns': returns,'scale': scale,'y': y,'ols': ols,'backcast': backcast(ols_resids),
+            'lower': lower,'upper': upper,'omega_bounds': np.array([1e-8*variance,10.0*variance])}
+
+def window_likelihood(params,window):
+    # Negative log likelihood of arch's fit of the window at params, and its gradient
+    value,gradient,_,_ = ar_garch_likelihood(params[None],window['y'][:,None],np.array([len(window['y']) - 1]),
+                                             np.array([window['backcast']]),window['lower'][:,None],window['upper'][:,None])
+    return value[0],gradient[0]
+
+def likelihood_hessian(params,window,gradient):
+    # Finite difference Hessian of window_likelihood, made positive definite
+    hessian = np.empty((5,5))
+    for j in range(5):
+        h             = 1e-5*max(abs(params[j]),1e-2)
+        shifted       = params.copy()
+        shifted[j]   += h
+        hessian[:,j]  = (window_likelihood(shifted,window)[1] - gradient)/h
+    return positive_definite(hessian[None])[0]
+
+def newton_fit(params,window,max_iterations=10,tolerance=1e-8):
+
+    # Local maximum of arch's likelihood of the window from params: Newton steps with finite difference Hessians
+    # within arch's bounds and constraints, halved until the likelihood increases. Returns the parameters and
+    # whether they converged
+    value,gradient = window_likelihood(params,window)
+    for iteration in range(max_iterations):
+        hessian       = likelihood_hessian(params,window,gradient)
+        step,decrease = constrained_steps(params[None],gradient[None],hessian[None],window['omega_bounds'][None])
+        if -decrease[0] <= tolerance*max(abs(value),1.0):
+            return params,True
+        for halving in range(30):
+            new_params             = project(params[None] + step,window['omega_bounds'][None])[0]
+            new_value,new_gradient = window_likelihood(new_params,window)
+            if new_value < value:
+                break
+            step                  /= 2
+        else:
+            break
+        params,value,gradient = new_params,new_value,new_gradient
+    return params,False
+
+def check_incremental_forecasts(strategy,timepoints):
+
+    # Incremental forecasts of strategy (in the order of timepoints) next to cold ones from generate_model_forecast
+    cold            = copy.copy(strategy)
+    cold.forecaster = None
+    rows            = []
+    for timepoint in timepoints:
+        incremental = strategy.generate_model_forecast(timepoint)
+        reference   = cold.generate_model_forecast(timepoint)
+        rows.append({'time'                   : timepoint,
+                     'return_forecast'        : incremental['return_forecast'],
+                     'return_forecast_cold'   : reference['return_forecast'],
+                     'sd_forecast'            : incremental['sd_forecast'],
+                     'sd_forecast_cold'       : reference['sd_forecast']})
+    result                         = pd.DataFrame(rows)
+    result['return_forecast_error'] = (result['return_forecast'] - result['return_forecast_cold']).abs()
+    result['sd_forecast_error']     = (result['sd_forecast']/result['sd_forecast_cold'] - 1).abs()
+    return result
+
+##############################################################
+# Forecast tables
+#
+# A forecast at time t only depends on the model data up to t, so the
+# forecasts a simulation will ask for can be computed beforehand, in
+# parallel, for every time it may check (the times of the price data passed
+# to simulate_strategy). Tables are saved in ./data under a key made of a
+# fingerprint of the cleaned model data, data_frequency and days_ar_model,
+# the only inputs of the forecasts: strategies that differ in alpha_param,
+# tau_param or volatility_reset_ratio share a table.
+##############################################################
+
+ESTIMATORS = ['arch','native']
+
+def forecast_key(strategy,estimator='arch'):
+    # Identifies the forecasts of an AutoRegressiveStrategy, estimator='native' for those of fit_ar_garch_batch
+    if estimator not in ESTIMATORS:
+        raise ValueError('estimator must be one of '+', '.join(ESTIMATORS))
+    prices      = strategy.model_data['quotePrice']
+    fingerprint = hashlib.sha1(pd.util.hash_pandas_object(prices,index=True).to_numpy().tobytes()).hexdigest()[:16]
+    key         = fingerprint+'_'+strategy.data_frequency+'_'+str(strategy.days_ar_model)
+    return key if estimator == 'arch' else key+'_'+estimator
+
+class ForecastTable:
+    def __init__(self,key,time_ns,return_forecast,sd_forecast):
+        # Forecasts sorted by time
+        order                = np.argsort(time_ns,kind='stable')
+        self.key             = key
+        self.time_ns         = np.asarray(time_ns,dtype=np.int64)[order]
+        self.return_forecast = np.asarray(return_forecast,dtype=float)[order]
+        self.sd_forecast     = np.asarray(sd_forecast,dtype=float)[order]
+
+    def __len__(self):
+        return len(self.time_ns)
+
+    def get(self,timepoint):
+        # Forecast at timepoint, None if it is not in the table
+        time_ns  = pd.Timestamp(timepoint).value
+        position = np.searchsorted(self.time_ns,time_ns)
+        if position == len(self.time_ns) or self.time_ns[position] != time_ns:
+            return None
+        return {'return_forecast': float(self.return_forecast[position]),
+                'sd_forecast'    : float(self.sd_forecast[position])}
+
+    def missing(self,time_ns):
+        # Times without a forecast
+        time_ns  = np.unique(np.asarray(time_ns,dtype=np.int64))
+        if len(self.time_ns) == 0:
+            return time_ns
+        position = np.minimum(np.searchsorted(self.time_ns,time_ns),len(self.time_ns) - 1)
+        return time_ns[self.time_ns[position] != time_ns]
+
+    def merge(self,other):
+        return ForecastTable(self.key,np.concatenate([self.time_ns,other.time_ns]),
+                             np.concatenate([self.return_forecast,other.return_forecast]),
+                             np.concatenate([self.sd_forecast,other.sd_forecast]))
+
+    def to_frame(self):
+        return pd.DataFrame({'return_forecast': self.return_forecast,'sd_forecast': self.sd_forecast},
+                            index=pd.to_datetime(self.time_ns,utc=True))
+
+    def save(self,path):
+        pd.to_pickle({'key': self.key,'forecasts': self.to_frame()},path)
+
+    @classmethod
+    def load(cls,path):
+        table     = pd.read_pickle(path)
+        forecasts = table['forecasts']
+        return cls(table['key'],ActiveStrategyFramework.datetime_index_ns(forecasts.index),
+                   forecasts['return_forecast'].to_numpy(),forecasts['sd_forecast'].to_numpy())
+
+def forecast_times(strategy,time_ns,estimator='arch'):
+    # Cold forecasts of generate_model_forecast at every time, run by the workers of build_forecast_table
+    if estimator == 'native':
+        forecasts           = batch_model_forecasts(strategy,[pd.Timestamp(x,tz='UTC') for x in time_ns])
+    else:
+        cold                = copy.copy(strategy)
+        cold.forecaster     = None
+        cold.forecast_table = None
+        forecasts           = [cold.generate_model_forecast(pd.Timestamp(x,tz='UTC')) for x in time_ns]
+    return ForecastTable(forecast_key(strategy,estimator),time_ns,[x['return_forecast'] for x in forecasts],[x['sd_forecast'] for x in forecasts])
+
+def build_forecast_table(strategy,times,max_workers=None,chunks_per_worker=4,table=None,estimator='arch'):
+
+    # Forecasts at the times missing from table, in chunks over a process pool (max_workers=1 runs them in this process)
+    key     = forecast_key(strategy,estimator)
+    table   = ForecastTable(key,[],[],[]) if table is None else table
+    if table.key != key:
+        raise ValueError('the forecast table was built from different model data or settings')
+    missing = table.missing([pd.Timestamp(x).value for x in times])
+    if len(missing) == 0:
+        return table
+
+    if max_workers == 1:
+        return table.merge(forecast_times(strategy,missing,estimator))
+    n_chunks    = min(len(missing),(max_workers or os.cpu_count() or 1)*chunks_per_worker)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for chunk in executor.map(forecast_times,[strategy]*n_chunks,np.array_split(missing,n_chunks),[estimator]*n_chunks):
+            table = table.merge(chunk)
+    return table
+
+##############################################################
+# Load the forecast table of a strategy from ./data, adding the times it lacks
+##############################################################
+def get_forecast_table(strategy,times,max_workers=None,BUILD_TABLE=False,estimator='arch'):
+
+    path  = './data/forecast_table_'+forecast_key(strategy,estimator)+'.pkl'
+    table = None
+    if not BUILD_TABLE and os.path.exists(path):
+        table = ForecastTable.load(path)
+
+    n_forecasts = 0 if table is None else len(table)
+    table       = build_forecast_table(strategy,times,max_workers,table=table,estimator=estimator)
+    if len(table) > n_forecasts:
+        os.makedirs('./data',exist_ok=True)
+        table.save(path)
+    return table
+
+##############################################################
+# Batched AR(1)-GARCH(1,1) estimation
+#
+# Fits the model of generate_model_forecast on many windows of returns at
+# once. The likelihood and its gradient are computed for all windows in one
+# pass over time, and a quasi-Newton method with the same bounds and
+# constraints as arch (omega within (1e-8, 10) times the variance of the
+# least squares residuals, alpha, beta >= 0 and alpha + beta <= 1) runs on
+# every window in lockstep. Data scaling, starting values, backcast and
+# variance bounds are those of arch, and the quasi-Newton method starts from
+# the identity as SLSQP, so fits mostly converge to the same maximum as arch,
+# to a tighter tolerance. Where the likelihood is flat or has several
+# maxima the two can stop at different points: on 900 windows of 180
+# returns of simulated GARCH, 8 volatility forecasts were more than 1e-3
+# (at most 9%) from arch's and 4 fits ended at a lower likelihood. With
+# arch_fallback (the default of batch_model_forecasts and native forecast
+# tables, at the cost of an arch fit per window) windows keep arch's fit
+# unless their own reaches a higher likelihood by more than 0.01: every
+# other forecast was arch's, and the 2 windows at a higher maximum were up
+# to 3% away. validate_against_arch checks this on any windows.
+##############################################################
+
+@JitKernels.jit
+def garch_likelihood_window(mu,phi,omega,alpha,beta,y,backcast,lower,upper):
+
+    # Negative log likelihood of one window of scaled returns y, its gradient and the last residual and variance,
+    # with the variances bounded as in garch_recursion
+    gradient = np.zeros(5)
+    d_sigma2 = np.zeros(5)
+    value    = 0.0
+    sigma2   = 0.0
+    last     = 0.0
+    for t in range(len(y) - 1):
+        resid = y[t+1] - mu - phi*y[t]
+        if t == 0:
+            d_sigma2[0] = 0.0
+            d_sigma2[1] = 0.0
+            d_sigma2[2] = 1.0
+            d_sigma2[3] = backcast
+            d_sigma2[4] = backcast
+            sigma2      = omega + alpha*backcast + beta*backcast
+        else:
+            d_sigma2[0] = beta*d_sigma2[0] - 2*alpha*last
+            d_sigma2[1] = beta*d_sigma2[1] - 2*alpha*last*y[t-1]
+            d_sigma2[2] = beta*d_sigma2[2] + 1.0
+            d_sigma2[3] = beta*d_sigma2[3] + last**2
+            d_sigma2[4] = beta*d_sigma2[4] + sigma2
+            sigma2      = omega + alpha*last**2 + beta*sigma2
+        if sigma2 < lower[t]:
+            sigma2      = lower[t]
+            d_sigma2[:] = 0.0
+        elif sigma2 > upper[t]:
+            if np.isinf(sigma2):
+                sigma2      = upper[t] + 1000
+                d_sigma2[:] = 0.0
+            else:
+                d_sigma2[:] = d_sigma2/sigma2
+                sigma2      = upper[t] + np.log(sigma2/upper[t])
+        value       += 0.5*(np.log(2*np.pi) + np.log(sigma2) + resid**2/sigma2)
+        gradient    += 0.5*(1 - resid**2/sigma2)/sigma2*d_sigma2
+        gradient[0] -= resid/sigma2
+        gradient[1] -= resid*y[t]/sigma2
+        last         = resid
+    return value,gradient,last,sigma2
+
+def ar_garch_likelihood(params,y,n_resids,backcasts,lower,upper):
+
+    # Negative log likelihood, its gradient and the last residual and variance of every window.
+    # params has a row per window, y the scaled returns of each window in a column (padded with zeros),
+    # n_resids the number of residuals of each window and lower, upper the variance bounds (padded with 0 and inf)
+    n_windows   = params.shape[0]
+    if JitKernels.ENABLED:
+        outside = np.ones(n_windows,dtype=bool)
+    else:
+        # All windows in one pass over time. Variances that cross the bounds are recomputed with garch_likelihood_window
+        mu,phi,omega,alpha,beta = params.T
+        n_steps     = y.shape[0] - 1
+        resids      = y[1:] - mu - phi*y[:-1]
+        resids2     = resids**2
+        active      = np.arange(n_steps)[:,None] < n_resids
+
+        # The variance (last row) and its derivatives follow x[t] = beta*x[t-1] + shocks[t], where the shock of the
+        # derivative by beta is the previous variance
+        shocks        = np.empty((n_steps,6,n_windows))
+        shocks[1:,0]  = -2*alpha*resids[:-1]
+        shocks[1:,1]  = -2*alpha*resids[:-1]*y[:-2]
+        shocks[1:,2]  = 1.0
+        shocks[1:,3]  = resids2[:-1]
+        shocks[1:,4]  = 0.0
+        shocks[1:,5]  = omega + alpha*resids2[:-1]
+        shocks[0]     = [np.zeros(n_windows),np.zeros(n_windows),np.ones(n_windows),backcasts,backcasts,omega + alpha*backcasts + beta*backcasts]
+        recursion     = shocks
+        for t in range(1,n_steps):
+            recursion[t]   += beta*recursion[t-1]
+            recursion[t,4] += recursion[t-1,5]
+        sigma2        = recursion[:,5]
+        d_sigma2      = recursion[:,:5]
+
+        weight      = np.where(active,1.0/sigma2,0.0)
+        value       = 0.5*(n_resids*np.log(2*np.pi) + np.sum(np.where(active,np.log(sigma2),0.0) + resids2*weight,axis=0))
+        gradient    = np.einsum('tw,tjw->jw',0.5*(1 - resids2*weight)*weight,d_sigma2)
+        gradient[0] -= np.sum(resids*weight,axis=0)
+        gradient[1] -= np.sum(resids*y[:-1]*weight,axis=0)
+        gradient    = gradient.T
+        last        = n_resids - 1
+        last_resid  = resids[last,np.arange(n_windows)]
+        last_sigma2 = sigma2[last,np.arange(n_windows)]
+        outside     = np.any(active & ((sigma2 < lower) | (sigma2 > upper)),axis=0)
+        if not np.any(outside):
+            return value,gradient,last_resid,last_sigma2
+
+        value,gradient,last_resid,last_sigma2 = value.copy(),gradient.copy(),last_resid.copy(),last_sigma2.copy()
+    if JitKernels.ENABLED:
+        value,gradient,last_resid,last_sigma2 = np.zeros(n_windows),np.zeros((n_windows,5)),np.zeros(n_windows),np.zeros(n_windows)
+
+    for w in np.flatnonzero(outside):
+        n = n_resids[w]
+        value[w],gradient[w],last_resid[w],last_sigma2[w] = garch_likelihood_window(*params[w],y[:n+1,w],backcasts[w],lower[:n,w],upper[:n,w])
+    return value,gradient,last_resid,last_sigma2
+
+def constrained_steps(x,gradient,hessian,omega_bounds):
+
+    # Minimum of the quadratic model gradient.d + d.hessian.d/2 over the steps d that keep x within the bounds
+    # and constraints. The minimum of a convex quadratic over a polytope is the minimum over the equality
+    # constrained minimums of its faces that are feasible, so every combination of active constraints is solved,
+    # all in one batch of KKT systems padded to three constraints
+    n_windows     = x.shape[0]
+    omega_faces   = [[],[(2,'lower')],[(2,'upper')]]
+    garch_faces   = [[],[(3,0.0)],[(4,0.0)],[('sum',1.0)],[(3,0.0),(4,0.0)],[(3,0.0),(4,1.0)],[(3,1.0),(4,0.0)]]
+    faces         = [omega_face + garch_face for omega_face in omega_faces for garch_face in garch_faces]
+    A             = np.zeros((len(faces),n_windows,3,5))
+    b             = np.zeros((len(faces),n_windows,3))
+    unused        = np.ones((len(faces),3))
+    for f,face in enumerate(faces):
+        for row,(variable,value) in enumerate(face):
+            if variable == 'sum':
+                A[f,:,row,3:] = 1.0
+            else:
+                A[f,:,row,variable] = 1.0
+            if value == 'lower':
+                value = omega_bounds[:,0]
+            elif value == 'upper':
+                value = omega_bounds[:,1]
+            b[f,:,row]     = value - np.einsum('wj,wj->w',A[f,:,row],x)
+            unused[f,row]  = 0.0
+
+    # Unused constraint rows only set their own multiplier to 0
+    kkt                   = np.zeros((len(faces),n_windows,8,8))
+    kkt[:,:,:5,:5]        = hessian
+    kkt[:,:,:5,5:]        = np.swapaxes(A,2,3)
+    kkt[:,:,5:,:5]        = A
+    kkt[:,:,5:,5:]        = unused[:,None,:,None]*np.eye(3)
+    rhs                   = np.concatenate([np.broadcast_to(-gradient,(len(faces),n_windows,5)),b],axis=2)
+    with np.errstate(all='ignore'):
+        try:
+            step          = np.linalg.solve(kkt,rhs[...,None])[...,:5,0]
+        except np.linalg.LinAlgError:
+            # Singular systems are skipped
+            step          = np.full((len(faces),n_windows,5),np.nan)
+            for index in np.ndindex(len(faces),n_windows):
+                try:
+                    step[index] = np.linalg.solve(kkt[index],rhs[index])[:5]
+                except np.linalg.LinAlgError:
+                    pass
+        new_x             = x + step
+        tolerance         = 1e-12
+        feasible          = np.all(np.isfinite(step),axis=2) & \
+                            (new_x[...,2] >= omega_bounds[:,0] - tolerance*omega_bounds[:,1]) & (new_x[...,2] <= omega_bounds[:,1]*(1 + tolerance)) & \
+                            (new_x[...,3] >= -tolerance) & (new_x[...,4] >= -tolerance) & (new_x[...,3] + new_x[...,4] <= 1 + tolerance)
+        value             = np.einsum('fwj,wj->fw',step,gradient) + 0.5*np.einsum('fwj,wjk,fwk->fw',step,hessian,step)
+
+    # The first feasible face with the lowest value, no step where none is feasible
+    value                 = np.where(feasible,value,np.inf)
+    best                  = np.argmin(value,axis=0)
+    best_value            = value[best,np.arange(n_windows)]
+    best_step             = np.where(np.isfinite(best_value)[:,None],step[best,np.arange(n_windows)],0.0)
+    return best_step,best_value
+
+def project(x,omega_bounds):
+    # Removes rounding errors that leave x outside the bounds
+    x      = x.copy()
+    x[:,2] = np.clip(x[:,2],omega_bounds[:,0],omega_bounds[:,1])
+    x[:,3] = np.clip(x[:,3],0.0,1.0)
+    x[:,4] = np.clip(x[:,4],0.0,1.0 - x[:,3])
+    return x
+
+def positive_definite(hessian):
+    # Eigenvalues floored to a small fraction of the largest
+    values,vectors = np.linalg.eigh(0.5*(hessian + np.transpose(hessian,(0,2,1))))
+    floor          = np.maximum(np.abs(values).max(axis=1,keepdims=True)*1e-8,1e-12)
+    values         = np.maximum(np.abs(values),floor)
+    return np.einsum('wij,wj,wkj->wik',vectors,values,vectors)
+
+class GarchBatchFit:
+    def __init__(self,params,scale,log_likelihood,converged,iterations,last_return,last_resid,last_sigma2,n_obs):
+        # params (Const, y[1], omega, alpha[1], beta[1]) of every window, in the scale of the fit as arch's res.params
+        self.params         = params
+        self.scale          = scale
+        self.log_likelihood = log_likelihood
+        self.converged      = converged
+        self.iterations     = iterations
+        self.last_return    = last_return
+        self.last_resid     = last_resid
+        self.last_sigma2    = last_sigma2
+        self.n_obs          = n_obs
+
+    def __len__(self):
+        return len(self.scale)
+
+    def forecasts(self,annualization_factor):
+        # One step ahead forecasts as generate_model_forecast
+        mu,phi,omega,alpha,beta = self.params.T
+        variance_forecast       = omega + alpha*self.last_resid**2 + beta*self.last_sigma2
+        return_forecast         = (mu + phi*self.last_return) / self.scale
+        sd_forecast             = (variance_forecast / self.scale**2)**0.5 * annualization_factor
+        return [{'return_forecast': float(x),'sd_forecast': float(y)} for x,y in zip(return_forecast,sd_forecast)]
+
+    def to_frame(self):
+        result = pd.DataFrame(self.params,columns=['Const','y[1]','omega','alpha[1]','beta[1]'])
+        result['scale']          = self.scale
+        result['log_likelihood'] = self.log_likelihood
+        result['converged']      = self.converged
+        result['iterations']     = self.iterations
+        result['n_obs']          = self.n_obs
+        return result
+
+def fit_ar_garch_batch(windows,max_iterations=200,tolerance=1e-10,n_starts=1,arch_fallback=False,fallback_tolerance=0.01):
+
+    # AR(1)-GARCH(1,1) fits of a list of return arrays, as fit_ar_garch_arch. Every window is fitted from arch's
+    # starting values and, with n_starts > 1, from the next best points of arch's grid, keeping the fit with the
+    # highest likelihood. With arch_fallback every window is also fitted with arch, and keeps arch's parameters
+    # unless the log likelihood of its own fit is higher by more than fallback_tolerance
+    windows        = [np.asarray(x,dtype=float) for x in windows]
+    n_windows      = len(windows)
+    n_resids       = np.array([len(x) - 1 for x in windows])
+    if n_windows == 0:
+        raise ValueError('no windows to fit')
+    if np.any(n_resids < 2):
+        raise ValueError('every window needs at least three returns')
+    n_steps        = n_resids.max()
+
+    # Scaled returns, least squares starting values, backcasts and bounds of every window
+    scale          = np.array([arch_scale(x) for x in windows])
+    y              = np.zeros((n_steps + 1,n_windows))
+    lower          = np.zeros((n_steps,n_windows))
+    upper          = np.full((n_steps,n_windows),np.inf)
+    ols            = np.zeros((n_windows,5))
+    backcasts      = np.zeros(n_windows)
+    omega_bounds   = np.zeros((n_windows,2))
+    for w,window in enumerate(windows):
+        arrays                      = fit_window(window)
+        y[:len(window),w]           = arrays['y']
+        ols[w,:2]                   = arrays['ols']
+        lower[:n_resids[w],w],upper[:n_resids[w],w] = arrays['lower'],arrays['upper']
+        backcasts[w]                = arrays['backcast']
+        omega_bounds[w]             = arrays['omega_bounds']
+
+    def likelihood(params,owner):
+        # Rows of params are fits of the windows in owner
+        if len(owner) == n_windows and np.array_equal(owner,np.arange(n_windows)):
+            return ar_garch_likelihood(params,y,n_resids,backcasts,lower,upper)
+        return ar_garch_likelihood(params,y[:,owner],n_resids[owner],backcasts[owner],lower[:,owner],upper[:,owner])
+
+    def optimize(x,owner):
+        return fit_from(x,owner,likelihood,omega_bounds[owner],max_iterations,tolerance)
+
+    # arch's grid of GARCH starting values, around the mean of the squared least squares residuals
+    target         = omega_bounds[:,1]/10.0
+    candidates     = []
+    values         = []
+    for alpha in [0.01,0.05,0.1,0.2]:
+        for persistence in [0.5,0.7,0.9,0.98]:
+            candidate       = ols.copy()
+            candidate[:,2:] = np.column_stack([(1.0 - persistence)*target,np.full(n_windows,alpha),np.full(n_windows,persistence - alpha)])
+            candidates.append(candidate)
+            values.append(likelihood(candidate,np.arange(n_windows))[0])
+
+    # The first start is arch's, the best point of the grid. Ties go to the earlier start
+    order          = np.argsort(np.array(values),axis=0,kind='stable')[:max(1,n_starts)]
+    owner          = np.tile(np.arange(n_windows),len(order))
+    x,value,converged,iterations = optimize(np.concatenate([np.array(candidates)[k,np.arange(n_windows)] for k in order]),owner)
+    best           = np.argmin(value.reshape(-1,n_windows),axis=0)*n_windows + np.arange(n_windows)
+    x,value,converged,iterations = x[best],value[best],converged[best],iterations[best]
+
+    if arch_fallback:
+        # Where the likelihood is flat arch stops short of the maximum, and continuing from its parameters would move
+        # the forecasts away from arch's for a negligible gain of likelihood
+        reference       = np.array([fit_ar_garch_arch(window)[0] for window in windows])
+        reference_value = likelihood(reference,np.arange(n_windows))[0]
+        rows            = np.flatnonzero(reference_value < value + fallback_tolerance)
+        x[rows],value[rows],converged[rows] = reference[rows],reference_value[rows],True
+
+    # Forecasts filter with the backcast and bounds of arch's forecast, from the fitted residuals
+    last_resid     = np.zeros(n_windows)
+    last_sigma2    = np.zeros(n_windows)
+    for w in range(n_windows):
+        resids,sigma2  = filter_ar_garch(y[:n_resids[w]+1,w],x[w])
+        last_resid[w],last_sigma2[w] = resids[-1],sigma2[-1]
+    return GarchBatchFit(x,scale,-value,converged,iterations,y[n_resids,np.arange(n_windows)],last_resid,last_sigma2,n_resids + 1)
+
+def fit_from(x,owner,likelihood,omega_bounds,max_iterations,tolerance):
+
+    # Quasi-Newton iterations from every row of x in lockstep, a row per fit of window owner[row]. BFGS starts from
+    # the identity as SLSQP, so that fits follow arch's path to the same maximum where the likelihood has several.
+    # A fit has converged when the decrease predicted with a finite difference Hessian is below tolerance,
+    # BFGS updates can underestimate it where the likelihood is flat
+    n_fits         = len(owner)
+    x              = x.copy()
+    value,gradient = likelihood(x,owner)[:2]
+    hessian        = np.tile(np.eye(5),(n_fits,1,1))
+    fresh          = np.zeros(n_fits,dtype=bool)
+    converged      = np.zeros(n_fits,dtype=bool)
+    iterations     = np.zeros(n_fits,dtype=int)
+
+    def refresh(rows):
+        # Finite difference Hessian of the gradient
+        for j in range(5):
+            h                   = 1e-5*np.maximum(np.abs(x[rows,j]),1e-2)
+            shifted             = x[rows].copy()
+            shifted[:,j]       += h
+            hessian[rows,:,j]   = (likelihood(shifted,owner[rows])[1] - gradient[rows])/h[:,None]
+        hessian[rows] = positive_definite(hessian[rows])
+        fresh[rows]   = True
+
+    for iteration in range(max_iterations):
+        rows             = np.flatnonzero(~converged)
+        if len(rows) == 0:
+            break
+        step,decrease    = constrained_steps(x[rows],gradient[rows],hessian[rows],omega_bounds[rows])
+        done             = -decrease <= tolerance*np.maximum(np.abs(value[rows]),1.0)
+        converged[rows[done & fresh[rows]]] = True
+        if np.any(done & ~fresh[rows]):
+            refresh(rows[done & ~fresh[rows]])
+        rows,step        = rows[~done],step[~done]
+        if len(rows) == 0:
+            continue
+        iterations[rows] += 1
+
+        # Backtracking line search, steps stay feasible as the feasible set is convex
+        slope            = np.einsum('wj,wj->w',gradient[rows],step)
+        length           = np.ones(len(rows))
+        new_x            = x[rows].copy()
+        new_value        = value[rows].copy()
+        new_gradient     = gradient[rows].copy()
+        pending          = np.arange(len(rows))
+        for _ in range(40):
+            trial_x          = project(x[rows[pending]] + length[pending,None]*step[pending],omega_bounds[rows[pending]])
+            trial_value,trial_gradient = likelihood(trial_x,owner[rows[pending]])[:2]
+            accept           = np.isfinite(trial_value) & (trial_value <= value[rows[pending]] + 1e-4*length[pending]*slope[pending])
+            new_x[pending[accept]]        = trial_x[accept]
+            new_value[pending[accept]]    = trial_value[accept]
+            new_gradient[pending[accept]] = trial_gradient[accept]
+            pending          = pending[~accept]
+            if len(pending) == 0:
+                break
+            length[pending] *= 0.5
+
+        # Fits without a decrease along the step are at a maximum up to rounding, unless a fresh Hessian finds one
+        stalled          = rows[pending]
+        converged[stalled[fresh[stalled]]] = True
+        moved            = np.ones(len(rows),dtype=bool)
+        moved[pending]   = False
+        rows,new_x,new_value,new_gradient = rows[moved],new_x[moved],new_value[moved],new_gradient[moved]
+        fresh[rows]      = False
+        if np.any(~fresh[stalled]):
+            refresh(stalled[~fresh[stalled]])
+
+        # Damped BFGS update, as SLSQP
+        s                = new_x - x[rows]
+        yk               = new_gradient - gradient[rows]
+        Hs               = np.einsum('wjk,wk->wj',hessian[rows],s)
+        sHs              = np.einsum('wj,wj->w',s,Hs)
+        sy               = np.einsum('wj,wj->w',s,yk)
+        theta            = np.where(sy >= 0.2*sHs,1.0,0.8*sHs/np.where(sHs - sy != 0,sHs - sy,1.0))
+        r                = theta[:,None]*yk + (1 - theta[:,None])*Hs
+        sr               = np.einsum('wj,wj->w',s,r)
+        update           = (sHs > 0) & (sr > 0)
+        with np.errstate(all='ignore'):
+            new_hessian  = hessian[rows] + np.einsum('wj,wk->wjk',r,r)/sr[:,None,None] - np.einsum('wj,wk->wjk',Hs,Hs)/sHs[:,None,None]
+        hessian[rows[update]]  = new_hessian[update]
+        x[rows]          = new_x
+        value[rows]      = new_value
+        gradient[rows]   = new_gradient
+
+    return x,value,converged,iterations
+
+def batch_model_forecasts(strategy,times,batch_size=256,arch_fallback=True):
+
+    # Forecasts of generate_model_forecast at every time with fit_ar_garch_batch, a dict per time. arch_fallback
+    # costs an arch fit per window, without it some windows can stop at another maximum than arch's
+    windows   = IncrementalForecaster(strategy.model_data['quotePrice'],strategy.resample_option,
+                                      strategy.days_ar_model,strategy.annualization_factor)
+    returns   = [windows.window_returns(pd.Timestamp(x).value) for x in times]
+    forecasts = []
+    for start in range(0,len(returns),batch_size):
+        forecasts.extend(fit_ar_garch_batch(returns[start:start + batch_size],arch_fallback=arch_fallback).forecasts(strategy.annualization_factor))
+    return forecasts
+
+def check_against_arch(windows,annualization_factor=1.0,arch_fallback=True,fallback_tolerance=0.01):
+
+    # fit_ar_garch_batch next to arch's fits of the same windows, with their differences
+    import arch
+    batch     = fit_ar_garch_batch(windows,arch_fallback=arch_fallback,fallback_tolerance=fallback_tolerance)
+    forecasts = batch.forecasts(annualization_factor)
+    rows      = []
+    for w,window in enumerate(windows):
+        ar_model            = arch.univariate.ARX(np.asarray(window,dtype=float),lags=1,rescale=True)
+        ar_model.volatility = arch.univariate.GARCH(p=1,q=1)
+        res                 = ar_model.fit(update_freq=0,disp="off")
+        reference           = res.forecast(horizon=1,reindex=False)
+        sd_forecast         = (reference.variance.to_numpy()[0][-1] / res.scale**2)**0.5 * annualization_factor
+        rows.append({'max_param_error'      : float(np.max(np.abs(batch.params[w] - res.params.to_numpy()))),
+                     'log_likelihood'       : batch.log_likelihood[w],
+                     'log_likelihood_arch'  : res.loglikelihood,
+                     'return_forecast_error': abs(forecasts[w]['return_forecast'] - reference.mean.to_numpy()[0][-1]/res.scale),
+                     'sd_forecast_error'    : abs(forecasts[w]['sd_forecast']/sd_forecast - 1),
+                     'converged'            : batch.converged[w]})
+    return pd.DataFrame(rows)
+
+def validate_against_arch(windows,rtol=1e-3,annualization_factor=1.0,arch_fallback=True,fallback_tolerance=0.01):
+
+    # check_against_arch, raising when a fit ends at a lower likelihood than arch's, or at the same maximum (log
+    # likelihoods within fallback_tolerance) with a volatility forecast further than rtol (relative) from arch's.
+    # higher_maximum marks the windows fitted at a higher maximum than arch's, whose forecasts can differ more
+    result                   = check_against_arch(windows,annualization_factor,arch_fallback,fallback_tolerance)
+    difference               = result['log_likelihood'] - result['log_likelihood_arch']
+    result['higher_maximum'] = difference > fallback_tolerance
+    lower                    = difference < -1e-8*result['log_likelihood_arch'].abs()
+    if lower.any():
+        raise ValueError(str(lower.sum())+' of '+str(len(result))+' windows ended at a lower likelihood than arch')
+    error                    = result['sd_forecast_error'][~result['higher_maximum']]
+    if (error > rtol).any():
+        raise ValueError('volatility forecasts up to '+str(error.max())+' from arch at the same maximum, above rtol='+str(rtol))
+    return result
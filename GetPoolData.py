@@ -7,6 +7,9 @@ from itertools import compress
 import time
 import os
 import math
+import heapq
+import numpy as np
+import PoolEngine
 
 ##############################################################
 # Pull Uniswap v3 pool data from Google Bigquery
@@ -89,11 +92,19 @@ def get_pool_data_bigquery(contract_address,date_begin,date_end,decimals_0,decim
     else:
         raise ValueError('Unsupported Network:'+network)
     
+    return preprocess_bigquery_swaps(resulting_data,decimals_0,decimals_1)
+
+def preprocess_bigquery_swaps(resulting_data,decimals_0,decimals_1):
+    """
+    Decimal adjusted amounts and liquidity values of blockchain-etl swap events, as GetPoolData.get_pool_data_bigquery returns them.
+    """
+    
     DECIMAL_ADJ                             = 10**(decimals_1  - decimals_0)
     resulting_data['sqrtPriceX96_float']    = resulting_data['sqrtPriceX96'].astype(float)
     resulting_data['quotePrice']            = (((resulting_data['sqrtPriceX96_float'] / 2**96) **2) / DECIMAL_ADJ).astype(float)
     resulting_data['block_date']            = pd.to_datetime(resulting_data['block_timestamp'])
-    resulting_data                          = resulting_data.set_index('block_date',drop=False).sort_index()
+    # Stable, so that swaps of the same block keep their log order
+    resulting_data                          = resulting_data.set_index('block_date',drop=False).sort_index(kind='stable')
 
     resulting_data['tick_swap']             = resulting_data['tick'].astype(int)
     resulting_data['amount0']               = resulting_data['amount0'].astype(float)
@@ -102,8 +113,8 @@ def get_pool_data_bigquery(contract_address,date_begin,date_end,decimals_0,decim
     resulting_data['amount1_adj']           = resulting_data['amount1'].astype(float) / 10**decimals_1
     resulting_data['virtual_liquidity']     = resulting_data['liquidity'].astype(float)
     resulting_data['virtual_liquidity_adj'] = resulting_data['liquidity'].astype(float) / (10**((decimals_0  + decimals_1)/2))
-    resulting_data['token_in']              = resulting_data.apply(lambda x: 'token0' if (x['amount0_adj'] < 0) else 'token1',axis=1)
-    resulting_data['traded_in']             = resulting_data.apply(lambda x: -x['amount0_adj'] if (x['amount0_adj'] < 0) else -x['amount1_adj'],axis=1).astype(float)
+    resulting_data['token_in']              = np.where(resulting_data['amount0_adj'] < 0,'token0','token1')
+    resulting_data['traded_in']             = np.where(resulting_data['amount0_adj'] < 0,-resulting_data['amount0_adj'],-resulting_data['amount1_adj']).astype(float)
 
     return resulting_data
 
@@ -115,6 +126,129 @@ def signed_int(h):
     i = int.from_bytes(s, 'big', signed=True)
     return i
 
+##############################################################
+# Active liquidity replayed from the pool's Mint, Burn and Swap events
+# Events are merged in (block_number, log_index) order into a PoolEngine,
+# which keeps the liquidity of every initialized tick, so every swap gets the
+# exact active liquidity of the pool instead of a separate liquidity source.
+# Events arrive in chunks and annotated swaps are written to ./data/ every
+# rows_per_file swaps, so memory is bounded by the chunk sizes and the
+# initialized ticks, and an interrupted replay resumes after the last file.
+##############################################################
+
+def download_bigquery_event_chunks(contract_address,event,block_start,block_end,blocks_per_query=100000,network='ethereum'):
+    """
+    Queries Google Bigquery for the Mint, Burn, Swap or Initialize events of a Uniswap v3 pool between two blocks,
+    one query every blocks_per_query blocks. Yields DataFrames sorted by block_number and log_index.
+    """
+
+    from google.cloud import bigquery
+    client = bigquery.Client()
+
+    for block_from in range(block_start,block_end,blocks_per_query):
+        query = """
+                SELECT *
+                FROM blockchain-etl."""+network+"""_uniswap.UniswapV3Pool_event_"""+event+"""
+                where contract_address = lower('"""+contract_address.lower()+"""') and
+                  block_number >= """+str(block_from)+""" and block_number < """+str(min(block_from+blocks_per_query,block_end))+"""
+                order by block_number, log_index
+                """
+        yield client.query(query).to_dataframe(create_bqstorage_client=False)
+
+def event_rows(chunks,event):
+    # (block_number, log_index, event, row) for every row of the chunks, which must be in order
+    for chunk in chunks:
+        for row in chunk.to_dict('records'):
+            yield int(row['block_number']),int(row['log_index']),event,row
+
+def replay_pool_events(mint_chunks,burn_chunks,swap_chunks,initialize,fee_tier,file_name,
+                       rows_per_file=100000,check_liquidity=True,resume=True):
+    """
+    Replays the Mint, Burn and Swap events of a pool from its Initialize event (a dict or row with tick and sqrtPriceX96),
+    writing every swap with the tick and active liquidity before (tick_pool, liquidity_pool) and after it (tick, liquidity)
+    to ./data/file_name_replay_*.pkl. If the swaps carry the liquidity after them, as on chain, check_liquidity compares it
+    with the replayed value. Returns the PoolEngine after the last event.
+    """
+
+    state_file = './data/'+file_name+'_replay_state.pkl'
+    if resume and os.path.exists(state_file):
+        with open(state_file, 'rb') as input:
+            state = pickle.load(input)
+    else:
+        pool      = PoolEngine.PoolEngine(fee_tier,int(initialize['sqrtPriceX96']))
+        pool.tick = int(initialize['tick'])
+        state     = {'pool': pool,'last_event': (-1,-1),'files': []}
+    pool = state['pool']
+
+    events = heapq.merge(event_rows(mint_chunks,'Mint'),event_rows(burn_chunks,'Burn'),event_rows(swap_chunks,'Swap'),
+                         key=lambda x: (x[0],x[1]))
+    rows       = []
+    last_event = state['last_event']
+    for block_number,log_index,event,row in events:
+        if (block_number,log_index) <= state['last_event']:
+            continue
+        last_event = (block_number,log_index)
+
+        if event != 'Swap':
+            # Burns of zero liquidity only poke the fees of a position
+            if int(row['amount']) != 0:
+                pool.modify_liquidity(int(row['tickLower']),int(row['tickUpper']),int(row['amount']) if event == 'Mint' else -int(row['amount']))
+        else:
+            row['tick_pool']      = pool.tick
+            row['liquidity_pool'] = float(pool.liquidity)
+            pool.cross_to(int(row['tick']),int(row['sqrtPriceX96']) if 'sqrtPriceX96' in row else None)
+            if check_liquidity and row.get('liquidity') is not None and int(row['liquidity']) != pool.liquidity:
+                raise ValueError('replayed liquidity '+str(pool.liquidity)+' differs from the swap at block '+str(block_number)+
+                                 ' log '+str(log_index)+', replays must start from the Initialize event')
+            row['tick']           = int(row['tick'])
+            row['liquidity']      = float(pool.liquidity)
+            rows.append(row)
+
+            if len(rows) == rows_per_file:
+                save_replay(file_name,state,rows,last_event)
+                rows = []
+
+    # Events after the last swap are part of the pool state as well
+    if last_event != state['last_event']:
+        save_replay(file_name,state,rows,last_event)
+    return pool
+
+def save_replay(file_name,state,rows,last_event):
+
+    # The state is replaced in one step after the rows are written, so that an interrupted
+    # replay resumes from the previous file
+    if len(rows) > 0:
+        replay_file = file_name+'_replay_{:06d}.pkl'.format(len(state['files']))
+        with open('./data/'+replay_file, 'wb') as output:
+            pickle.dump(pd.DataFrame(rows), output, pickle.HIGHEST_PROTOCOL)
+        state['files'] = state['files'] + [replay_file]
+
+    state['last_event'] = last_event
+    with open('./data/'+file_name+'_replay_state.pkl.tmp', 'wb') as output:
+        pickle.dump(state, output, pickle.HIGHEST_PROTOCOL)
+    os.replace('./data/'+file_name+'_replay_state.pkl.tmp','./data/'+file_name+'_replay_state.pkl')
+
+def get_replayed_swap_chunks(file_name,decimals_0,decimals_1):
+    """
+    Reads the swaps written by replay_pool_events one file at a time, preprocessed like GetPoolData.get_pool_data_bigquery,
+    e.g. as the swap_chunks of ActiveStrategyFramework.simulate_strategy_stream.
+    """
+
+    with open('./data/'+file_name+'_replay_state.pkl', 'rb') as input:
+        replay_files = pickle.load(input)['files']
+
+    for replay_file in replay_files:
+        with open('./data/'+replay_file, 'rb') as input:
+            resulting_data = pickle.load(input)
+
+        yield preprocess_bigquery_swaps(resulting_data,decimals_0,decimals_1)
+
+def get_pool_data_replay(file_name,decimals_0,decimals_1):
+    """
+    All the swaps written by replay_pool_events, with the exact active liquidity at every swap, in order to conduct simulations using the Active Strategy Framework.
+    """
+    return pd.concat(list(get_replayed_swap_chunks(file_name,decimals_0,decimals_1)))
+
 ##############################################################
 # Get Swaps from Uniswap v3's subgraph, and liquidity at each swap from Flipside Crypto
 ##############################################################
@@ -198,13 +332,21 @@ def get_pool_data_flipside(contract_address,flipside_query,file_name,DOWNLOAD_DA
 
     # Download  events
     swap_data               = get_swap_data(contract_address,file_name,DOWNLOAD_DATA)
+    # Download pool liquidity data
+    stats_data              = get_liquidity_flipside(flipside_query,file_name,DOWNLOAD_DATA)    
+    
+    return preprocess_flipside_swaps(swap_data,stats_data)
+
+def preprocess_flipside_swaps(swap_data,stats_data):
+    """
+    Merges subgraph swaps with the Flipside Crypto liquidity before each of them, as GetPoolData.get_pool_data_flipside returns them.
+    """
+    
     swap_data['time_pd']    = pd.to_datetime(swap_data['timestamp'], unit='s', origin='unix',utc=True)
     swap_data               = swap_data.set_index('time_pd')
     swap_data['tick_swap']  = swap_data['tick']
     swap_data               = swap_data.sort_index()
     
-    # Download pool liquidity data
-    stats_data              = get_liquidity_flipside(flipside_query,file_name,DOWNLOAD_DATA)    
     stats_data['time_pd']   = pd.to_datetime(stats_data['BLOCK_TIMESTAMP'], origin='unix',utc=True) 
     stats_data              = stats_data.set_index('time_pd')
     stats_data              = stats_data.sort_index()
@@ -216,7 +358,7 @@ def get_pool_data_flipside(contract_address,flipside_query,file_name,DOWNLOAD_DA
     full_data['tick_swap']       = full_data['tick_swap'].astype(int)
     full_data['amount0']         = full_data['amount0'].astype(float)
     full_data['amount1']         = full_data['amount1'].astype(float)
-    full_data['token_in']        = full_data.apply(lambda x: 'token0' if (x['amount0'] < 0) else 'token1',axis=1)
+    full_data['token_in']        = np.where(full_data['amount0'] < 0,'token0','token1')
     
     return full_data
 
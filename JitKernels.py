@@ -0,0 +1,126 @@
+import numpy as np
+
+##############################################################
+# Optional numba kernels for the inner loops of the simulations
+#
+# When numba is installed the loops below (liquidity math and fee accrual) are
+# compiled, and used by BatchSimulator and ActiveStrategyFramework's fee
+# accrual instead of their NumPy versions. Strategies can compile their own
+# kernels with jit (see ResetStrategy.reset_strategy_predicates).
+#
+# Kernels are compiled on their first call and cached on disk (in __pycache__,
+# or NUMBA_CACHE_DIR), so later runs and process pool workers load them
+# instead of compiling again.
+#
+# Every kernel does the same float operations in the same order as the NumPy
+# code it replaces, so results are identical with or without numba. Setting
+# ENABLED = False goes back to the NumPy code, e.g. to compare both.
+##############################################################
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+ENABLED = numba is not None
+Q96     = float(2**96)
+
+def jit(function):
+    # Division by zero gives inf or nan as in NumPy, rather than raising
+    if numba is None:
+        return function
+    return numba.njit(cache=True,error_model='numpy')(function)
+
+##############################################################
+# UNI_v3_funcs over flat arrays of ranges, as BatchSimulator.get_amounts and
+# get_liquidity. scale_0 and scale_1 are float(10**decimals)
+##############################################################
+
+@jit
+def get_amounts(sqrt,sqrtA,sqrtB,liquidity,scale_0,scale_1):
+
+    amount_0 = np.zeros(len(sqrtA))
+    amount_1 = np.zeros(len(sqrtA))
+    for j in range(len(sqrtA)):
+        lower,upper = min(sqrtA[j],sqrtB[j]),max(sqrtA[j],sqrtB[j])
+        if sqrt <= lower:
+            amount_0[j] = liquidity[j]*Q96*(upper-lower)/upper/lower/scale_0
+        elif sqrt < upper:
+            amount_0[j] = liquidity[j]*Q96*(upper-sqrt)/upper/sqrt/scale_0
+            amount_1[j] = liquidity[j]*(sqrt-lower)/Q96/scale_1
+        else:
+            amount_1[j] = liquidity[j]*(upper-lower)/Q96/scale_1
+    return amount_0,amount_1
+
+@jit
+def get_liquidity(sqrt,sqrtA,sqrtB,amount_0,amount_1,scale_0,scale_1):
+
+    liquidity = np.empty(len(sqrtA))
+    for j in range(len(sqrtA)):
+        lower,upper = min(sqrtA[j],sqrtB[j]),max(sqrtA[j],sqrtB[j])
+        if lower == upper:
+            liquidity[j] = np.nan
+        elif sqrt <= lower:
+            liquidity[j] = np.trunc(amount_0[j]/(Q96*(upper-lower)/upper/lower/scale_0))
+        elif sqrt < upper:
+            liquidity_0  = np.trunc(amount_0[j]/(Q96*(upper-sqrt)/upper/sqrt/scale_0))
+            liquidity_1  = np.trunc(amount_1[j]/((sqrt-lower)/Q96/scale_1))
+            # np.minimum propagates nan
+            if np.isnan(liquidity_0) or np.isnan(liquidity_1):
+                liquidity[j] = np.nan
+            else:
+                liquidity[j] = min(liquidity_0,liquidity_1)
+        else:
+            liquidity[j] = np.trunc(amount_1[j]/((upper-lower)/Q96/scale_1))
+    return liquidity
+
+##############################################################
+# Fees earned by the (swap, range) pairs of a RangeIndex, added in pair order
+# as the cumulative sums of accrue_fees_columnar
+##############################################################
+
+@jit
+def accrue_fee_pairs(swap_index,range_index,token_0_in,virtual_liquidity,traded_in,position_liquidity,fee_tier):
+
+    fees_token_0 = 0.0
+    fees_token_1 = 0.0
+    for p in range(len(swap_index)):
+        s,j = swap_index[p],range_index[p]
+        if virtual_liquidity[s] < 1e-9:
+            fraction_fees_earned_position = 1.0
+        else:
+            fraction_fees_earned_position = position_liquidity[j]/(position_liquidity[j] + virtual_liquidity[s])
+        fees = fee_tier * fraction_fees_earned_position * traded_in[s]
+        if token_0_in[s]:
+            fees_token_0 += fees
+        else:
+            fees_token_1 += fees
+    return fees_token_0,fees_token_1
+
+##############################################################
+# Fees earned by K positions of R ranges over a batch of swaps
+# Terms are added per position in (swap, range) order, as the cumulative
+# sums of BatchSimulator.accrue_fees
+##############################################################
+
+@jit
+def accrue_fees(tick_swap,token_0_in,virtual_liquidity,traded_in,
+                lower_bin_tick,upper_bin_tick,position_liquidity,fee_tier):
+
+    n_positions,n_ranges = position_liquidity.shape
+    fees_token_0         = np.zeros(n_positions)
+    fees_token_1         = np.zeros(n_positions)
+    for k in range(n_positions):
+        for s in range(len(tick_swap)):
+            for j in range(n_ranges):
+                if lower_bin_tick[k,j] <= tick_swap[s] and upper_bin_tick[k,j] >= tick_swap[s]:
+                    if virtual_liquidity[s] < 1e-9:
+                        fraction_fees_earned_position = 1.0
+                    else:
+                        fraction_fees_earned_position = position_liquidity[k,j]/(position_liquidity[k,j] + virtual_liquidity[s])
+                    fees = fee_tier * fraction_fees_earned_position * traded_in[s]
+                    if token_0_in[s]:
+                        fees_token_0[k] += fees
+                    else:
+                        fees_token_1[k] += fees
+    return fees_token_0,fees_token_1
@@ -0,0 +1,232 @@
+import numpy as np
+import pandas as pd
+import concurrent.futures
+import ActiveStrategyFramework
+import BatchSimulator
+import TickConversion
+
+##############################################################
+# Monte Carlo simulation of batch strategies
+#
+# Price paths are drawn from a model (bootstrapped returns, geometric
+# Brownian motion or an AR(1)-GARCH(1,1) like the one of
+# AutoRegressiveStrategy), and every step of every path gets synthetic swap
+# flow. All paths of a batch are simulated at once with BatchSimulator, one
+# row of the batch state per (configuration, path), and BatchResults.analyze
+# gives the analyze_strategy metrics of every row without building a
+# DataFrame per path.
+#
+# Batches of paths run in parallel over a process pool. Each batch draws
+# from its own stream of a np.random.SeedSequence, so results only depend on
+# seed and paths_per_batch, not on the number of workers.
+##############################################################
+
+def price_paths(price_0,returns):
+    # returns has a row per step and a column per path, prices start at price_0
+    prices     = np.empty((len(returns)+1,returns.shape[1]))
+    prices[0]  = price_0
+    prices[1:] = price_0*np.cumprod(1 + returns,axis=0)
+    return prices
+
+########################################################
+# Price models, generate(rng,n_paths) returns n_steps+1 prices (rows) per path (columns)
+########################################################
+
+class BootstrapPaths:
+    def __init__(self,returns,price_0,n_steps,block_size=1):
+        # Blocks of block_size consecutive returns are drawn with replacement
+        self.returns    = np.asarray(returns,dtype=float)
+        self.returns    = self.returns[np.isfinite(self.returns)]
+        self.price_0    = price_0
+        self.n_steps    = n_steps
+        self.block_size = block_size
+        if len(self.returns) < block_size:
+            raise ValueError('fewer returns than block_size')
+
+    def generate(self,rng,n_paths):
+        n_blocks = -(-self.n_steps//self.block_size)
+        starts   = rng.integers(0,len(self.returns) - self.block_size + 1,size=(n_blocks,n_paths))
+        rows     = (starts[:,None,:] + np.arange(self.block_size)[None,:,None]).reshape(n_blocks*self.block_size,n_paths)
+        return price_paths(self.price_0,self.returns[rows[:self.n_steps]])
+
+class GBMPaths:
+    def __init__(self,price_0,n_steps,drift,volatility):
+        # drift and volatility of the log price per step
+        self.price_0    = price_0
+        self.n_steps    = n_steps
+        self.drift      = drift
+        self.volatility = volatility
+
+    def generate(self,rng,n_paths):
+        log_returns = (self.drift - self.volatility**2/2) + self.volatility*rng.standard_normal((self.n_steps,n_paths))
+        prices      = np.empty((self.n_steps+1,n_paths))
+        prices[0]   = self.price_0
+        prices[1:]  = self.price_0*np.exp(np.cumsum(log_returns,axis=0))
+        return prices
+
+class ARGarchPaths:
+    def __init__(self,price_0,n_steps,mu,phi,omega,alpha,beta,last_return=0.0,last_residual=0.0,last_variance=None):
+        # r[t] = mu + phi*r[t-1] + e[t], e[t] = sqrt(h[t])*z[t], h[t] = omega + alpha*e[t-1]**2 + beta*h[t-1]
+        # Without last_variance paths start at the unconditional variance
+        self.price_0       = price_0
+        self.n_steps       = n_steps
+        self.mu            = mu
+        self.phi           = phi
+        self.omega         = omega
+        self.alpha         = alpha
+        self.beta          = beta
+        self.last_return   = last_return
+        self.last_residual = last_residual
+        self.last_variance = omega/(1 - alpha - beta) if last_variance is None else last_variance
+
+    @classmethod
+    def from_returns(cls,returns,price_0,n_steps):
+        # Fit as AutoRegressiveStrategy.generate_model_forecast, parameters back in units of the returns
+        import arch
+        returns             = np.asarray(returns,dtype=float)
+        returns             = returns[np.isfinite(returns)]
+        ar_model            = arch.univariate.ARX(returns,lags=1,rescale=True)
+        ar_model.volatility = arch.univariate.GARCH(p=1,q=1)
+        res                 = ar_model.fit(update_freq=0,disp="off")
+        scale               = res.scale
+        return cls(price_0,n_steps,
+                   mu            = res.params['Const']/scale,
+                   phi           = res.params['y[1]'],
+                   omega         = res.params['omega']/scale**2,
+                   alpha         = res.params['alpha[1]'],
+                   beta          = res.params['beta[1]'],
+                   last_return   = returns[-1],
+                   last_residual = res.resid[-1]/scale,
+                   last_variance = res.conditional_volatility[-1]**2/scale**2)
+
+    def generate(self,rng,n_paths):
+        shocks        = rng.standard_normal((self.n_steps,n_paths))
+        returns       = np.empty((self.n_steps,n_paths))
+        last_return   = np.full(n_paths,float(self.last_return))
+        residual      = np.full(n_paths,float(self.last_residual))
+        variance      = np.full(n_paths,float(self.last_variance))
+        for t in range(self.n_steps):
+            variance      = self.omega + self.alpha*residual**2 + self.beta*variance
+            residual      = variance**0.5*shocks[t]
+            last_return   = self.mu + self.phi*last_return + residual
+            returns[t]    = last_return
+        # Returns below -100% would give negative prices
+        return price_paths(self.price_0,np.maximum(returns,-0.99))
+
+########################################################
+# Synthetic swap flow
+# Each step has two swaps per path, the volume sold of token 0 and of token 1,
+# at the pool tick at the end of the step. The number of swaps of a step is
+# Poisson with mean swaps_per_step and their sizes exponential with mean
+# mean_swap_size (in token 0). Falling prices come with more token 0 sold,
+# direction_sensitivity sets how much. virtual_liquidity is the pool
+# liquidity, with lognormal noise of liquidity_volatility per step.
+########################################################
+
+class SwapFlow:
+    def __init__(self,swaps_per_step,mean_swap_size,virtual_liquidity,direction_sensitivity=1.0,liquidity_volatility=0.0):
+        self.swaps_per_step        = swaps_per_step
+        self.mean_swap_size        = mean_swap_size
+        self.virtual_liquidity     = virtual_liquidity
+        self.direction_sensitivity = direction_sensitivity
+        self.liquidity_volatility  = liquidity_volatility
+
+    def generate(self,rng,prices):
+
+        # Arrays with a row per step, a column per path and the token 0 and token 1 swaps
+        returns         = prices[1:]/prices[:-1] - 1
+        n_swaps         = rng.poisson(self.swaps_per_step,returns.shape)
+        volume          = np.where(n_swaps > 0,rng.gamma(np.maximum(n_swaps,1),self.mean_swap_size),0.0)
+        return_scale    = returns.std() if returns.std() > 0 else 1.0
+        share_token_0   = 1/(1 + np.exp(self.direction_sensitivity*returns/return_scale))
+
+        traded_in       = np.stack([volume*share_token_0,volume*(1 - share_token_0)*prices[1:]],axis=-1)
+        noise           = self.liquidity_volatility*rng.standard_normal(returns.shape)
+        liquidity       = self.virtual_liquidity*np.exp(noise - self.liquidity_volatility**2/2)
+        return traded_in,np.repeat(liquidity[:,:,None],2,axis=-1)
+
+########################################################
+# Timeline of a batch of paths, for BatchSimulator.simulate_batch
+# Configuration row r of the batch follows path columns[r]
+########################################################
+
+class PathTimeline:
+    def __init__(self,prices,traded_in,virtual_liquidity,columns,fee_tier,decimals_0,decimals_1,frequency='H',start=None):
+
+        self.fee_tier           = fee_tier
+        self.decimals_0         = decimals_0
+        self.decimals_1         = decimals_1
+        self.tickSpacing        = ActiveStrategyFramework.get_tick_spacing(fee_tier)
+        decimal_adjustment      = 10**(decimals_1 - decimals_0)
+        start                   = pd.Timestamp('2021-05-05',tz='UTC') if start is None else pd.Timestamp(start)
+
+        self.time               = list(pd.date_range(start,periods=len(prices),freq=ActiveStrategyFramework.SWAP_BUCKETS[frequency]))
+        self.time_ns            = ActiveStrategyFramework.datetime_index_ns(self.time)
+        self.columns            = np.asarray(columns)
+
+        TICK_P_PRE              = TickConversion.raw_ticks(prices,decimal_adjustment)
+        tick_current            = TickConversion.snap_ticks(TICK_P_PRE,1,'floor')
+        self.price              = prices[:,self.columns]
+        self.price_tick         = TickConversion.snap_ticks(TICK_P_PRE,self.tickSpacing,'floor')[:,self.columns]
+        self.price_tick_current = tick_current[:,self.columns]
+
+        # Swaps of step i are stored at i-1, per path
+        self.tick_swap          = np.repeat(tick_current[1:,:,None],2,axis=-1).astype(float)
+        self.traded_in          = traded_in
+        self.virtual_liquidity  = virtual_liquidity
+        self.token_0_in         = np.array([True,False])
+
+    def __len__(self):
+        return len(self.time)
+
+    def swaps_between(self,i):
+        return ActiveStrategyFramework.SwapColumns(self.tick_swap[i-1][self.columns],self.token_0_in,
+                                                   self.virtual_liquidity[i-1][self.columns],self.traded_in[i-1][self.columns])
+
+########################################################
+# Simulate every configuration of strategy_batch on n_paths paths
+########################################################
+
+def simulate_paths(path_model,swap_flow,strategy_batch,n_paths,seed,liquidity_in_0,liquidity_in_1,
+                   fee_tier,decimals_0,decimals_1,frequency='H',start=None):
+
+    # One batch of paths, metrics with a row per configuration and path
+    rng                 = np.random.default_rng(seed)
+    prices              = path_model.generate(rng,n_paths)
+    traded_in,liquidity = swap_flow.generate(rng,prices)
+
+    configurations      = np.repeat(np.arange(len(strategy_batch)),n_paths)
+    paths               = np.tile(np.arange(n_paths),len(strategy_batch))
+    timeline            = PathTimeline(prices,traded_in,liquidity,paths,fee_tier,decimals_0,decimals_1,frequency,start)
+    results             = BatchSimulator.simulate_batch(None,None,strategy_batch.take(configurations),liquidity_in_0,liquidity_in_1,
+                                                        fee_tier,decimals_0,decimals_1,timeline=timeline)
+
+    metrics             = results.analyze(frequency)
+    metrics.insert(0,'path',paths)
+    metrics.insert(0,'configuration',configurations)
+    return metrics
+
+def simulate_monte_carlo(path_model,swap_flow,strategy_batch,n_paths,liquidity_in_0,liquidity_in_1,fee_tier,decimals_0,decimals_1,
+                         frequency='H',paths_per_batch=100,seed=0,max_workers=None,start=None):
+
+    # Batches of paths_per_batch paths over a process pool (max_workers=1 runs them in this process)
+    sizes   = [min(paths_per_batch,n_paths - x) for x in range(0,n_paths,paths_per_batch)]
+    seeds   = np.random.SeedSequence(seed).spawn(len(sizes))
+    args    = [(path_model,swap_flow,strategy_batch,size,batch_seed,liquidity_in_0,liquidity_in_1,
+                fee_tier,decimals_0,decimals_1,frequency,start) for size,batch_seed in zip(sizes,seeds)]
+
+    if max_workers == 1:
+        batches = [simulate_paths(*x) for x in args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            batches = list(executor.map(simulate_paths,*zip(*args)))
+
+    # Paths numbered across batches
+    offsets = np.cumsum([0] + sizes[:-1])
+    for metrics,offset in zip(batches,offsets):
+        metrics['path'] += offset
+    return pd.concat(batches,ignore_index=True).sort_values(['configuration','path'],kind='stable').reset_index(drop=True)
+
+def metric_quantiles(metrics,quantiles=(0.05,0.5,0.95)):
+    # Distribution of every metric over the paths, a row per configuration and quantile
+    return metrics.drop(columns='path').groupby('configuration').quantile(list(quantiles))
@@ -0,0 +1,333 @@
+import numpy as np
+import math
+import functools
+import time
+import UNI_v3_funcs
+import ActiveStrategyFramework
+
+##############################################################
+# In-process Uniswap v3 pool
+#
+# Keeps the liquidity of every initialized tick (liquidityNet, liquidityGross)
+# and a tick bitmap like UniswapV3Pool, and executes swaps tick by tick,
+# crossing initialized ticks and updating the active liquidity, so that
+# replayed swaps and our own rebalancing swaps move the price as they would in
+# the pool. Amounts are in raw token units and the math is done in floats with
+# the sqrt prices of UNI_v3_funcs, liquidities are kept as python ints.
+#
+# Fee growth per unit of liquidity is tracked globally and outside of each
+# initialized tick, so that fee_growth_inside gives the fees earned by a range.
+##############################################################
+
+MIN_TICK       = -887272
+MAX_TICK       = -MIN_TICK
+Q96            = 2**96
+LOG_TICK_BASE  = math.log(1.0001)
+
+@functools.lru_cache(maxsize=None)
+def sqrt_price(tick):
+    # sqrt(token_1/token_0) in raw units at a tick
+    return UNI_v3_funcs.sqrt_price_x96(tick)/Q96
+
+MIN_SQRT_PRICE = sqrt_price(MIN_TICK)
+MAX_SQRT_PRICE = sqrt_price(MAX_TICK)
+
+def tick_at_sqrt_price(s):
+    # Greatest tick whose sqrt price is at most s
+    tick = min(max(math.floor(2*math.log(s)/LOG_TICK_BASE),MIN_TICK),MAX_TICK)
+    while tick < MAX_TICK and sqrt_price(tick+1) <= s:
+        tick += 1
+    while tick > MIN_TICK and sqrt_price(tick) > s:
+        tick -= 1
+    return tick
+
+class PoolEngine:
+    def __init__(self,fee_tier,sqrt_price_x96,tick_spacing=None):
+
+        self.fee_tier             = fee_tier
+        self.tick_spacing         = ActiveStrategyFramework.get_tick_spacing(fee_tier) if tick_spacing is None else tick_spacing
+        self.sqrt_price           = sqrt_price_x96/Q96
+        self.tick                 = tick_at_sqrt_price(self.sqrt_price)
+        self.liquidity            = 0
+
+        # Initialized ticks
+        self.liquidity_net        = dict()
+        self.liquidity_gross      = dict()
+        self.bitmap               = dict()
+        self.fee_growth_outside_0 = dict()
+        self.fee_growth_outside_1 = dict()
+
+        self.fee_growth_global_0  = 0.0
+        self.fee_growth_global_1  = 0.0
+
+    @classmethod
+    def from_price(cls,fee_tier,price,decimals_0,decimals_1,tick_spacing=None):
+        # price in token_1 per token_0, as in the price data of the simulations
+        return cls(fee_tier,math.sqrt(price*10**(decimals_1-decimals_0))*Q96,tick_spacing)
+
+    @property
+    def sqrt_price_x96(self):
+        return self.sqrt_price*Q96
+
+    ##############################################################
+    # Tick bitmap: one bit per multiple of tick_spacing, in words of 256 bits
+    ##############################################################
+
+    def flip_tick(self,tick):
+        compressed       = tick // self.tick_spacing
+        word,bit         = compressed >> 8,compressed & 255
+        self.bitmap[word] = self.bitmap.get(word,0) ^ (1 << bit)
+        if self.bitmap[word] == 0:
+            del self.bitmap[word]
+
+    def next_initialized_tick(self,tick,lte):
+
+        # Next initialized tick within the 256 bit word of tick (at or below tick when lte, above it otherwise),
+        # or the end of the word, as TickBitmap.nextInitializedTickWithinOneWord
+        compressed = tick // self.tick_spacing
+        if lte:
+            word,bit = compressed >> 8,compressed & 255
+            masked   = self.bitmap.get(word,0) & ((2 << bit) - 1)
+            if masked != 0:
+                return (compressed - (bit - (masked.bit_length() - 1)))*self.tick_spacing,True
+            return (compressed - bit)*self.tick_spacing,False
+        else:
+            compressed += 1
+            word,bit    = compressed >> 8,compressed & 255
+            masked      = self.bitmap.get(word,0) >> bit
+            if masked != 0:
+                return (compressed + ((masked & -masked).bit_length() - 1))*self.tick_spacing,True
+            return (compressed + (255 - bit))*self.tick_spacing,False
+
+    ##############################################################
+    # Mint (liquidity_delta > 0) and burn (< 0) of a range
+    # Returns the amounts paid into the pool (negative when paid out)
+    ##############################################################
+
+    def modify_liquidity(self,tick_lower,tick_upper,liquidity_delta):
+
+        if tick_lower >= tick_upper or tick_lower % self.tick_spacing != 0 or tick_upper % self.tick_spacing != 0:
+            raise ValueError('ticks must be increasing multiples of the tick spacing')
+        liquidity_delta = int(liquidity_delta)
+
+        self.update_tick(tick_lower,liquidity_delta,False)
+        self.update_tick(tick_upper,liquidity_delta,True)
+
+        sqrt_lower,sqrt_upper = UNI_v3_funcs.sqrt_price_x96(tick_lower),UNI_v3_funcs.sqrt_price_x96(tick_upper)
+        if self.tick < tick_lower:
+            return UNI_v3_funcs.get_amount0(sqrt_lower,sqrt_upper,liquidity_delta,0),0.0
+        elif self.tick < tick_upper:
+            self.liquidity += liquidity_delta
+            return (UNI_v3_funcs.get_amount0(self.sqrt_price_x96,sqrt_upper,liquidity_delta,0),
+                    UNI_v3_funcs.get_amount1(sqrt_lower,self.sqrt_price_x96,liquidity_delta,0))
+        else:
+            return 0.0,UNI_v3_funcs.get_amount1(sqrt_lower,sqrt_upper,liquidity_delta,0)
+
+    def update_tick(self,tick,liquidity_delta,upper):
+
+        gross_before = self.liquidity_gross.get(tick,0)
+        gross_after  = gross_before + liquidity_delta
+        if gross_after < 0:
+            raise ValueError('burning more liquidity than was minted at tick '+str(tick))
+
+        if gross_before == 0:
+            # By convention, all fee growth before a tick is initialized happened below it
+            self.fee_growth_outside_0[tick] = self.fee_growth_global_0 if tick <= self.tick else 0.0
+            self.fee_growth_outside_1[tick] = self.fee_growth_global_1 if tick <= self.tick else 0.0
+
+        self.liquidity_net[tick] = self.liquidity_net.get(tick,0) + (-liquidity_delta if upper else liquidity_delta)
+
+        if gross_after == 0:
+            for values in (self.liquidity_net,self.liquidity_gross,self.fee_growth_outside_0,self.fee_growth_outside_1):
+                del values[tick]
+        else:
+            self.liquidity_gross[tick] = gross_after
+        if (gross_before == 0) != (gross_after == 0):
+            self.flip_tick(tick)
+
+    ##############################################################
+    # Exact input swap of amount_in of token 0 (zero_for_one) or token 1,
+    # stopping at sqrt_price_limit_x96 if given
+    # With dry_run the pool is left unchanged, e.g. to quote the price impact of a rebalance
+    ##############################################################
+
+    def swap(self,zero_for_one,amount_in,sqrt_price_limit_x96=None,dry_run=False):
+
+        fee        = self.fee_tier
+        s          = self.sqrt_price
+        tick       = self.tick
+        liquidity  = self.liquidity
+        remaining  = float(amount_in)
+        amount_out = 0.0
+        fees_paid  = 0.0
+        fee_growth = self.fee_growth_global_0 if zero_for_one else self.fee_growth_global_1
+        crossed    = []
+
+        # As in Uniswap the limit stays strictly within the sqrt prices of MIN_TICK and MAX_TICK, so the
+        # current tick stays within [MIN_TICK, MAX_TICK - 1]
+        if sqrt_price_limit_x96 is None:
+            limit = math.nextafter(MIN_SQRT_PRICE,math.inf) if zero_for_one else math.nextafter(MAX_SQRT_PRICE,0.0)
+        else:
+            limit = sqrt_price_limit_x96/Q96
+        if (zero_for_one and limit >= s) or (not zero_for_one and limit <= s):
+            raise ValueError('sqrt_price_limit_x96 is on the wrong side of the current price')
+        if limit <= MIN_SQRT_PRICE or limit >= MAX_SQRT_PRICE:
+            raise ValueError('sqrt_price_limit_x96 is outside the sqrt prices of MIN_TICK and MAX_TICK')
+
+        while remaining > 0.0 and s != limit:
+
+            next_tick,initialized = self.next_initialized_tick(tick,zero_for_one)
+            next_tick             = min(max(next_tick,MIN_TICK),MAX_TICK)
+            s_next                = sqrt_price(next_tick)
+            s_target              = max(s_next,limit) if zero_for_one else min(s_next,limit)
+
+            if liquidity > 0:
+                L                  = float(liquidity)
+                remaining_less_fee = remaining*(1.0-fee)
+                amount_to_target   = L*(s-s_target)/(s*s_target) if zero_for_one else L*(s_target-s)
+                if remaining_less_fee >= amount_to_target:
+                    s_new      = s_target
+                    step_in    = amount_to_target
+                    step_fee   = step_in*fee/(1.0-fee)
+                    remaining -= step_in + step_fee
+                else:
+                    s_new      = L*s/(L + remaining_less_fee*s) if zero_for_one else s + remaining_less_fee/L
+                    s_new      = max(s_new,s_target) if zero_for_one else min(s_new,s_target)
+                    step_in    = remaining_less_fee
+                    step_fee   = remaining - remaining_less_fee
+                    remaining  = 0.0
+                amount_out += L*(s-s_new) if zero_for_one else L*(s_new-s)/(s*s_new)
+                fees_paid  += step_fee
+                fee_growth += step_fee/L
+            else:
+                s_new = s_target
+
+            if s_new == s_next:
+                if initialized:
+                    crossed.append((next_tick,fee_growth))
+                    net        = self.liquidity_net[next_tick]
+                    liquidity += -net if zero_for_one else net
+                tick = next_tick - 1 if zero_for_one else next_tick
+            elif s_new != s:
+                tick = tick_at_sqrt_price(s_new)
+            s = s_new
+
+        if not dry_run:
+            for crossed_tick,crossed_fee_growth in crossed:
+                # Fee growth outside a tick flips to the other side when it is crossed
+                growth_0 = crossed_fee_growth if zero_for_one else self.fee_growth_global_0
+                growth_1 = self.fee_growth_global_1 if zero_for_one else crossed_fee_growth
+                self.fee_growth_outside_0[crossed_tick] = growth_0 - self.fee_growth_outside_0[crossed_tick]
+                self.fee_growth_outside_1[crossed_tick] = growth_1 - self.fee_growth_outside_1[crossed_tick]
+            if zero_for_one:
+                self.fee_growth_global_0 = fee_growth
+            else:
+                self.fee_growth_global_1 = fee_growth
+            self.sqrt_price = s
+            self.tick       = min(max(tick,MIN_TICK),MAX_TICK - 1)
+            self.liquidity  = liquidity
+
+        return float(amount_in) - remaining,amount_out,fees_paid,s*Q96
+
+    ##############################################################
+    # Move the pool to a tick observed on chain (e.g. the tick of a Swap event),
+    # crossing the initialized ticks in between as the swap did
+    ##############################################################
+
+    def cross_to(self,tick,sqrt_price_x96=None):
+
+        liquidity = self.liquidity
+        crossed   = []
+        while self.tick < tick:
+            next_tick,initialized = self.next_initialized_tick(self.tick,False)
+            if next_tick > tick:
+                break
+            if initialized:
+                crossed.append(next_tick)
+                liquidity += self.liquidity_net[next_tick]
+            self.tick = next_tick
+        while self.tick > tick:
+            next_tick,initialized = self.next_initialized_tick(self.tick,True)
+            if next_tick <= tick:
+                break
+            if initialized:
+                crossed.append(next_tick)
+                liquidity -= self.liquidity_net[next_tick]
+            self.tick = next_tick - 1
+
+        for crossed_tick in crossed:
+            self.fee_growth_outside_0[crossed_tick] = self.fee_growth_global_0 - self.fee_growth_outside_0[crossed_tick]
+            self.fee_growth_outside_1[crossed_tick] = self.fee_growth_global_1 - self.fee_growth_outside_1[crossed_tick]
+        self.tick       = tick
+        self.liquidity  = liquidity
+        self.sqrt_price = sqrt_price(tick) if sqrt_price_x96 is None else sqrt_price_x96/Q96
+
+    def price_impact(self,zero_for_one,amount_in):
+        # Relative change of the price from swapping amount_in, without changing the pool
+        _,_,_,sqrt_price_x96 = self.swap(zero_for_one,amount_in,dry_run=True)
+        return (sqrt_price_x96/self.sqrt_price_x96)**2 - 1.0
+
+    ##############################################################
+    # Fees per unit of liquidity earned inside a range since its ticks were initialized
+    ##############################################################
+
+    def fee_growth_inside(self,tick_lower,tick_upper):
+
+        growth = []
+        for global_growth,outside in ((self.fee_growth_global_0,self.fee_growth_outside_0),(self.fee_growth_global_1,self.fee_growth_outside_1)):
+            below = outside[tick_lower] if self.tick >= tick_lower else global_growth - outside[tick_lower]
+            above = outside[tick_upper] if self.tick < tick_upper  else global_growth - outside[tick_upper]
+            growth.append(global_growth - below - above)
+        return growth[0],growth[1]
+
+##############################################################
+# Replay swaps with the signed raw amounts of the swap data (positive into the pool)
+# Returns the tick, sqrt price and active liquidity after each swap
+# Swaps are executed one by one in python: benchmark_replay measured about
+# 130,000 swaps per second (with 10-20% of them crossing initialized ticks),
+# e.g. around a minute and a half for 10 million swaps
+##############################################################
+
+def replay_swaps(pool,amount0,amount1):
+
+    amount0        = np.asarray(amount0,dtype=float)
+    amount1        = np.asarray(amount1,dtype=float)
+    ticks          = np.empty(len(amount0),dtype=np.int64)
+    sqrt_prices    = np.empty(len(amount0))
+    liquidity      = np.empty(len(amount0))
+
+    for i in range(len(amount0)):
+        zero_for_one = amount0[i] > 0
+        amount_in    = amount0[i] if zero_for_one else amount1[i]
+        if amount_in > 0:
+            pool.swap(zero_for_one,amount_in)
+        ticks[i]       = pool.tick
+        sqrt_prices[i] = pool.sqrt_price_x96
+        liquidity[i]   = pool.liquidity
+
+    return {'tick': ticks,'sqrt_price_x96': sqrt_prices,'liquidity': liquidity}
+
+##############################################################
+# Throughput of replay_swaps on a synthetic pool: n_positions random ranges
+# near the price and n_swaps swaps of random direction and size
+# Returns the swaps per second and the share of swaps that crossed an
+# initialized tick (changing the active liquidity)
+##############################################################
+
+def benchmark_replay(n_swaps=100000,n_positions=500,fee_tier=0.003,seed=0):
+
+    rng          = np.random.default_rng(seed)
+    pool         = PoolEngine(fee_tier,UNI_v3_funcs.sqrt_price_x96(0))
+    tick_lower   = rng.integers(-200,200,n_positions)*pool.tick_spacing
+    tick_upper   = tick_lower + rng.integers(1,50,n_positions)*pool.tick_spacing
+    for lower,upper in zip(tick_lower,tick_upper):
+        pool.modify_liquidity(int(lower),int(upper),10**18)
+
+    zero_for_one = rng.random(n_swaps) < 0.5
+    amount_in    = rng.exponential(1e16,n_swaps)
+    start        = time.perf_counter()
+    replayed     = replay_swaps(pool,np.where(zero_for_one,amount_in,-amount_in),np.where(zero_for_one,-amount_in,amount_in))
+    elapsed      = time.perf_counter() - start
+
+    return {'swaps_per_second' : n_swaps/elapsed,
+            'share_crossing'   : float(np.mean(np.diff(replayed['liquidity']) != 0))}
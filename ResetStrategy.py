@@ -1,11 +1,25 @@
 import pandas as pd
 import numpy as np
-import math
 from statsmodels.distributions.empirical_distribution import ECDF, monotone_fn_inverter
 import UNI_v3_funcs
+import TickConversion
+import ActiveStrategyFramework
+import BatchSimulator
+import JitKernels
+import itertools
 import copy
 
 class ResetStrategy:
+    # Columns written by record_components, see ActiveStrategyFramework.SimulationRecorder
+    simulation_columns = [('price',float),('reset_point',bool),('reset_reason',object),
+                          ('base_range_lower',float),('base_range_upper',float),('limit_range_lower',float),('limit_range_upper',float),
+                          ('reset_range_lower',float),('reset_range_upper',float),('price_at_reset',float)] + \
+                         ActiveStrategyFramework.POSITION_COLUMNS + \
+                         [('base_position_value_in_token_0',float),('limit_position_value_in_token_0',float)]
+    
+    # Columns that scale with the capital, see ActiveStrategyFramework.simulate_strategy_sharded
+    amount_columns     = [name for name,_ in ActiveStrategyFramework.POSITION_COLUMNS] + ['base_position_value_in_token_0','limit_position_value_in_token_0']
+    
     def __init__(self,model_data,alpha_param,tau_param,limit_parameter):
     
         self.alpha_param            = alpha_param
@@ -70,6 +84,22 @@ class ResetStrategy:
             return current_strat_obs.liquidity_ranges,current_strat_obs.strategy_info
             
             
+    #####################################
+    # Bounds within which check_strategy can not rebalance, 
+    # used by ActiveStrategyFramework.simulate_strategy_event_driven
+    #####################################
+    
+    def quiet_bounds(self,current_strat_obs):
+        
+        # The limit position only has both tokens (a condition for LIMIT_REBALANCE) 
+        # when the price is strictly inside its ticks
+        limit_lower = current_strat_obs.liquidity_ranges[1]['lower_bin_tick']
+        limit_upper = current_strat_obs.liquidity_ranges[1]['upper_bin_tick']
+        
+        return (current_strat_obs.strategy_info['reset_range_lower'],
+                current_strat_obs.strategy_info['reset_range_upper'],
+                [(min(limit_lower,limit_upper),max(limit_lower,limit_upper))])
+            
     def set_liquidity_ranges(self,current_strat_obs):
         
         ###########################################################
@@ -80,7 +110,7 @@ class ResetStrategy:
         if current_strat_obs.strategy_info is None:
             strategy_info_here = dict()
         else:
-            strategy_info_here = copy.deepcopy(current_strat_obs.strategy_info)
+            strategy_info_here = dict(current_strat_obs.strategy_info)
             
         strategy_info_here['reset_range_lower']     = (1 + self.inverse_ecdf((1 -      self.tau_param)/2))    * current_strat_obs.price
         strategy_info_here['reset_range_upper']     = (1 + self.inverse_ecdf( 1 - (1 - self.tau_param)/2))    * current_strat_obs.price
@@ -100,12 +130,12 @@ class ResetStrategy:
         total_token_1_amount = current_strat_obs.liquidity_in_1
                                     
         # Lower Range
-        TICK_A_PRE         = int(math.log(current_strat_obs.decimal_adjustment*base_range_lower,1.0001))
-        TICK_A             = int(round(TICK_A_PRE/current_strat_obs.tickSpacing)*current_strat_obs.tickSpacing)
+        TICK_A             = TickConversion.price_to_tick(base_range_lower,current_strat_obs.decimal_adjustment,current_strat_obs.tickSpacing,
+                                                          rounding='nearest',tick_rounding='truncate')
 
         # Upper Range
-        TICK_B_PRE        = int(math.log(current_strat_obs.decimal_adjustment*base_range_upper,1.0001))
-        TICK_B            = int(round(TICK_B_PRE/current_strat_obs.tickSpacing)*current_strat_obs.tickSpacing)
+        TICK_B            = TickConversion.price_to_tick(base_range_upper,current_strat_obs.decimal_adjustment,current_strat_obs.tickSpacing,
+                                                         rounding='nearest',tick_rounding='truncate')
         
         liquidity_placed_base         = int(UNI_v3_funcs.get_liquidity(current_strat_obs.price_tick,TICK_A,TICK_B,current_strat_obs.liquidity_in_0, \
                                                                        current_strat_obs.liquidity_in_1,current_strat_obs.decimals_0,current_strat_obs.decimals_1))
@@ -150,11 +180,11 @@ class ResetStrategy:
             limit_range_upper = current_strat_obs.price 
             
             
-        TICK_A_PRE         = int(math.log(current_strat_obs.decimal_adjustment*limit_range_lower,1.0001))
-        TICK_A             = int(round(TICK_A_PRE/current_strat_obs.tickSpacing)*current_strat_obs.tickSpacing)
+        TICK_A             = TickConversion.price_to_tick(limit_range_lower,current_strat_obs.decimal_adjustment,current_strat_obs.tickSpacing,
+                                                          rounding='nearest',tick_rounding='truncate')
 
-        TICK_B_PRE        = int(math.log(current_strat_obs.decimal_adjustment*limit_range_upper,1.0001))
-        TICK_B            = int(round(TICK_B_PRE/current_strat_obs.tickSpacing)*current_strat_obs.tickSpacing)
+        TICK_B            = TickConversion.price_to_tick(limit_range_upper,current_strat_obs.decimal_adjustment,current_strat_obs.tickSpacing,
+                                                         rounding='nearest',tick_rounding='truncate')
 
         liquidity_placed_limit        = int(UNI_v3_funcs.get_liquidity(current_strat_obs.price_tick,TICK_A,TICK_B, \
                                                                        limit_amount_0,limit_amount_1,current_strat_obs.decimals_0,current_strat_obs.decimals_1))
@@ -244,4 +274,235 @@ class ResetStrategy:
             this_data['base_position_value_in_token_0']    = strategy_observation.liquidity_ranges[0]['token_0'] + strategy_observation.liquidity_ranges[0]['token_1'] / this_data['price']
             this_data['limit_position_value_in_token_0']   = strategy_observation.liquidity_ranges[1]['token_0'] + strategy_observation.liquidity_ranges[1]['token_1'] / this_data['price']
              
-            return this_data
\ No newline at end of file
+            return this_data
+
+    ########################################################
+    # Record strategy parameters into simulation columns
+    ########################################################
+    def record_components(self,strategy_observation,columns,i):
+            
+            # General variables
+            columns['price'][i]                  = strategy_observation.price
+            columns['reset_point'][i]            = strategy_observation.reset_point
+            columns['reset_reason'][i]           = strategy_observation.reset_reason
+            
+            # Range Variables
+            columns['base_range_lower'][i]       = strategy_observation.liquidity_ranges[0]['lower_bin_price']
+            columns['base_range_upper'][i]       = strategy_observation.liquidity_ranges[0]['upper_bin_price']
+            columns['limit_range_lower'][i]      = strategy_observation.liquidity_ranges[1]['lower_bin_price']
+            columns['limit_range_upper'][i]      = strategy_observation.liquidity_ranges[1]['upper_bin_price']
+            columns['reset_range_lower'][i]      = strategy_observation.strategy_info['reset_range_lower']
+            columns['reset_range_upper'][i]      = strategy_observation.strategy_info['reset_range_upper']
+            columns['price_at_reset'][i]         = strategy_observation.liquidity_ranges[0]['price']
+            
+            # Fee, Asset and Value Variables
+            ActiveStrategyFramework.record_position_components(strategy_observation,columns,i)
+            
+            columns['base_position_value_in_token_0'][i]    = strategy_observation.liquidity_ranges[0]['token_0'] + strategy_observation.liquidity_ranges[0]['token_1'] / strategy_observation.price
+            columns['limit_position_value_in_token_0'][i]   = strategy_observation.liquidity_ranges[1]['token_0'] + strategy_observation.liquidity_ranges[1]['token_1'] / strategy_observation.price
+
+
+########################################################
+# ResetStrategy for K parameter sets at once, simulated in lockstep with 
+# BatchSimulator.simulate_batch. Each configuration follows the same rules as
+# ResetStrategy: range 0 is the base position and range 1 the limit position.
+########################################################
+class ResetStrategyBatch:
+    simulation_columns = ResetStrategy.simulation_columns
+    n_ranges           = 2
+    
+    def __init__(self,model_data,alpha_params,tau_params,limit_parameters):
+        
+        self.alpha_param             = np.asarray(alpha_params,dtype=float)
+        self.tau_param               = np.asarray(tau_params,dtype=float)
+        self.limit_parameter         = np.asarray(limit_parameters,dtype=float)
+        
+        ecdf                         = ECDF(model_data['price_return'].to_numpy())
+        self.inverse_ecdf            = monotone_fn_inverter(ecdf,np.linspace(model_data['price_return'].min(),model_data['price_return'].max(),1000),vectorized=False)
+        
+        # Range widths only depend on the parameters, relative to the price
+        self.reset_lower_factor      = 1 + self.inverse_ecdf((1 -      self.tau_param)/2)
+        self.reset_upper_factor      = 1 + self.inverse_ecdf( 1 - (1 - self.tau_param)/2)
+        self.base_lower_factor       = 1 + self.inverse_ecdf((1 -      self.alpha_param)/2)
+        self.base_upper_factor       = 1 + self.inverse_ecdf( 1 - (1 - self.alpha_param)/2)
+        
+    @classmethod
+    def from_grid(cls,model_data,alpha_params,tau_params,limit_parameters):
+        # Every combination, in itertools.product order
+        parameters = list(itertools.product(alpha_params,tau_params,limit_parameters))
+        return cls(model_data,[x[0] for x in parameters],[x[1] for x in parameters],[x[2] for x in parameters])
+    
+    def __len__(self):
+        return len(self.alpha_param)
+    
+    def parameters(self,k):
+        return {'alpha_param':self.alpha_param[k],'tau_param':self.tau_param[k],'limit_parameter':self.limit_parameter[k]}
+    
+    def take(self,rows):
+        # Batch with the configurations in rows, which can repeat (e.g. one copy per Monte Carlo path)
+        batch = copy.copy(self)
+        for name in ['alpha_param','tau_param','limit_parameter',
+                     'reset_lower_factor','reset_upper_factor','base_lower_factor','base_upper_factor']:
+            setattr(batch,name,getattr(self,name)[rows])
+        return batch
+    
+    #####################################
+    # Same rules as ResetStrategy.check_strategy
+    #####################################
+    
+    def check_strategy(self,state,timeline,i):
+        
+        price               = timeline.price[i]
+        
+        if JitKernels.ENABLED:
+            EXITED_RANGE,LIMIT_REBALANCE = reset_strategy_predicates(BatchSimulator.flat_floats(price,len(state)),
+                                                                     state.strategy_info['reset_range_lower'],state.strategy_info['reset_range_upper'],
+                                                                     state.token_0,state.token_1,self.limit_parameter)
+        else:
+            LEFT_RANGE_LOW      = price < state.strategy_info['reset_range_lower']
+            LEFT_RANGE_HIGH     = price > state.strategy_info['reset_range_upper']
+            LIMIT_ORDER_BALANCE = state.token_0[:,1] + state.token_1[:,1]*price
+            BASE_ORDER_BALANCE  = state.token_0[:,0] + state.token_1[:,0]*price
+            
+            # Rebalance out of limit when have both tokens in self.limit_parameter ratio
+            with np.errstate(divide='ignore',invalid='ignore'):
+                LIMIT_BOTH      = (state.token_0[:,1] > 0.0) & (state.token_1[:,1] > 0.0)
+                LIMIT_SIMILAR   = ((state.token_0[:,1]/state.token_1[:,1]) >= self.limit_parameter) | \
+                                  ((state.token_0[:,1]/state.token_1[:,1]) <= (self.limit_parameter+1))
+                LIMIT_REBALANCE = LIMIT_BOTH & np.where(BASE_ORDER_BALANCE > 0.0,
+                                                        ((LIMIT_ORDER_BALANCE/BASE_ORDER_BALANCE) > (1+self.limit_parameter)) & LIMIT_SIMILAR,
+                                                        LIMIT_SIMILAR)
+            
+            EXITED_RANGE        = LEFT_RANGE_LOW | LEFT_RANGE_HIGH
+        
+        rows                = np.flatnonzero((EXITED_RANGE | LIMIT_REBALANCE) & (state.failed_step < 0))
+        
+        if len(rows) > 0:
+            state.reset_point[rows]  = True
+            state.reset_reason[rows] = np.where(EXITED_RANGE[rows],'exited_range','limit_imbalance')
+            BatchSimulator.remove_liquidity(state,rows,timeline,i)
+            self.set_liquidity_ranges(state,rows,timeline,i)
+            
+    #####################################
+    # Same ranges as ResetStrategy.set_liquidity_ranges, for the configurations in rows
+    #####################################
+    
+    def set_liquidity_ranges(self,state,rows,timeline,i):
+        
+        price              = BatchSimulator.row_values(timeline.price[i],rows)
+        sqrt               = BatchSimulator.sqrt_prices_x96(BatchSimulator.row_values(timeline.price_tick[i],rows))
+        decimal_adjustment = 10**(timeline.decimals_1 - timeline.decimals_0)
+        tickSpacing        = timeline.tickSpacing
+        
+        def range_ticks(range_price):
+            return [int(x) for x in TickConversion.price_to_tick(range_price,decimal_adjustment,tickSpacing,rounding='nearest',tick_rounding='truncate')]
+        
+        for name in ['reset_range_lower','reset_range_upper']:
+            if name not in state.strategy_info:
+                state.strategy_info[name] = np.zeros(len(state))
+        state.strategy_info['reset_range_lower'][rows] = self.reset_lower_factor[rows] * price
+        state.strategy_info['reset_range_upper'][rows] = self.reset_upper_factor[rows] * price
+        
+        # Base range
+        base_range_lower     = self.base_lower_factor[rows] * price
+        base_range_upper     = self.base_upper_factor[rows] * price
+        
+        total_token_0_amount = state.liquidity_in_0[rows]
+        total_token_1_amount = state.liquidity_in_1[rows]
+        
+        state.set_range(rows,0,range_ticks(base_range_lower),range_ticks(base_range_upper))
+        liquidity_placed_base          = BatchSimulator.get_liquidity(sqrt,state.sqrt_lower[rows,0],state.sqrt_upper[rows,0],
+                                                                      total_token_0_amount,total_token_1_amount,timeline.decimals_0,timeline.decimals_1)
+        base_0_amount,base_1_amount    = BatchSimulator.get_amounts(sqrt,state.sqrt_lower[rows,0],state.sqrt_upper[rows,0],liquidity_placed_base,
+                                                                    timeline.decimals_0,timeline.decimals_1)
+        total_token_0_amount           = total_token_0_amount - base_0_amount
+        total_token_1_amount           = total_token_1_amount - base_1_amount
+        
+        state.lower_bin_price[rows,0]    = base_range_lower
+        state.upper_bin_price[rows,0]    = base_range_upper
+        state.range_price[rows,0]        = price
+        state.position_liquidity[rows,0] = liquidity_placed_base
+        state.token_0[rows,0]            = base_0_amount
+        state.token_1[rows,0]            = base_1_amount
+        
+        # Limit position, single sided with the token of highest value
+        place_token_0      = total_token_0_amount*price > total_token_1_amount
+        limit_amount_0     = np.where(place_token_0,total_token_0_amount,0.0)
+        limit_amount_1     = np.where(place_token_0,0.0,total_token_1_amount)
+        limit_range_lower  = np.where(place_token_0,price,base_range_lower)
+        limit_range_upper  = np.where(place_token_0,base_range_upper,price)
+        
+        state.set_range(rows,1,range_ticks(limit_range_lower),range_ticks(limit_range_upper))
+        liquidity_placed_limit         = BatchSimulator.get_liquidity(sqrt,state.sqrt_lower[rows,1],state.sqrt_upper[rows,1],
+                                                                      limit_amount_0,limit_amount_1,timeline.decimals_0,timeline.decimals_1)
+        limit_0_amount,limit_1_amount  = BatchSimulator.get_amounts(sqrt,state.sqrt_lower[rows,1],state.sqrt_upper[rows,1],liquidity_placed_limit,
+                                                                    timeline.decimals_0,timeline.decimals_1)
+        
+        state.lower_bin_price[rows,1]    = limit_range_lower
+        state.upper_bin_price[rows,1]    = limit_range_upper
+        state.range_price[rows,1]        = price
+        state.position_liquidity[rows,1] = liquidity_placed_limit
+        state.token_0[rows,1]            = limit_0_amount
+        state.token_1[rows,1]            = limit_1_amount
+        
+        total_token_0_amount             = total_token_0_amount - limit_0_amount
+        total_token_1_amount             = total_token_1_amount - limit_1_amount
+        
+        # Ranges without width can not hold liquidity
+        state.fail(rows[np.isnan(liquidity_placed_base) | np.isnan(liquidity_placed_limit)],i)
+        placed = state.failed_step[rows] < 0
+        
+        # Check we didn't allocate more liquidiqity than available
+        assert np.all(state.liquidity_in_0[rows][placed] >= total_token_0_amount[placed])
+        assert np.all(state.liquidity_in_1[rows][placed] >= total_token_1_amount[placed])
+        
+        state.token_0_left_over[rows] = np.maximum(total_token_0_amount,0.0)
+        state.token_1_left_over[rows] = np.maximum(total_token_1_amount,0.0)
+        state.liquidity_in_0[rows]    = 0.0
+        state.liquidity_in_1[rows]    = 0.0
+        
+    ########################################################
+    # Record strategy parameters into simulation columns, one column per configuration
+    ########################################################
+    def record_components(self,state,timeline,i,columns):
+        
+        price                                = timeline.price[i]
+        columns['price'][i]                  = price
+        columns['reset_point'][i]            = state.reset_point
+        columns['reset_reason'][i]           = state.reset_reason
+        
+        columns['base_range_lower'][i]       = state.lower_bin_price[:,0]
+        columns['base_range_upper'][i]       = state.upper_bin_price[:,0]
+        columns['limit_range_lower'][i]      = state.lower_bin_price[:,1]
+        columns['limit_range_upper'][i]      = state.upper_bin_price[:,1]
+        columns['reset_range_lower'][i]      = state.strategy_info['reset_range_lower']
+        columns['reset_range_upper'][i]      = state.strategy_info['reset_range_upper']
+        columns['price_at_reset'][i]         = state.range_price[:,0]
+        
+        BatchSimulator.record_position_components(state,price,columns,i)
+        
+        columns['base_position_value_in_token_0'][i]    = state.token_0[:,0] + state.token_1[:,0] / price
+        columns['limit_position_value_in_token_0'][i]   = state.token_0[:,1] + state.token_1[:,1] / price
+
+#####################################
+# ResetStrategyBatch.check_strategy rules for every configuration, compiled when numba is installed
+# price has the pool price of each configuration. Returns the configurations that exited their reset range and the ones whose limit order needs rebalancing
+#####################################
+
+@JitKernels.jit
+def reset_strategy_predicates(price,reset_range_lower,reset_range_upper,token_0,token_1,limit_parameter):
+    
+    exited_range    = np.zeros(len(limit_parameter),dtype=np.bool_)
+    limit_rebalance = np.zeros(len(limit_parameter),dtype=np.bool_)
+    for k in range(len(limit_parameter)):
+        exited_range[k]     = price[k] < reset_range_lower[k] or price[k] > reset_range_upper[k]
+        
+        LIMIT_ORDER_BALANCE = token_0[k,1] + token_1[k,1]*price[k]
+        BASE_ORDER_BALANCE  = token_0[k,0] + token_1[k,0]*price[k]
+        if token_0[k,1] > 0.0 and token_1[k,1] > 0.0:
+            LIMIT_SIMILAR   = (token_0[k,1]/token_1[k,1]) >= limit_parameter[k] or (token_0[k,1]/token_1[k,1]) <= (limit_parameter[k]+1)
+            if BASE_ORDER_BALANCE > 0.0:
+                limit_rebalance[k] = ((LIMIT_ORDER_BALANCE/BASE_ORDER_BALANCE) > (1+limit_parameter[k])) and LIMIT_SIMILAR
+            else:
+                limit_rebalance[k] = LIMIT_SIMILAR
+    return exited_range,limit_rebalance
@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+import ActiveStrategyFramework
+import BatchSimulator
+import TickConversion
+
+##############################################################
+# Passive positions on a grid of ranges
+#
+# Each range [lower_bin_tick, upper_bin_tick] is entered with the same capital
+# (in token 0) at entry_time, split between the tokens as the range requires
+# at the pool price, and held untouched until exit_time. Fees are looked up
+# in a FeeIndex.FeeIndex of the pool swaps (prefix sums over time and ticks),
+# so thousands of ranges cost a few array queries instead of one
+# simulate_strategy run each. As in the simulations, fees are earned on the
+# swaps between entry_time and exit_time, both included, and token amounts
+# are computed at the pool tick of the price.
+#
+# Impermanent loss is the value of the position at exit (without fees)
+# relative to holding the tokens deposited at entry.
+##############################################################
+
+def range_grid(center_ticks,widths,tick_spacing):
+
+    # Every combination of center and width (in ticks), lower ticks snapped down to the tick spacing
+    center_ticks,widths = np.meshgrid(np.asarray(center_ticks,dtype=np.int64),np.asarray(widths,dtype=np.int64))
+    widths              = TickConversion.snap_ticks(widths.ravel(),tick_spacing,'ceil')
+    lower_bin_tick      = TickConversion.snap_ticks(center_ticks.ravel() - widths/2,tick_spacing,'floor')
+    return pd.DataFrame({'center_tick'    : center_ticks.ravel(),
+                         'width'          : widths,
+                         'lower_bin_tick' : lower_bin_tick,
+                         'upper_bin_tick' : lower_bin_tick + widths})
+
+def times_ns(times):
+    return np.array([pd.Timestamp(x).value for x in times],dtype=np.int64)
+
+def price_at(price_data,time_ns):
+    # Last price at or before each time
+    position = np.searchsorted(ActiveStrategyFramework.datetime_index_ns(price_data.index),time_ns,side='right') - 1
+    if np.any(position < 0):
+        raise ValueError('price_data starts after an entry or exit time')
+    return price_data.to_numpy(dtype=float)[position]
+
+def backtest_ranges(fee_index,price_data,lower_bin_tick,upper_bin_tick,entry_time,exit_time,
+                    capital_in_token_0,decimals_0,decimals_1):
+
+    # entry_time and exit_time are a time or one time per range
+    lower_bin_tick     = np.asarray(lower_bin_tick,dtype=np.int64)
+    upper_bin_tick     = np.asarray(upper_bin_tick,dtype=np.int64)
+    n_ranges           = len(lower_bin_tick)
+    entry_time         = list(np.broadcast_to(np.asarray(entry_time,dtype=object),n_ranges))
+    exit_time          = list(np.broadcast_to(np.asarray(exit_time, dtype=object),n_ranges))
+    decimal_adjustment = 10**(decimals_1 - decimals_0)
+
+    if np.any(upper_bin_tick <= lower_bin_tick):
+        raise ValueError('ranges need upper_bin_tick > lower_bin_tick')
+    entry_ns           = times_ns(entry_time)
+    exit_ns            = times_ns(exit_time)
+    if np.any(exit_ns < entry_ns):
+        raise ValueError('exit_time is before entry_time')
+
+    sqrt_lower         = BatchSimulator.sqrt_prices_x96(lower_bin_tick)
+    sqrt_upper         = BatchSimulator.sqrt_prices_x96(upper_bin_tick)
+
+    def sqrt_prices(price):
+        ticks          = TickConversion.price_to_tick(price,decimal_adjustment)
+        return BatchSimulator.sqrt_prices_x96(ticks)
+
+    def amounts(sqrt,liquidity):
+        return BatchSimulator.get_amounts(sqrt,sqrt_lower,sqrt_upper,liquidity,decimals_0,decimals_1)
+
+    # Liquidity that the capital buys at entry
+    entry_price        = price_at(price_data,entry_ns)
+    exit_price         = price_at(price_data,exit_ns)
+    entry_sqrt         = sqrt_prices(entry_price)
+    exit_sqrt          = sqrt_prices(exit_price)
+    unit_0,unit_1      = amounts(entry_sqrt,np.ones(n_ranges))
+    position_liquidity = capital_in_token_0/(unit_0 + unit_1/entry_price)
+
+    token_0_entry,token_1_entry = amounts(entry_sqrt,position_liquidity)
+    token_0_exit,token_1_exit   = amounts(exit_sqrt,position_liquidity)
+
+    # Swaps between entry and exit, both included
+    starts             = np.searchsorted(fee_index.time_ns,entry_ns,side='left')
+    ends               = np.searchsorted(fee_index.time_ns,exit_ns, side='right')
+    token_0_fees,token_1_fees = fee_index.range_fees(starts,ends,lower_bin_tick,upper_bin_tick,position_liquidity)
+
+    value_hold         = token_0_entry + token_1_entry/exit_price
+    value_position     = token_0_exit  + token_1_exit /exit_price
+    value_fees         = token_0_fees  + token_1_fees /exit_price
+
+    return pd.DataFrame({'lower_bin_tick'            : lower_bin_tick,
+                         'upper_bin_tick'            : upper_bin_tick,
+                         'lower_bin_price'           : TickConversion.tick_to_price(lower_bin_tick,decimal_adjustment),
+                         'upper_bin_price'           : TickConversion.tick_to_price(upper_bin_tick,decimal_adjustment),
+                         'entry_time'                : entry_time,
+                         'exit_time'                 : exit_time,
+                         'entry_price'               : entry_price,
+                         'exit_price'                : exit_price,
+                         'position_liquidity'        : position_liquidity,
+                         'token_0_entry'             : token_0_entry,
+                         'token_1_entry'             : token_1_entry,
+                         'token_0_exit'              : token_0_exit,
+                         'token_1_exit'              : token_1_exit,
+                         'token_0_fees'              : token_0_fees,
+                         'token_1_fees'              : token_1_fees,
+                         'value_hold_in_token_0'     : value_hold,
+                         'value_position_in_token_0' : value_position,
+                         'value_fees_in_token_0'     : value_fees,
+                         'value_final_in_token_0'    : value_position + value_fees,
+                         'impermanent_loss'          : value_position/value_hold - 1,
+                         'fee_return'                : value_fees/capital_in_token_0,
+                         'net_return'                : (value_position + value_fees)/capital_in_token_0 - 1})
+
+def backtest_grid(fee_index,price_data,center_ticks,widths,entry_time,exit_time,capital_in_token_0,decimals_0,decimals_1):
+    grid    = range_grid(center_ticks,widths,ActiveStrategyFramework.get_tick_spacing(fee_index.fee_tier))
+    results = backtest_ranges(fee_index,price_data,grid['lower_bin_tick'],grid['upper_bin_tick'],entry_time,exit_time,
+                              capital_in_token_0,decimals_0,decimals_1)
+    results.insert(0,'width',grid['width'].to_numpy())
+    results.insert(0,'center_tick',grid['center_tick'].to_numpy())
+    return results
+
+def surface(results,value='net_return'):
+    # Widths as rows and centers as columns
+    return results.pivot_table(index='width',columns='center_tick',values=value)
@@ -0,0 +1,308 @@
+import pandas as pd
+import numpy as np
+import pickle
+import os
+import scipy.signal
+import GetPoolData
+
+##############################################################
+# Synthetic pool data, written in the schemas of GetPoolData
+#
+# Generates the swaps of a pool and its minute price data without any
+# network access, to test the simulator, aggregators and loaders at any size.
+# Swaps are written as GetPoolData.get_pool_data_bigquery or
+# get_pool_data_flipside return them (the raw rows go through the same
+# preprocessing), and prices as get_price_data_bitquery returns them.
+#
+# Prices follow a price process sampled every minute, swaps arrive as a
+# Poisson process between those prices with lognormal sizes, and the pool
+# liquidity switches between regimes. Swaps land in blocks of block_seconds
+# with increasing log indices, and the token swapped in has a negative
+# amount, as the framework reads the downloaded data.
+#
+# Data is generated in files of about rows_per_file swaps, in ./data/,
+# carrying the state of the processes from one file to the next, so memory
+# only depends on rows_per_file. Each file draws from its own seed, so an
+# interrupted run resumes after its last file with the same results.
+##############################################################
+
+########################################################
+# Price processes, log prices of the next n_minutes minutes after log_price
+########################################################
+
+class GBMProcess:
+    def __init__(self,volatility,drift=0.0):
+        # volatility and drift of the log price per minute
+        self.volatility = volatility
+        self.drift      = drift
+
+    def simulate(self,rng,log_price,n_minutes):
+        steps = (self.drift - self.volatility**2/2) + self.volatility*rng.standard_normal(n_minutes)
+        return log_price + np.cumsum(steps)
+
+class JumpDiffusionProcess(GBMProcess):
+    def __init__(self,volatility,jump_rate,jump_size,drift=0.0):
+        # jump_rate jumps per minute, with normal log price changes of standard deviation jump_size
+        super().__init__(volatility,drift)
+        self.jump_rate = jump_rate
+        self.jump_size = jump_size
+
+    def simulate(self,rng,log_price,n_minutes):
+        n_jumps = rng.poisson(self.jump_rate,n_minutes)
+        jumps   = self.jump_size*np.sqrt(n_jumps)*rng.standard_normal(n_minutes)
+        return super().simulate(rng,log_price,n_minutes) + np.cumsum(jumps)
+
+class MeanRevertingProcess:
+    def __init__(self,volatility,mean_price,half_life_minutes):
+        # Log price reverts to log(mean_price), halving its distance every half_life_minutes
+        self.volatility  = volatility
+        self.log_mean    = np.log(mean_price)
+        self.persistence = 0.5**(1/half_life_minutes)
+
+    def simulate(self,rng,log_price,n_minutes):
+        shocks        = self.volatility*rng.standard_normal(n_minutes)
+        deviation,_   = scipy.signal.lfilter([1.0],[1.0,-self.persistence],shocks,zi=[self.persistence*(log_price - self.log_mean)])
+        return self.log_mean + deviation
+
+########################################################
+# Liquidity regimes
+# The pool liquidity (raw, as the swap events report it) stays at one of
+# levels for an exponential time of mean mean_duration_minutes, then moves
+# to another one. Every swap has lognormal noise of standard deviation noise
+# around its level, and a share empty_share of the swaps find no liquidity.
+########################################################
+
+class LiquidityRegimes:
+    def __init__(self,levels,mean_duration_minutes=np.inf,noise=0.0,empty_share=0.0):
+        self.levels                = np.asarray(levels,dtype=float)
+        self.mean_duration_minutes = mean_duration_minutes
+        self.noise                 = noise
+        self.empty_share           = empty_share
+
+    def initial_state(self):
+        # (regime, minutes left in it), drawn on the first call of simulate
+        return (0,None)
+
+    def duration(self,rng):
+        if np.isinf(self.mean_duration_minutes):
+            return np.inf
+        return rng.exponential(self.mean_duration_minutes)
+
+    def simulate(self,rng,state,n_minutes):
+
+        # Regime of each minute, and the state after them
+        regime,minutes_left = state
+        if minutes_left is None:
+            minutes_left = self.duration(rng)
+        regimes = np.empty(n_minutes,dtype=np.int64)
+        start   = 0
+        while start < n_minutes:
+            end             = n_minutes if minutes_left >= n_minutes - start else start + int(np.ceil(minutes_left))
+            regimes[start:end] = regime
+            minutes_left   -= end - start
+            start           = end
+            if minutes_left <= 0:
+                if len(self.levels) > 1:
+                    regime  = (regime + rng.integers(1,len(self.levels))) % len(self.levels)
+                minutes_left = self.duration(rng)
+        return self.levels[regimes],(regime,minutes_left)
+
+    def swap_liquidity(self,rng,level):
+        liquidity = level*np.exp(self.noise*rng.standard_normal(len(level)) - self.noise**2/2)
+        return np.where(rng.random(len(level)) < self.empty_share,0.0,liquidity)
+
+########################################################
+# Generate the data of a pool between two dates
+########################################################
+
+def write_synthetic_pool_data(file_name,date_begin,date_end,price_0,decimals_0,decimals_1,fee_tier,price_process,liquidity,
+                              swaps_per_minute=1.0,mean_swap_size=1.0,swap_size_sigma=1.0,direction_sensitivity=1.0,schema='bigquery',
+                              rows_per_file=1000000,seed=0,token_0_symbol='TOKEN0',token_1_symbol='TOKEN1',token_0_usd=1.0,
+                              pool_address='0x0000000000000000000000000000000000000000',block_start=12370000,block_seconds=12,resume=True):
+    """
+    Writes synthetic swaps (schema 'bigquery' or 'flipside') and minute prices of a pool between date_begin and date_end to
+    ./data/file_name_synthetic_*.pkl, in files of about rows_per_file swaps. Prices start at price_0 (token 1 per token 0)
+    and follow price_process, liquidity is a LiquidityRegimes. Swap sizes are lognormal with mean mean_swap_size (in token 0),
+    and falling prices come with more token 0 swapped in, direction_sensitivity sets how much. Returns the list of files.
+    """
+
+    if schema not in ['bigquery','flipside']:
+        raise ValueError('schema must be bigquery or flipside')
+
+    date_begin       = pd.Timestamp(date_begin,tz='UTC') if pd.Timestamp(date_begin).tz is None else pd.Timestamp(date_begin)
+    date_end         = pd.Timestamp(date_end,tz='UTC')   if pd.Timestamp(date_end).tz   is None else pd.Timestamp(date_end)
+    n_minutes        = int((date_end - date_begin)/pd.Timedelta('1min'))
+    minutes_per_file = max(1,int(rows_per_file/swaps_per_minute))
+
+    state_file = './data/'+file_name+'_synthetic_state.pkl'
+    if resume and os.path.exists(state_file):
+        with open(state_file, 'rb') as input:
+            state = pickle.load(input)
+    else:
+        state = {'minute'         : 0,
+                 'log_price'      : np.log(price_0),
+                 'liquidity'      : liquidity.initial_state(),
+                 'n_swaps'        : 0,
+                 'last_block'     : -1,
+                 'last_log_index' : -1,
+                 'last_stats'     : None,
+                 'files'          : []}
+
+    while state['minute'] < n_minutes:
+        rng             = np.random.default_rng([seed,len(state['files'])])
+        minutes         = min(minutes_per_file,n_minutes - state['minute'])
+        minute_ns       = date_begin.value + (state['minute'] + np.arange(minutes + 1,dtype=np.int64))*60*10**9
+
+        # Log prices at the start of every minute, the last one starts the next file
+        log_prices      = np.concatenate([[state['log_price']],price_process.simulate(rng,state['log_price'],minutes)])
+        level,liquidity_state = liquidity.simulate(rng,state['liquidity'],minutes)
+
+        # Swaps between the prices at the start and the end of their minute
+        swap_minute     = np.repeat(np.arange(minutes),rng.poisson(swaps_per_minute,minutes))
+        fraction        = np.sort(swap_minute + rng.random(len(swap_minute))) - swap_minute
+        swap_ns         = minute_ns[swap_minute] + (fraction*60*10**9).astype(np.int64)
+        log_price_swap  = log_prices[swap_minute] + fraction*(log_prices[swap_minute+1] - log_prices[swap_minute])
+        price_swap      = np.exp(log_price_swap)
+
+        minute_returns  = np.diff(log_prices)
+        return_scale    = minute_returns.std() if minutes > 1 and minute_returns.std() > 0 else 1.0
+        token_0_in      = rng.random(len(swap_minute)) < 1/(1 + np.exp(direction_sensitivity*minute_returns[swap_minute]/return_scale))
+        size            = rng.lognormal(np.log(mean_swap_size) - swap_size_sigma**2/2,swap_size_sigma,len(swap_minute))
+        amount0_adj     = np.where(token_0_in,-size,size*(1 - fee_tier))
+        amount1_adj     = np.where(token_0_in,size*price_swap*(1 - fee_tier),-size*price_swap)
+
+        swaps = {'time_ns'     : swap_ns,
+                 'price'       : price_swap,
+                 'tick'        : np.floor((log_price_swap + np.log(10**(decimals_1 - decimals_0)))/np.log(1.0001)).astype(np.int64),
+                 'liquidity'   : liquidity.swap_liquidity(rng,level[swap_minute]),
+                 'amount0_adj' : amount0_adj,
+                 'amount1_adj' : amount1_adj}
+        swaps.update(swap_blocks(swap_ns,date_begin.value,block_start,block_seconds,state))
+
+        if schema == 'bigquery':
+            swap_data = bigquery_swaps(swaps,decimals_0,decimals_1,pool_address,state['n_swaps'])
+        else:
+            swap_data,state['last_stats'] = flipside_swaps(swaps,decimals_0,decimals_1,pool_address,token_0_usd,state['n_swaps'],state['last_stats'])
+        price_data      = bitquery_prices(swaps,token_0_symbol,token_1_symbol,token_0_usd)
+
+        state['minute']         += minutes
+        state['log_price']       = log_prices[-1]
+        state['liquidity']       = liquidity_state
+        state['n_swaps']        += len(swap_ns)
+        save_synthetic(file_name,state,swap_data,price_data)
+
+    return state['files']
+
+def swap_blocks(swap_ns,start_ns,block_start,block_seconds,state):
+
+    # Block of every swap and its log index within the block, continuing the previous file
+    block_number    = block_start + (swap_ns - start_ns)//(block_seconds*10**9)
+    first_of_block  = np.r_[True,block_number[1:] != block_number[:-1]] if len(block_number) > 0 else np.zeros(0,dtype=bool)
+    block_offset    = np.flatnonzero(first_of_block)
+    log_index       = np.arange(len(block_number)) - np.repeat(block_offset,np.diff(np.r_[block_offset,len(block_number)]))
+    log_index       = np.where(block_number == state['last_block'],log_index + state['last_log_index'] + 1,log_index)
+    if len(block_number) > 0:
+        state['last_block']     = int(block_number[-1])
+        state['last_log_index'] = int(log_index[-1])
+    return {'block_number'    : block_number,
+            'block_timestamp' : pd.to_datetime(start_ns + (block_number - block_start)*block_seconds*10**9,utc=True),
+            'log_index'       : log_index}
+
+def transaction_hashes(first,n):
+    return np.char.mod('0x%064x',first + np.arange(n))
+
+def bigquery_swaps(swaps,decimals_0,decimals_1,pool_address,first_swap):
+
+    # Rows of blockchain-etl's UniswapV3Pool_event_Swap, with integer values as strings
+    sqrt_price_x96 = np.sqrt(swaps['price']*10**(decimals_1 - decimals_0))*2**96
+    raw_data       = pd.DataFrame({'block_timestamp'  : swaps['block_timestamp'],
+                                   'block_number'     : swaps['block_number'],
+                                   'transaction_hash' : transaction_hashes(first_swap,len(sqrt_price_x96)),
+                                   'log_index'        : swaps['log_index'],
+                                   'contract_address' : pool_address,
+                                   'sender'           : pool_address,
+                                   'recipient'        : pool_address,
+                                   'amount0'          : np.char.mod('%.0f',np.trunc(swaps['amount0_adj']*10**decimals_0)),
+                                   'amount1'          : np.char.mod('%.0f',np.trunc(swaps['amount1_adj']*10**decimals_1)),
+                                   'sqrtPriceX96'     : np.char.mod('%.0f',np.trunc(sqrt_price_x96)),
+                                   'liquidity'        : np.char.mod('%.0f',np.trunc(swaps['liquidity'])),
+                                   'tick'             : swaps['tick'].astype(str)})
+    return GetPoolData.preprocess_bigquery_swaps(raw_data,decimals_0,decimals_1)
+
+def flipside_swaps(swaps,decimals_0,decimals_1,pool_address,token_0_usd,first_swap,last_stats):
+
+    # Subgraph swaps (amounts in human units, values as strings) and Flipside pool stats at the last swap of every block
+    hashes     = transaction_hashes(first_swap,len(swaps['tick']))
+    swap_data  = pd.DataFrame({'id'        : np.char.add(np.char.add(hashes,'#'),swaps['log_index'].astype(str)),
+                               'timestamp' : (swaps['block_timestamp'].asi8//10**9).astype(str),
+                               'tick'      : swaps['tick'].astype(str),
+                               'amount0'   : np.char.mod('%.17g',swaps['amount0_adj']),
+                               'amount1'   : np.char.mod('%.17g',swaps['amount1_adj']),
+                               'amountUSD' : np.char.mod('%.17g',np.abs(swaps['amount0_adj'])*token_0_usd)})
+
+    last_swap  = np.r_[swaps['block_number'][1:] != swaps['block_number'][:-1],True] if len(hashes) > 0 else np.zeros(0,dtype=bool)
+    stats_data = pd.DataFrame({'BLOCK_ID'                   : swaps['block_number'][last_swap],
+                               'BLOCK_TIMESTAMP'            : swaps['block_timestamp'][last_swap].strftime('%Y-%m-%d %H:%M:%S.000'),
+                               'POOL_ADDRESS'               : pool_address,
+                               'PRICE_0_1'                  : 1/swaps['price'][last_swap],
+                               'PRICE_1_0'                  : swaps['price'][last_swap],
+                               'TICK'                       : swaps['tick'][last_swap],
+                               'VIRTUAL_LIQUIDITY_ADJUSTED' : swaps['liquidity'][last_swap]/10**((decimals_0 + decimals_1)/2)})
+
+    # The first swaps of the file see the stats of the previous file
+    all_stats  = stats_data if last_stats is None else pd.concat([last_stats,stats_data],ignore_index=True)
+    if len(all_stats) > 0:
+        last_stats = all_stats.tail(1).copy()
+    return GetPoolData.preprocess_flipside_swaps(swap_data,all_stats),last_stats
+
+def bitquery_prices(swaps,token_0_symbol,token_1_symbol,token_0_usd):
+
+    # Minute bars with the last swap price of the minutes that had swaps, as Bitquery's dexTrades
+    minute      = pd.to_datetime(swaps['time_ns'],utc=True).floor('min')
+    trades      = pd.DataFrame({'quoteAmount' : np.abs(swaps['amount1_adj']),
+                                'baseAmount'  : np.abs(swaps['amount0_adj']),
+                                'quotePrice'  : swaps['price']},index=minute)
+    price_data  = trades.groupby(level=0).agg({'quoteAmount':'sum','baseAmount':'sum','quotePrice':'last'})
+    price_data.index.name     = 'time_pd'
+    price_data['tradeAmount'] = price_data['baseAmount']*token_0_usd
+    price_data.insert(0,'quoteCurrency',token_1_symbol)
+    price_data.insert(0,'baseCurrency',token_0_symbol)
+    price_data.insert(0,'time',price_data.index.tz_localize(None))
+    return price_data[['time','baseCurrency','quoteCurrency','quoteAmount','baseAmount','tradeAmount','quotePrice']]
+
+def save_synthetic(file_name,state,swap_data,price_data):
+
+    # As GetPoolData.save_replay, the state is replaced after the files are written
+    files = (file_name+'_synthetic_swap_{:06d}.pkl'.format(len(state['files'])),
+             file_name+'_synthetic_price_{:06d}.pkl'.format(len(state['files'])))
+    for data,data_file in zip([swap_data,price_data],files):
+        with open('./data/'+data_file, 'wb') as output:
+            pickle.dump(data, output, pickle.HIGHEST_PROTOCOL)
+    state['files'] = state['files'] + [files]
+
+    with open('./data/'+file_name+'_synthetic_state.pkl.tmp', 'wb') as output:
+        pickle.dump(state, output, pickle.HIGHEST_PROTOCOL)
+    os.replace('./data/'+file_name+'_synthetic_state.pkl.tmp','./data/'+file_name+'_synthetic_state.pkl')
+
+########################################################
+# Read the data back
+########################################################
+
+def get_synthetic_chunks(file_name,data='swap'):
+    """
+    Reads the swaps (data='swap') or prices (data='price') written by write_synthetic_pool_data one file at a time,
+    e.g. as the swap_chunks of ActiveStrategyFramework.simulate_strategy_stream (bigquery schema).
+    """
+
+    with open('./data/'+file_name+'_synthetic_state.pkl', 'rb') as input:
+        files = pickle.load(input)['files']
+
+    for synthetic_files in files:
+        with open('./data/'+synthetic_files[0 if data == 'swap' else 1], 'rb') as input:
+            yield pickle.load(input)
+
+def get_synthetic_pool_data(file_name):
+    """
+    All the swaps and prices written by write_synthetic_pool_data.
+    """
+    return pd.concat(list(get_synthetic_chunks(file_name,'swap'))),pd.concat(list(get_synthetic_chunks(file_name,'price')))
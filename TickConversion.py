@@ -0,0 +1,74 @@
+import numpy as np
+import math
+import functools
+
+##############################################################
+# Conversions between prices and ticks, shared by the framework and the strategies
+#
+# Prices are token_1 per token_0 in human units, decimal_adjustment is
+# 10**(decimals_1 - decimals_0). Every function takes a scalar or an array
+# (a price series, a grid of ranges) and returns the same shape, python ints
+# for scalars. Logarithms and powers are computed with python's math per
+# distinct value, so ticks are identical to the scalar formulas used so far
+# (numpy's log and power can differ in the last bit).
+#
+# Rounding modes:
+#   'floor'    towards -inf
+#   'ceil'     towards +inf
+#   'truncate' towards 0, like int()
+#   'nearest'  to the nearest, ties to even, like round()
+##############################################################
+
+ROUNDING_MODES = {'floor'    : np.floor,
+                  'ceil'     : np.ceil,
+                  'truncate' : np.trunc,
+                  'nearest'  : np.rint}
+
+# Tick of the smallest price the framework places ranges at (2**-128)
+MIN_PRICE_TICK = math.log(2**-128,1.0001)
+
+@functools.lru_cache(maxsize=2**16)
+def raw_tick(price,decimal_adjustment):
+    return math.log(decimal_adjustment*price,1.0001)
+
+def raw_ticks(prices,decimal_adjustment):
+
+    # Fractional ticks of the prices, the log is computed once per distinct price
+    if np.ndim(prices) == 0:
+        return raw_tick(prices,decimal_adjustment)
+    prices         = np.asarray(prices,dtype=float)
+    unique,inverse = np.unique(prices,return_inverse=True)
+    return np.array([raw_tick(x,decimal_adjustment) for x in unique])[inverse].reshape(prices.shape)
+
+def snap_ticks(ticks,tick_spacing=1,rounding='floor'):
+
+    # Multiples of tick_spacing, rounding ticks/tick_spacing with the given mode
+    if rounding not in ROUNDING_MODES:
+        raise ValueError('rounding must be one of '+', '.join(ROUNDING_MODES))
+    values = np.asarray(ticks,dtype=float)
+    if not np.all(np.isfinite(values)):
+        raise ValueError('cannot convert non finite ticks to integer ticks')
+    snapped = ROUNDING_MODES[rounding](values/tick_spacing).astype(np.int64)*tick_spacing
+    if np.ndim(ticks) == 0:
+        return int(snapped)
+    return snapped
+
+def price_to_tick(prices,decimal_adjustment,tick_spacing=1,rounding='floor',tick_rounding=None):
+
+    # tick_rounding first rounds the fractional ticks to integer ticks,
+    # which are then snapped to tick_spacing with rounding
+    ticks = raw_ticks(prices,decimal_adjustment)
+    if tick_rounding is not None:
+        ticks = snap_ticks(ticks,1,tick_rounding)
+    return snap_ticks(ticks,tick_spacing,rounding)
+
+def tick_to_price(ticks,decimal_adjustment):
+    if np.ndim(ticks) == 0:
+        return 1.0001**int(ticks)/decimal_adjustment
+    ticks          = np.asarray(ticks,dtype=np.int64)
+    unique,inverse = np.unique(ticks,return_inverse=True)
+    return np.array([1.0001**int(x)/decimal_adjustment for x in unique])[inverse].reshape(ticks.shape)
+
+def min_usable_tick(tick_spacing):
+    # Lowest tick of a range when its price is not positive
+    return snap_ticks(MIN_PRICE_TICK,tick_spacing,'ceil')
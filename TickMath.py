@@ -0,0 +1,270 @@
+import numpy as np
+import functools
+
+##############################################################
+# Exact integer port of Uniswap v3's TickMath, SqrtPriceMath and
+# LiquidityAmounts libraries
+#
+# UNI_v3_funcs computes sqrt prices as int(1.0001**(tick/2)*2**96) and amounts
+# in floats, which is fast and close enough for backtests. The functions here
+# follow the contracts step by step with python ints, giving the same sqrt
+# ratios, liquidities and token amounts (in raw token units) as the pool, e.g.
+# to reconcile simulated positions with live ones.
+##############################################################
+
+MIN_TICK        = -887272
+MAX_TICK        = -MIN_TICK
+MIN_SQRT_RATIO  = 4295128739
+MAX_SQRT_RATIO  = 1461446703485210103287273052203988822378723970342
+Q96             = 2**96
+MAX_UINT256     = 2**256 - 1
+
+# ratio multipliers of TickMath.getSqrtRatioAtTick for the bits of abs(tick) from 0x2
+TICK_BIT_RATIOS = [0xfff97272373d413259a46990580e213a,
+                   0xfff2e50f5f656932ef12357cf3c7fdcc,
+                   0xffe5caca7e10e4e61c3624eaa0941cd0,
+                   0xffcb9843d60f6159c9db58835c926644,
+                   0xff973b41fa98c081472e6896dfb254c0,
+                   0xff2ea16466c96a3843ec78b326b52861,
+                   0xfe5dee046a99a2a811c461f1969c3053,
+                   0xfcbe86c7900a88aedcffc83b479aa3a4,
+                   0xf987a7253ac413176f2b074cf7815e54,
+                   0xf3392b0822b70005940c7a398e4b70f3,
+                   0xe7159475a2c29b7443b29c7fa6e889d9,
+                   0xd097f3bdfd2022b8845ad8f792aa5825,
+                   0xa9f746462d870fdf8a65dc1f90e061e5,
+                   0x70d869a156d2a1b890bb3df62baf32f7,
+                   0x31be135f97d08fd981231505542fcfa6,
+                   0x9aa508b5b7a84e1c677de54f3e99bc9,
+                   0x5d6af8dedb81196699c329225ee604,
+                   0x2216e584f5fa1ea926041bedfe98,
+                   0x48a170391f7dc42444e8fa2]
+
+##############################################################
+# FullMath
+##############################################################
+
+def mul_div(a,b,denominator):
+    # floor(a*b/denominator)
+    if denominator == 0:
+        raise ZeroDivisionError('mul_div by zero')
+    return (a*b) // denominator
+
+def mul_div_rounding_up(a,b,denominator):
+    result = mul_div(a,b,denominator)
+    if (a*b) % denominator > 0:
+        result += 1
+    return result
+
+def div_rounding_up(x,y):
+    return x // y + (1 if x % y > 0 else 0)
+
+def to_uint128(x):
+    if x >= 2**128:
+        raise OverflowError('liquidity does not fit in uint128')
+    return x
+
+##############################################################
+# TickMath
+##############################################################
+
+@functools.lru_cache(maxsize=65536)
+def get_sqrt_ratio_at_tick(tick):
+
+    tick     = int(tick)
+    abs_tick = abs(tick)
+    if abs_tick > MAX_TICK:
+        raise ValueError('tick out of range: '+str(tick))
+
+    ratio = 0xfffcb933bd6fad37aa2d162d1a594001 if abs_tick & 0x1 != 0 else 0x100000000000000000000000000000000
+    for bit,multiplier in enumerate(TICK_BIT_RATIOS,1):
+        if abs_tick & (1 << bit) != 0:
+            ratio = (ratio * multiplier) >> 128
+
+    if tick > 0:
+        ratio = MAX_UINT256 // ratio
+
+    # Q128.128 to Q64.96, rounding up
+    return (ratio >> 32) + (0 if ratio % (1 << 32) == 0 else 1)
+
+def get_tick_at_sqrt_ratio(sqrt_price_x96):
+
+    # Greatest tick whose sqrt ratio is at most sqrt_price_x96, as TickMath.getTickAtSqrtRatio
+    if sqrt_price_x96 < MIN_SQRT_RATIO or sqrt_price_x96 >= MAX_SQRT_RATIO:
+        raise ValueError('sqrt ratio out of range: '+str(sqrt_price_x96))
+
+    low,high = MIN_TICK,MAX_TICK
+    while low < high:
+        middle = (low + high + 1) // 2
+        if get_sqrt_ratio_at_tick(middle) <= sqrt_price_x96:
+            low  = middle
+        else:
+            high = middle - 1
+    return low
+
+##############################################################
+# Table of the sqrt ratios of the ticks a pool uses
+# Ratios take up to 160 bits, they are stored as three 64 bit limbs
+# together with their float64 value for the fast path.
+##############################################################
+
+class SqrtRatioTable:
+    def __init__(self,ticks):
+
+        self.ticks   = np.unique(np.asarray(ticks,dtype=np.int64))
+        ratios       = [get_sqrt_ratio_at_tick(int(tick)) for tick in self.ticks]
+        mask         = (1 << 64) - 1
+        self.limbs   = np.array([[x & mask,(x >> 64) & mask,x >> 128] for x in ratios],dtype=np.uint64).reshape(-1,3)
+        self.floats  = np.array([float(x) for x in ratios])
+
+    @classmethod
+    def from_range(cls,tick_lower,tick_upper,tick_spacing):
+        # Usable ticks of a pool between tick_lower and tick_upper
+        first = -(-max(tick_lower,MIN_TICK) // tick_spacing) * tick_spacing
+        return cls(np.arange(first,min(tick_upper,MAX_TICK)+1,tick_spacing))
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def positions(self,ticks):
+        ticks     = np.asarray(ticks,dtype=np.int64)
+        positions = np.searchsorted(self.ticks,ticks)
+        found     = positions < len(self.ticks)
+        found[found] = self.ticks[positions[found]] == ticks[found]
+        return positions,found
+
+    def __getitem__(self,tick):
+        positions,found = self.positions([tick])
+        if not found[0]:
+            return get_sqrt_ratio_at_tick(tick)
+        lo,mid,hi = (int(x) for x in self.limbs[positions[0]])
+        return lo | (mid << 64) | (hi << 128)
+
+    def sqrt_ratios(self,ticks):
+        # Exact sqrt ratios as an object array of python ints
+        return np.array([self[tick] for tick in np.asarray(ticks,dtype=np.int64).ravel()],dtype=object).reshape(np.shape(ticks))
+
+    def sqrt_ratios_float(self,ticks):
+        # sqrt ratios rounded to float64, ticks outside the table are computed
+        positions,found = self.positions(ticks)
+        values          = np.empty(np.shape(positions))
+        values[found]   = self.floats[positions[found]]
+        values[~found]  = [float(get_sqrt_ratio_at_tick(tick)) for tick in np.asarray(ticks,dtype=np.int64)[~found]]
+        return values
+
+##############################################################
+# SqrtPriceMath
+# Token amounts in raw units between two sqrt ratios for a liquidity
+##############################################################
+
+def get_amount0_delta(sqrt_ratio_a,sqrt_ratio_b,liquidity,round_up):
+
+    if sqrt_ratio_a > sqrt_ratio_b:
+        sqrt_ratio_a,sqrt_ratio_b = sqrt_ratio_b,sqrt_ratio_a
+    if sqrt_ratio_a <= 0:
+        raise ValueError('sqrt ratio must be positive')
+
+    numerator_1 = liquidity << 96
+    numerator_2 = sqrt_ratio_b - sqrt_ratio_a
+
+    if round_up:
+        return div_rounding_up(mul_div_rounding_up(numerator_1,numerator_2,sqrt_ratio_b),sqrt_ratio_a)
+    return mul_div(numerator_1,numerator_2,sqrt_ratio_b) // sqrt_ratio_a
+
+def get_amount1_delta(sqrt_ratio_a,sqrt_ratio_b,liquidity,round_up):
+
+    if sqrt_ratio_a > sqrt_ratio_b:
+        sqrt_ratio_a,sqrt_ratio_b = sqrt_ratio_b,sqrt_ratio_a
+
+    if round_up:
+        return mul_div_rounding_up(liquidity,sqrt_ratio_b-sqrt_ratio_a,Q96)
+    return mul_div(liquidity,sqrt_ratio_b-sqrt_ratio_a,Q96)
+
+def get_amount0_delta_signed(sqrt_ratio_a,sqrt_ratio_b,liquidity_delta):
+    # Owed to the pool when adding liquidity (rounded up), negative when removing it (rounded down)
+    if liquidity_delta < 0:
+        return -get_amount0_delta(sqrt_ratio_a,sqrt_ratio_b,-liquidity_delta,False)
+    return get_amount0_delta(sqrt_ratio_a,sqrt_ratio_b,liquidity_delta,True)
+
+def get_amount1_delta_signed(sqrt_ratio_a,sqrt_ratio_b,liquidity_delta):
+    if liquidity_delta < 0:
+        return -get_amount1_delta(sqrt_ratio_a,sqrt_ratio_b,-liquidity_delta,False)
+    return get_amount1_delta(sqrt_ratio_a,sqrt_ratio_b,liquidity_delta,True)
+
+def get_position_amounts(tick_current,sqrt_price_x96,tick_lower,tick_upper,liquidity_delta):
+
+    # Amounts of UniswapV3Pool._modifyPosition: paid in for a positive liquidity_delta (mint),
+    # negative amounts are paid out for a negative one (burn)
+    sqrt_ratio_lower = get_sqrt_ratio_at_tick(tick_lower)
+    sqrt_ratio_upper = get_sqrt_ratio_at_tick(tick_upper)
+
+    if tick_current < tick_lower:
+        return get_amount0_delta_signed(sqrt_ratio_lower,sqrt_ratio_upper,liquidity_delta),0
+    elif tick_current < tick_upper:
+        return (get_amount0_delta_signed(sqrt_price_x96,sqrt_ratio_upper,liquidity_delta),
+                get_amount1_delta_signed(sqrt_ratio_lower,sqrt_price_x96,liquidity_delta))
+    else:
+        return 0,get_amount1_delta_signed(sqrt_ratio_lower,sqrt_ratio_upper,liquidity_delta)
+
+##############################################################
+# LiquidityAmounts (periphery)
+##############################################################
+
+def get_liquidity_for_amount0(sqrt_ratio_a,sqrt_ratio_b,amount0):
+    if sqrt_ratio_a > sqrt_ratio_b:
+        sqrt_ratio_a,sqrt_ratio_b = sqrt_ratio_b,sqrt_ratio_a
+    intermediate = mul_div(sqrt_ratio_a,sqrt_ratio_b,Q96)
+    return to_uint128(mul_div(amount0,intermediate,sqrt_ratio_b-sqrt_ratio_a))
+
+def get_liquidity_for_amount1(sqrt_ratio_a,sqrt_ratio_b,amount1):
+    if sqrt_ratio_a > sqrt_ratio_b:
+        sqrt_ratio_a,sqrt_ratio_b = sqrt_ratio_b,sqrt_ratio_a
+    return to_uint128(mul_div(amount1,Q96,sqrt_ratio_b-sqrt_ratio_a))
+
+def get_liquidity_for_amounts(sqrt_price_x96,sqrt_ratio_a,sqrt_ratio_b,amount0,amount1):
+
+    if sqrt_ratio_a > sqrt_ratio_b:
+        sqrt_ratio_a,sqrt_ratio_b = sqrt_ratio_b,sqrt_ratio_a
+
+    if sqrt_price_x96 <= sqrt_ratio_a:
+        return get_liquidity_for_amount0(sqrt_ratio_a,sqrt_ratio_b,amount0)
+    elif sqrt_price_x96 < sqrt_ratio_b:
+        liquidity0 = get_liquidity_for_amount0(sqrt_price_x96,sqrt_ratio_b,amount0)
+        liquidity1 = get_liquidity_for_amount1(sqrt_ratio_a,sqrt_price_x96,amount1)
+        return liquidity0 if liquidity0 < liquidity1 else liquidity1
+    else:
+        return get_liquidity_for_amount1(sqrt_ratio_a,sqrt_ratio_b,amount1)
+
+def get_amount0_for_liquidity(sqrt_ratio_a,sqrt_ratio_b,liquidity):
+    if sqrt_ratio_a > sqrt_ratio_b:
+        sqrt_ratio_a,sqrt_ratio_b = sqrt_ratio_b,sqrt_ratio_a
+    return mul_div(liquidity << 96,sqrt_ratio_b-sqrt_ratio_a,sqrt_ratio_b) // sqrt_ratio_a
+
+def get_amount1_for_liquidity(sqrt_ratio_a,sqrt_ratio_b,liquidity):
+    if sqrt_ratio_a > sqrt_ratio_b:
+        sqrt_ratio_a,sqrt_ratio_b = sqrt_ratio_b,sqrt_ratio_a
+    return mul_div(liquidity,sqrt_ratio_b-sqrt_ratio_a,Q96)
+
+def get_amounts_for_liquidity(sqrt_price_x96,sqrt_ratio_a,sqrt_ratio_b,liquidity):
+
+    if sqrt_ratio_a > sqrt_ratio_b:
+        sqrt_ratio_a,sqrt_ratio_b = sqrt_ratio_b,sqrt_ratio_a
+
+    if sqrt_price_x96 <= sqrt_ratio_a:
+        return get_amount0_for_liquidity(sqrt_ratio_a,sqrt_ratio_b,liquidity),0
+    elif sqrt_price_x96 < sqrt_ratio_b:
+        return (get_amount0_for_liquidity(sqrt_price_x96,sqrt_ratio_b,liquidity),
+                get_amount1_for_liquidity(sqrt_ratio_a,sqrt_price_x96,liquidity))
+    else:
+        return 0,get_amount1_for_liquidity(sqrt_ratio_a,sqrt_ratio_b,liquidity)
+
+##############################################################
+# Same as UNI_v3_funcs.get_amounts and get_liquidity, from ticks,
+# with exact sqrt ratios and amounts in raw token units
+##############################################################
+
+def get_amounts(tick,tickA,tickB,liquidity):
+    return get_amounts_for_liquidity(get_sqrt_ratio_at_tick(tick),get_sqrt_ratio_at_tick(tickA),get_sqrt_ratio_at_tick(tickB),int(liquidity))
+
+def get_liquidity(tick,tickA,tickB,amount0,amount1):
+    return get_liquidity_for_amounts(get_sqrt_ratio_at_tick(tick),get_sqrt_ratio_at_tick(tickA),get_sqrt_ratio_at_tick(tickB),int(amount0),int(amount1))
@@ -7,6 +7,9 @@ Created on Mon Jun 14 18:53:09 2021
 
 
 
+import numpy as np
+import functools
+
 '''liquitidymath'''
 '''Python library to emulate the calculations done in liquiditymath.sol of UNI_V3 peryphery contract'''
 
@@ -14,6 +17,15 @@ Created on Mon Jun 14 18:53:09 2021
 #liquidity: int
 #sqrtA = price for lower tick
 #sqrtB = price for upper tick
+
+#sqrtP of a tick, computed once per tick (ticks are used as python ints)
+#Ticks are integers, a fractional tick is an error rather than being truncated
+@functools.lru_cache(maxsize=None)
+def sqrt_price_x96(tick):
+    if tick != int(tick):
+        raise ValueError('tick must be an integer, got '+str(tick))
+    return int(1.0001**(int(tick)/2)*(2**96))
+
 '''get_amounts function'''
 #Use 'get_amounts' function to calculate amounts as a function of liquitidy and price range
 def get_amount0(sqrtA,sqrtB,liquidity,decimals):
@@ -36,9 +48,9 @@ def get_amount1(sqrtA,sqrtB,liquidity,decimals):
 
 def get_amounts(tick,tickA,tickB,liquidity,decimal0,decimal1):
 
-    sqrt  = int(1.0001**(tick/2)*(2**96))
-    sqrtA = int(1.0001**(tickA/2)*(2**96))
-    sqrtB = int(1.0001**(tickB/2)*(2**96))
+    sqrt  = sqrt_price_x96(tick)
+    sqrtA = sqrt_price_x96(tickA)
+    sqrtB = sqrt_price_x96(tickB)
 
     if (sqrtA > sqrtB):
         (sqrtA,sqrtB)=(sqrtB,sqrtA)
@@ -95,9 +107,9 @@ def get_liquidity1(sqrtA,sqrtB,amount1,decimals):
 
 def get_liquidity(tick,tickA,tickB,amount0,amount1,decimal0,decimal1):
     
-        sqrt  = int(1.0001**(tick/2)*(2**96))
-        sqrtA = int(1.0001**(tickA/2)*(2**96))
-        sqrtB = int(1.0001**(tickB/2)*(2**96))
+        sqrt  = sqrt_price_x96(tick)
+        sqrtA = sqrt_price_x96(tickA)
+        sqrtB = sqrt_price_x96(tickB)
         
         if (sqrtA > sqrtB):
             (sqrtA,sqrtB)=(sqrtB,sqrtA)
@@ -117,7 +129,113 @@ def get_liquidity(tick,tickA,tickB,amount0,amount1,decimal0,decimal1):
             return liquidity1
 
 
-        
+'''array versions'''
+#Same functions over NumPy arrays of ticks, liquidities and amounts (broadcast against each other),
+#with the same results as calling the functions above on every element.
+#sqrtP are object arrays of python ints (sqrt_price_x96_array). Float liquidities are computed in float64,
+#integer liquidities are kept as python ints (they can be larger than int64) and computed like python does.
+def sqrt_price_x96_array(ticks):
+    return np.asarray(np.frompyfunc(sqrt_price_x96,1,1)(np.asarray(ticks)),dtype=object)
 
-        
-        
\ No newline at end of file
+def exact_liquidity(liquidity):
+    liquidity = np.asarray(liquidity)
+    if liquidity.dtype.kind == 'f':
+        return liquidity
+    return liquidity.astype(object)
+
+def get_amount0_array(sqrtA,sqrtB,liquidity,decimals):
+    
+    sqrtA,sqrtB = np.minimum(sqrtA,sqrtB),np.maximum(sqrtA,sqrtB)
+    liquidity   = exact_liquidity(liquidity)
+    
+    if liquidity.dtype.kind == 'f':
+        # python converts each int to float before multiplying or dividing by a float
+        amount0 = ((liquidity*2.0**96*(sqrtB-sqrtA).astype(float)/sqrtB.astype(float)/sqrtA.astype(float))/float(10**decimals))
+    else:
+        amount0 = ((liquidity*2**96*(sqrtB-sqrtA)/sqrtB/sqrtA)/10**decimals)
+    
+    return np.asarray(amount0,dtype=float)
+
+def get_amount1_array(sqrtA,sqrtB,liquidity,decimals):
+    
+    sqrtA,sqrtB = np.minimum(sqrtA,sqrtB),np.maximum(sqrtA,sqrtB)
+    liquidity   = exact_liquidity(liquidity)
+    
+    if liquidity.dtype.kind == 'f':
+        amount1 = liquidity*(sqrtB-sqrtA).astype(float)/2.0**96/float(10**decimals)
+    else:
+        amount1 = liquidity*(sqrtB-sqrtA)/2**96/10**decimals
+    
+    return np.asarray(amount1,dtype=float)
+
+def get_amounts_array(tick,tickA,tickB,liquidity,decimal0,decimal1):
+    
+    tick,tickA,tickB,liquidity = np.broadcast_arrays(np.asarray(tick),np.asarray(tickA),np.asarray(tickB),exact_liquidity(liquidity))
+    shape                      = np.shape(tick)
+    tick,tickA,tickB,liquidity = tick.ravel(),tickA.ravel(),tickB.ravel(),liquidity.ravel()
+    
+    sqrt        = sqrt_price_x96_array(tick)
+    sqrtA       = sqrt_price_x96_array(tickA)
+    sqrtB       = sqrt_price_x96_array(tickB)
+    sqrtA,sqrtB = np.minimum(sqrtA,sqrtB),np.maximum(sqrtA,sqrtB)
+    
+    below       = (sqrt <= sqrtA).astype(bool)
+    inside      = ((sqrt < sqrtB) & (sqrt > sqrtA)).astype(bool)
+    above       = ~below & ~inside
+    
+    amount0     = np.zeros(np.shape(sqrt))
+    amount1     = np.zeros(np.shape(sqrt))
+    
+    amount0[below]  = get_amount0_array(sqrtA[below],sqrtB[below],liquidity[below],decimal0)
+    amount0[inside] = get_amount0_array(sqrt[inside],sqrtB[inside],liquidity[inside],decimal0)
+    amount1[inside] = get_amount1_array(sqrtA[inside],sqrt[inside],liquidity[inside],decimal1)
+    amount1[above]  = get_amount1_array(sqrtA[above],sqrtB[above],liquidity[above],decimal1)
+    
+    return amount0.reshape(shape),amount1.reshape(shape)
+
+#Liquidities are returned as object arrays of python ints
+def get_liquidity0_array(sqrtA,sqrtB,amount0,decimals):
+    
+    sqrtA,sqrtB = np.minimum(sqrtA,sqrtB),np.maximum(sqrtA,sqrtB)
+    
+    # 2**96*(sqrtB-sqrtA)/sqrtB divides two python ints
+    per_liquidity = np.asarray((2**96*(sqrtB-sqrtA)/sqrtB/sqrtA)/10**decimals,dtype=float)
+    if np.any(per_liquidity == 0.0):
+        raise ZeroDivisionError('float division by zero')
+    
+    return np.asarray(np.frompyfunc(int,1,1)(np.asarray(amount0,dtype=float)/per_liquidity),dtype=object)
+
+def get_liquidity1_array(sqrtA,sqrtB,amount1,decimals):
+    
+    sqrtA,sqrtB = np.minimum(sqrtA,sqrtB),np.maximum(sqrtA,sqrtB)
+    
+    per_liquidity = np.asarray((sqrtB-sqrtA)/2**96/10**decimals,dtype=float)
+    if np.any(per_liquidity == 0.0):
+        raise ZeroDivisionError('float division by zero')
+    
+    return np.asarray(np.frompyfunc(int,1,1)(np.asarray(amount1,dtype=float)/per_liquidity),dtype=object)
+
+def get_liquidity_array(tick,tickA,tickB,amount0,amount1,decimal0,decimal1):
+    
+    tick,tickA,tickB,amount0,amount1 = np.broadcast_arrays(np.asarray(tick),np.asarray(tickA),np.asarray(tickB),
+                                                           np.asarray(amount0,dtype=float),np.asarray(amount1,dtype=float))
+    shape                            = np.shape(tick)
+    tick,tickA,tickB,amount0,amount1 = tick.ravel(),tickA.ravel(),tickB.ravel(),amount0.ravel(),amount1.ravel()
+    
+    sqrt        = sqrt_price_x96_array(tick)
+    sqrtA       = sqrt_price_x96_array(tickA)
+    sqrtB       = sqrt_price_x96_array(tickB)
+    sqrtA,sqrtB = np.minimum(sqrtA,sqrtB),np.maximum(sqrtA,sqrtB)
+    
+    below       = (sqrt <= sqrtA).astype(bool)
+    inside      = ((sqrt < sqrtB) & (sqrt > sqrtA)).astype(bool)
+    above       = ~below & ~inside
+    
+    liquidity   = np.zeros(np.shape(sqrt),dtype=object)
+    
+    liquidity[below]  = get_liquidity0_array(sqrtA[below],sqrtB[below],amount0[below],decimal0)
+    liquidity[inside] = np.minimum(get_liquidity0_array(sqrt[inside],sqrtB[inside],amount0[inside],decimal0),
+                                   get_liquidity1_array(sqrtA[inside],sqrt[inside],amount1[inside],decimal1))
+    liquidity[above]  = get_liquidity1_array(sqrtA[above],sqrtB[above],amount1[above],decimal1)
+    
+    return liquidity.reshape(shape)